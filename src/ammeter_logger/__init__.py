@@ -1 +1,13 @@
-from .ammeter_recv import AmmeterRecvSerial
\ No newline at end of file
+from .ammeter_recv import AmmeterRecvSerial
+from .sample_store import SampleStore, Sample
+from .binary_capture import BinaryCaptureReader, convert_to_csv
+from .ammeter_core import AmmeterCore
+from .async_recv import AsyncAmmeterRecv
+from .multi_capture import MultiAmmeterCapture, merge_samples
+from .stats import StatsEngine
+from .decimation import DecimationPyramid, build_pyramid, lttb
+from .triggers import TriggeredCapture, ThresholdTrigger, RateTrigger
+from .export import export_capture
+from .fanout import SampleServer, SampleSubscriber
+from .device_cache import DeviceConfigCache
+from .analysis import analyze_captures, replay_capture
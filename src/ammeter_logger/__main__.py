@@ -1,42 +1,262 @@
 from .ammeter_recv import AmmeterRecvSerial
 from .logging_handler import create_logger
+from .spool import CsvSink, SpoolWriter
+from .binary_capture import BinarySink
+from .multi_capture import MultiAmmeterCapture, MergedCsvSink, StreamingMerger
+from .stats import StatsEngine, format_summary
+from .decimation import DecimationPyramid, write_pyramid
+from .triggers import ThresholdTrigger, RateTrigger, TriggeredCapture
+from .metrics import MetricsExporter
+from .export import export_capture
+from .fanout import SampleServer
+from .device_cache import DeviceConfigCache
+from .analysis import ANALYSIS_COMMANDS, main as analysis_main
 import argparse
 from time import sleep, time
+import sys
 import json
-import csv
-from datetime import datetime
 import signal
 
-def write_log_data(serial_device:AmmeterRecvSerial, args:dict):
-    """ Write the log data to the specified file """
+# options that are only implemented for a single device capture
+SINGLE_DEVICE_OPTIONS = ('trigger_above', 'trigger_below', 'trigger_rate', 'publish')
+
+# seconds between STATUS polls while waiting for the ammeter to initialize
+INIT_POLL_INTERVAL = 0.25
+
+
+def create_sink(args:dict):
+    """ Create the output sink for the capture file in the selected format """
+    if args['format'] == 'binary':
+        return BinarySink(args['file'])
+    return CsvSink(args['file'])
+
+
+def write_log_data(serial_device:AmmeterRecvSerial, args:dict, spool=None):
+    """ Write the log data to the specified file.  For a streaming capture the spool is drained and closed instead """
+    run_info = {'config': serial_device.ammeter_config_data, 'start': serial_device.ammeter_start_time,
+                'stop': serial_device.ammeter_stop_time}
+    if spool is not None:
+        print(f"Finishing streamed log file {args['file']}...")
+        spool.close(run_info=run_info)
+        print(f"Writing complete.  {spool.samples_written} samples written.")
+        if spool.write_error is not None:
+            print(f"Error writing the log file, {spool.samples_dropped} samples were not written: {spool.write_error}")
+        return
     print(f"Writing log to file {args['file']}...")
-    with open(args['file'], 'w', encoding='utf-8') as output_file:
-        writer = csv.writer(output_file)
-        header = ['received_epoch', 'name', 'received_datetime', 'ticks', 'latest']
-        for x in range(len(serial_device.ammeter_data[0]['last_reads'])):
-            header.append(f'read_{x+1}')
-        header.append('time_from_start')
-        header.append('average')
-        writer.writerow(header)
-        for record in serial_device.ammeter_data:
-            row = [
-                record['received'], 
-                record['name'],  
-                datetime.fromtimestamp(record['received']).strftime('%Y-%m-%d %H:%M:%S.%f'),
-                record['ticks'], 
-                record['current_amps']]
-            for x in range(len(record['last_reads'])):
-                row.append(record['last_reads'][x])
-            row.append(float(record['ticks'])/1000)
-            row.append(record['average'])
-            writer.writerow(row)
+    if args['format'] != 'binary':
+        # text and npz formats are encoded in bulk, a chunk at a time on a pool of worker processes.  The receive and
+        # logging threads are still running, so the workers are spawned rather than forked, and the data is read
+        # from a snapshot so the lock isn't held while encoding
+        with serial_device.ammeter_data_lock:
+            snapshot = serial_device.ammeter_data.snapshot()
+        result = export_capture(snapshot, args['file'], output_format=args['format'], workers=args['export_workers'], executor='spawn')
+        print(f"Writing complete.  {result['rows']} samples written in {result['seconds']:.2f} s ({result['rows_per_sec']:,.0f} rows/sec).")
+        return
+    sink = create_sink(args)
+    sink.set_run_info(**run_info)
+    with serial_device.ammeter_data_lock:
+        sink.write_samples(serial_device.ammeter_data)
+    sink.close()
     print("Writing complete.")
 
 
+def create_triggered_capture(args:dict, config:dict):
+    """ Create the triggered capture for the --trigger-* arguments (None if no trigger is set).  Segments are saved to
+        OUTPUT_FILE.<segment>.csv (or .bin)
+    """
+    triggers = []
+    if args['trigger_above'] is not None or args['trigger_below'] is not None:
+        triggers.append(ThresholdTrigger(args['trigger_field'], above=args['trigger_above'], below=args['trigger_below']))
+    if args['trigger_rate'] is not None:
+        triggers.append(RateTrigger(args['trigger_rate'], field=args['trigger_field']))
+    if len(triggers) == 0:
+        return None
+    def sink_factory(segment:int):
+        """ Create the sink for a segment in the selected format """
+        if args['format'] == 'binary':
+            return BinarySink(f"{args['file']}.{segment:04d}.bin")
+        return CsvSink(f"{args['file']}.{segment:04d}.csv")
+    return TriggeredCapture(triggers, pre_seconds=args['pre_trigger'], post_seconds=args['post_trigger'],
+                            sink_factory=sink_factory, config=config)
+
+
+def write_segments(triggered:TriggeredCapture):
+    """ Finish the triggered capture and list the saved segments """
+    triggered.close()
+    print(f"Saved {len(triggered.segments)} segments ({triggered.triggers_fired} triggering samples).")
+    for segment in triggered.segments:
+        print(f"    Segment {segment['segment']}: trigger at ticks {segment['trigger_ticks']}, {segment['samples']} samples "
+              f"from ticks {segment['start_ticks']} to {segment['stop_ticks']}")
+
+
+def create_metrics_exporter(args:dict, registries:list):
+    """ Start writing the receive metrics to the --metrics-file if set """
+    if args['metrics_file'] is None:
+        return None
+    return MetricsExporter(registries, args['metrics_file'], output_format=args['metrics_format'], interval=args['metrics_interval'])
+
+
+def write_pyramid_files(pyramid:DecimationPyramid, prefix:str, lttb_points:int):
+    """ Finish the downsampled levels built during the capture and write them next to the output file """
+    pyramid.finish(lttb_points)
+    for file_name in write_pyramid(pyramid, prefix):
+        print(f"Wrote downsampled levels to {file_name}")
+
+
+def print_multi_summary(capture:MultiAmmeterCapture):
+    """ Print the per device summary of a multi device capture """
+    for device, summary in capture.summary().items():
+        print(f"{device}: {summary['samples']} samples.  Start: {summary['start']}  Stop: {summary['stop']}")
+        print(format_summary(summary['channels']))
+
+
+def create_config_cache(args:dict, logger):
+    """ Return the device config cache, None if disabled """
+    if args['no_config_cache']:
+        return None
+    cache = DeviceConfigCache(logger=logger)
+    if args['clear_config_cache']:
+        cache.invalidate()
+    return cache
+
+
+def print_startup_time(startup:float, first_sample):
+    """ Print the time from starting the logger to the first sample received """
+    if first_sample is not None:
+        print(f"Startup to first sample: {first_sample - startup:.3f} s")
+
+
+def run_multi_capture(args:dict, logger, startup:float):
+    """ Capture from several devices at once and write a single time ordered output """
+    if args['format'] != 'csv':
+        print("Only CSV output is supported when capturing from multiple devices")
+        quit(1)
+    single_device = [option for option in SINGLE_DEVICE_OPTIONS if args[option] is not None]
+    if len(single_device) > 0:
+        print(f"{', '.join('--' + option.replace('_', '-') for option in single_device)} can only be used with a single device")
+        quit(1)
+    capture = MultiAmmeterCapture(args['device'], baudrate=args['baudrate'], logger=logger, keep_samples=not args['stream'])
+
+    # get config and status if requested and quit
+    if args['get_config']:
+        print(f"Current Config: {capture.config()}")
+    if args['get_status']:
+        print(f"Current Status: {capture.status()}")
+    if args['get_config'] or args['get_status']:
+        quit()
+
+    # status and config of every device in one round trip, the config from the cache where possible
+    sessions = capture.session(create_config_cache(args, logger))
+
+    # initialize the devices
+    init_devices = [device for device, session in sessions.items()
+                    if (session['status'].get('status') == 'NOINIT' and not args['skip_init']) or args['force_init'] or args['init_only']]
+    if len(init_devices) > 0:
+        for device in init_devices:
+            capture.devices[device].ammeter_init()
+        timeout = time() + 2 + max(sessions[device]['config'].get('init_timeout', 0) for device in init_devices)
+        status = {}
+        while time() < timeout:
+            last_status, status = status, capture.status()
+            if all(device_status.get('status') == 'READY' for device_status in status.values()):
+                break
+            if status != last_status:
+                print(f'Waiting for ammeters to initialize. {status}')
+            sleep(INIT_POLL_INTERVAL)
+        status = capture.status()
+        if not all(device_status.get('status') == 'READY' for device_status in status.values()):
+            print(f"Ammeters are not ready!  Current status: {status}")
+            quit(1)
+    if args['init_only']:
+        print(f"Current Config: {capture.config()}")
+        print(f"Current Status: {capture.status()}")
+        quit()
+
+    # when streaming, the merged samples are written by the spool while the capture runs
+    spool, merger = None, None
+    if args['stream']:
+        spool = SpoolWriter(MergedCsvSink(args['file']), flush_interval=args['flush_interval'], fsync_interval=args['fsync_interval'])
+        merger = StreamingMerger(list(capture.devices), spool)
+        for device in capture.devices:
+            capture.add_sample_listener(device, merger.listener(device))
+            # a device that stops first mustn't hold back the samples of the others
+            capture.devices[device].add_state_listener(merger.state_listener(device))
+
+    # downsampled levels for each device, written as OUTPUT_FILE.<device number>.L<level>.csv
+    pyramids = {}
+    if args['pyramid']:
+        for device in capture.devices:
+            pyramids[device] = DecimationPyramid()
+            capture.add_sample_listener(device, pyramids[device])
+
+    # receive metrics for every device
+    exporter = create_metrics_exporter(args, [ammeter.ammeter_metrics for ammeter in capture.devices.values()])
+
+    def write_output():
+        """ Write the merged output and the per device summary """
+        if exporter is not None:
+            exporter.close()
+        if spool is not None:
+            merger.finish()
+            spool.close()
+            print(f"Writing complete.  {spool.samples_written} samples written.")
+        else:
+            print(f"Writing merged log to file {args['file']}...")
+            sink = MergedCsvSink(args['file'])
+            sink.write_samples(capture.merged_samples())
+            sink.close()
+            print(f"Writing complete.  {sink.rows_written} samples written.")
+        for index, pyramid in enumerate(pyramids.values()):
+            write_pyramid_files(pyramid, f"{args['file']}.{index}", args['pyramid_points'])
+        print_multi_summary(capture)
+        first_samples = [ammeter.ammeter_first_sample_time for ammeter in capture.devices.values() if ammeter.ammeter_first_sample_time is not None]
+        print_startup_time(startup, min(first_samples) if len(first_samples) > 0 else None)
+
+    # a cached config (or one from before the init) is refreshed, the response arrives before START so the refresh
+    # doesn't delay the start.  The response also updates the cache.
+    refreshes = {device: capture.devices[device].ammeter_command('CONFIG', 'CONFIG') for device, session in sessions.items()
+                 if session['cached'] or device in init_devices}
+
+    # start all devices together
+    started = capture.start(timeout=args['capture_time'])
+    if not all(started.values()):
+        print(f"Error starting the ammeters!  Started: {started}.  Current status: {capture.status()}")
+        capture.stop()
+        quit(1)
+
+    def break_handler(signum, frame):
+        """ Handle a ctrl+c from the user to stop the data collection and write the collected data """
+        print("Caught Ctrl+C.  Stopping data collection...")
+        stopped = capture.stop()
+        if not all(stopped.values()):
+            print(f"Error stopping the ammeters!  Stopped: {stopped}")
+        write_output()
+        quit()
+    signal.signal(signal.SIGINT, break_handler)
+
+    # wait for every device to complete
+    for device, refresh in refreshes.items():
+        sessions[device]['config'] = capture.devices[device].ammeter_wait(refresh, sessions[device]['config'])
+    run_time = max(session['config'].get('timeout', 0) for session in sessions.values()) if args['capture_time'] is None else args['capture_time']
+    print(f"Starting data collection on {len(capture.devices)} devices.  Collection will run for {run_time} seconds.  You can stop at any point and write the captured data using CTRL+C.")
+    timeout = time() + 2 + run_time
+    while not capture.wait(timeout=2):
+        if time() > timeout:
+            print("Timed out waiting for the logging run to complete.")
+            break
+        progress = {device: {name: channel['last'] for name, channel in stats.snapshot().items()} for device, stats in capture.stats.items()}
+        print(f"Waiting for logging run to complete.  Last amp reads: {progress}")
+    write_output()
+
+
 if __name__ == '__main__':
+    # offline analysis of saved captures (analyze, replay) has its own arguments
+    if len(sys.argv) > 1 and sys.argv[1] in ANALYSIS_COMMANDS:
+        quit(analysis_main(sys.argv[1:]))
+
     # setup the argument parser
-    parser = argparse.ArgumentParser(description="Start the ammeter data collector.  Requires the sender to be running (provided sender is Micropython for a microcontroller)")
-    parser.add_argument('device', metavar='DEVICE', help='Serial device connected to the microcontroller (i.e. /dev/ttyUSB0')
+    parser = argparse.ArgumentParser(description="Start the ammeter data collector.  Requires the sender to be running (provided sender is Micropython for a microcontroller).  Saved captures can be summarized with 'analyze' or replayed with 'replay' (see analyze -h and replay -h)")
+    parser.add_argument('device', metavar='DEVICE', nargs='+', help='Serial device(s) connected to the microcontroller (i.e. /dev/ttyUSB0).  Multiple devices are captured together into one time ordered output')
     parser.add_argument('file', metavar='OUTPUT_FILE', help='File to save captured data to')
     parser.add_argument('--get-config', dest='get_config', required=False, action='store_true', default=False, help="(False) Get the configuration from the microcontroller and quit")
     parser.add_argument('--get-status', dest='get_status', required=False, action='store_true', default=False, help="(False) Get the current status of the microcontroller and quit")
@@ -46,12 +266,45 @@ if __name__ == '__main__':
     parser.add_argument('--sample-interval', dest='sample_interval', required=False, type=int, default=0, help="Set the sampling interval, overrides the config on the microcontroller")
     parser.add_argument('--capture-time', dest='capture_time', required=False, type=int, default=None, help="Set the max time to capture before stopping, overrides the config on the microcontroller")
     parser.add_argument('--baudrate', dest='baudrate', required=False, type=int, default=115200, help="(115200) Set the baudrate for the serial interface")
+    parser.add_argument('--format', dest='format', required=False, choices=['csv', 'binary', 'jsonl', 'npz', 'csv.gz'], default='csv', help="(csv) Output file format.  binary is a compact capture that can be memory-mapped with BinaryCaptureReader, jsonl/npz/csv.gz are written when the capture completes (not with --stream)")
+    parser.add_argument('--export-workers', dest='export_workers', required=False, type=int, default=None, help="Number of worker processes used to encode the output file (default the number of CPUs)")
+    parser.add_argument('--stream', dest='stream', required=False, action='store_true', default=False, help="(False) Write samples to the output file while capturing instead of holding the run in memory")
+    parser.add_argument('--flush-interval', dest='flush_interval', required=False, type=float, default=1.0, help="(1.0) Seconds between writes of buffered samples when streaming")
+    parser.add_argument('--fsync-interval', dest='fsync_interval', required=False, type=float, default=10.0, help="(10.0) Seconds between forcing streamed samples to disk")
+    parser.add_argument('--pyramid', dest='pyramid', required=False, action='store_true', default=False, help="(False) Also write downsampled min/max/mean levels and an LTTB level for plotting (OUTPUT_FILE.L<level>.csv, OUTPUT_FILE.lttb.csv)")
+    parser.add_argument('--pyramid-points', dest='pyramid_points', required=False, type=int, default=2000, help="(2000) Number of points in the LTTB level")
+    parser.add_argument('--trigger-above', dest='trigger_above', required=False, type=float, default=None, help="Only save segments around samples above this current (continuous monitoring, single device)")
+    parser.add_argument('--trigger-below', dest='trigger_below', required=False, type=float, default=None, help="Only save segments around samples below this current")
+    parser.add_argument('--trigger-rate', dest='trigger_rate', required=False, type=float, default=None, help="Only save segments around a change of more than this many amps per second")
+    parser.add_argument('--trigger-field', dest='trigger_field', required=False, choices=['current_amps', 'average'], default='current_amps', help="(current_amps) Sample field the triggers are checked against")
+    parser.add_argument('--pre-trigger', dest='pre_trigger', required=False, type=float, default=5.0, help="(5.0) Seconds saved before a trigger")
+    parser.add_argument('--post-trigger', dest='post_trigger', required=False, type=float, default=5.0, help="(5.0) Seconds saved after the last trigger")
+    parser.add_argument('--metrics-file', dest='metrics_file', required=False, default=None, help="Write the receive metrics (rates, bad lines, parse time, backlog, lock wait, command latency) to this file while capturing")
+    parser.add_argument('--metrics-format', dest='metrics_format', required=False, choices=['prometheus', 'json'], default='prometheus', help="(prometheus) Metrics file format, a Prometheus text file (replaced each interval) or JSON lines (appended)")
+    parser.add_argument('--metrics-interval', dest='metrics_interval', required=False, type=float, default=10.0, help="(10.0) Seconds between metrics writes")
+    parser.add_argument('--publish', dest='publish', required=False, default=None, help="Publish the live samples on a Unix socket path or HOST:PORT for other local processes (single device)")
+    parser.add_argument('--publish-encoding', dest='publish_encoding', required=False, choices=['binary', 'jsonl'], default='binary', help="(binary) Encoding of the published batches, binary for SampleSubscriber or jsonl")
+    parser.add_argument('--publish-policy', dest='publish_policy', required=False, choices=['drop-oldest', 'disconnect'], default='drop-oldest', help="(drop-oldest) What to do with a subscriber that falls more than --publish-queue batches behind")
+    parser.add_argument('--publish-queue', dest='publish_queue', required=False, type=int, default=256, help="(256) Batches queued per subscriber before the --publish-policy applies")
+    parser.add_argument('--log-rate-limit', dest='log_rate_limit', required=False, type=float, default=10.0, help="(10.0) Maximum debug messages per second of each kind (i.e. received lines), 0 for no limit")
+    parser.add_argument('--no-config-cache', dest='no_config_cache', required=False, action='store_true', default=False, help="Always read the config from the ammeter instead of using the cached copy")
+    parser.add_argument('--clear-config-cache', dest='clear_config_cache', required=False, action='store_true', default=False, help="Clear the cached config of every ammeter before starting")
     parser.add_argument('--log-level', dest='log_level', required=False, type=str, default='INFO', help='(INFO) Specify the logging level for the console')
 
     args = vars(parser.parse_args())
+    startup = time()
+    logger = create_logger(console=True, console_level=args['log_level'], queue=True, rate_limit=args['log_rate_limit'])
 
-    # Create the device
-    serial_device = AmmeterRecvSerial(args['device'], baudrate=args['baudrate'], logger=create_logger(console=True, console_level=args['log_level']))
+    if args['stream'] and args['format'] not in ('csv', 'binary'):
+        print("Only CSV and binary output can be streamed")
+        quit(1)
+    if len(args['device']) > 1:
+        run_multi_capture(args, logger, startup)
+        quit()
+
+    # Create the device, a triggered capture only keeps the samples around the triggers
+    triggered_mode = any(args[trigger] is not None for trigger in ('trigger_above', 'trigger_below', 'trigger_rate'))
+    serial_device = AmmeterRecvSerial(args['device'][0], baudrate=args['baudrate'], keep_samples=not (args['stream'] or triggered_mode), logger=logger)
 
     # get config and status if requested and quit
     if args['get_config']:
@@ -62,17 +315,23 @@ if __name__ == '__main__':
         print(f"Current Status: {serial_device.ammeter_status}")
         quit()
 
+    # status and config in one round trip, the config from the cache where possible
+    session = serial_device.ammeter_session(create_config_cache(args, logger))
+    logger.info('%s: Session setup in %.3f s (config %s)', serial_device._info_str, session['seconds'], 'cached' if session['cached'] else 'read')
+
     # initialize the device
-    if (not serial_device.ammeter_initialized and not args['skip_init']) or args['force_init'] or args['init_only']:
+    initialized = (session['status'].get('status') == 'NOINIT' and not args['skip_init']) or args['force_init'] or args['init_only']
+    if initialized:
         serial_device.ammeter_init()
-        timeout = time() + 2 + serial_device.ammeter_config['init_timeout']
+        timeout = time() + 2 + session['config'].get('init_timeout', 0)
+        status = {}
         while time() < timeout:
-            status = serial_device.ammeter_status
-            if status['status'] != 'READY' or status['status'] != 'RUNNING':
-                print(f'Waiting for ammeter to initialize. {status}')
-            else:
+            last_status, status = status, serial_device.ammeter_status
+            if status.get('status') == 'READY':
                 break
-            sleep(2)
+            if status != last_status:
+                print(f'Waiting for ammeter to initialize. {status}')
+            sleep(INIT_POLL_INTERVAL)
         if not serial_device.ammeter_ready:
             print(f"Ammeter is not ready!  Current status: {serial_device.ammeter_status}")
             quit(1)
@@ -81,38 +340,96 @@ if __name__ == '__main__':
         print(f"Current Status: {serial_device.ammeter_status}")
         quit()
 
+    # when streaming, samples are written by the spool while the capture runs
+    spool, triggered = None, None
+    if triggered_mode:
+        triggered = create_triggered_capture(args, serial_device.ammeter_config_data)
+        serial_device.add_sample_listener(triggered)
+    elif args['stream']:
+        spool = SpoolWriter(create_sink(args), flush_interval=args['flush_interval'], fsync_interval=args['fsync_interval'])
+        serial_device.add_sample_listener(spool)
+
+    # running statistics for the progress line and the final summary
+    stats = StatsEngine()
+    serial_device.add_sample_listener(stats)
+
+    # receive metrics, written periodically while the capture runs
+    exporter = create_metrics_exporter(args, [serial_device.ammeter_metrics])
+
+    # live samples for other local processes
+    publisher = None
+    if args['publish'] is not None:
+        try:
+            publisher = SampleServer(args['publish'], encoding=args['publish_encoding'], policy=args['publish_policy'],
+                                     max_queue=args['publish_queue'], logger=logger)
+        except (ValueError, OSError) as e:
+            print(f"Unable to publish on {args['publish']}: {e}")
+            quit(1)
+        serial_device.add_sample_listener(publisher)
+
+    # downsampled levels built while the capture runs
+    pyramid = None
+    if args['pyramid']:
+        pyramid = DecimationPyramid()
+        serial_device.add_sample_listener(pyramid)
+
+    # a cached config (or one from before the init) is refreshed, the response arrives before START so the refresh
+    # doesn't delay the start.  The response also updates the cache.
+    refresh = serial_device.ammeter_command('CONFIG', 'CONFIG') if session['cached'] or initialized else None
+
     # start the logging
     return_value = serial_device.ammeter_start(timeout=args['capture_time'])
     if not return_value:
         print(f"Error starting the ammeter!  Current status: {serial_device.ammeter_status}")
         quit()
     
+    def write_output():
+        """ Write the collected data and close the capture stages """
+        if triggered is not None:
+            write_segments(triggered)
+        else:
+            write_log_data(serial_device, args, spool)
+        if pyramid is not None:
+            write_pyramid_files(pyramid, args['file'], args['pyramid_points'])
+        if exporter is not None:
+            exporter.close()
+        if publisher is not None:
+            publisher.close()
+        print(format_summary(stats.snapshot()))
+
     # Configure a handler to catch a Ctrl+C
     def break_handler(signum, frame):
         """ Handle a ctrl+c from the user to stop the data collection and write the collected data """
         print(f"Caught Ctrl+C.  Stopping data collection...")
-        if serial_device.ammeter_stop():
-            write_log_data(serial_device, args)
-        else:
+        if not serial_device.ammeter_stop():
             print(f"Error stopping the ammeter!  Current status: {serial_device.ammeter_status}")
+        write_output()
         quit()
     signal.signal(signal.SIGINT, break_handler)
 
-    # wait for the logging to complete
-    print(f"Starting data collection.  Collection will run for {serial_device.ammeter_config['timeout']} seconds.  You can stop at any point and write the captured data using CTRL+C.")
-    timeout = time() + 2 + (serial_device.ammeter_config['timeout'] if args['capture_time'] is None else args['capture_time'])
-    while time() < timeout:
-        status = serial_device.ammeter_status
-        if status['status'] == 'RUNNING':
-            last_read = serial_device.ammeter_data[len(serial_device.ammeter_data) - 1]['average'] if len(serial_device.ammeter_data) > 0 else 0
-            print(f"Waiting for logging run to complete.  Last amp read: {last_read}.  Current status: {status}")
-        elif status['status'] == 'READY':
-            print(f"Logging Run complete.  Current status: {status}.  Captured {len(serial_device.ammeter_data)} intervals")
-            break
-        else:
-            print(f"Microcontroller reporting an unexpected state: {status}.  Check and try again.")
+    # wait for the logging to complete, the run state is updated by the receive thread when STOP arrives
+    config = serial_device.ammeter_wait(refresh, session['config']) if refresh is not None else session['config']
+    run_time = config.get('timeout', 0) if args['capture_time'] is None else args['capture_time']
+    print(f"Starting data collection.  Collection will run for {run_time} seconds.  You can stop at any point and write the captured data using CTRL+C.")
+    timeout = time() + 2 + run_time
+    while not serial_device.ammeter_wait_complete(timeout=2):
+        run_state = serial_device.ammeter_run_state
+        if run_state != 'RUNNING':
+            # STOP may have arrived since the wait returned, READY means the run finished
+            if serial_device.ammeter_wait_complete(0) or run_state == 'READY':
+                break
+            print(f"Microcontroller reporting an unexpected state: {run_state}.  Check and try again.")
+            write_output()
             quit(1)
-        sleep(2)
-    
+        if time() > timeout:
+            print(f"Timed out waiting for the logging run to complete.  Current status: {serial_device.ammeter_status}")
+            break
+        last_sample = serial_device.ammeter_last_sample
+        last_read = last_sample['average'] if last_sample is not None else 0
+        means = {name: round(channel['mean'], 4) for name, channel in stats.snapshot().items()}
+        print(f"Waiting for logging run to complete.  Last amp read: {last_read}.  Mean: {means}.  Run state: {serial_device.ammeter_run_state}")
+    print(f"Logging Run complete.  Run state: {serial_device.ammeter_run_state}.  Captured {serial_device.ammeter_sample_count} intervals")
+    print_startup_time(startup, serial_device.ammeter_first_sample_time)
+
     # logging complete, write the data to a file
-    write_log_data(serial_device, args)
\ No newline at end of file
+    write_output()
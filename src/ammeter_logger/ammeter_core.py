@@ -0,0 +1,414 @@
+"""
+Transport independent core of the Micropython ammeter protocol, shared by the serial and asyncio receivers
+"""
+import logging
+from time import time, thread_time, perf_counter
+from threading import Lock, Event
+from collections import deque
+from concurrent.futures import Future
+from .line_framer import LineFramer
+from .sample_store import SampleStore, Sample
+from .protocol import PARSERS, ProtocolError, parse_data
+from .metrics import MetricsRegistry, SIZE_BUCKETS
+
+# time to wait for the ammeter to respond to a command (seconds)
+COMMAND_TIMEOUT = 3
+
+# run states tracked from the received records, matching the STATUS values reported by the ammeter
+STATE_UNKNOWN = 'UNKNOWN'
+STATE_NOINIT = 'NOINIT'
+STATE_INITIALIZING = 'INITIALIZING'
+STATE_READY = 'READY'
+STATE_RUNNING = 'RUNNING'
+
+
+class AmmeterCore:
+    """ Protocol state machine for the Micropython ammeter.  Received bytes are passed to _ammeter_feed() and
+        commands are sent through _ammeter_write(), which the transport class (serial thread or asyncio) provides.
+    """
+    def __init__(self, logger=None, keep_samples=True):
+        self._logger = logger if logger is not None else logging
+        # set keep_samples=False when a sample listener handles the data (streaming capture) to keep memory bounded
+        self.ammeter_keep_samples = keep_samples
+        self.ammeter_data = SampleStore()
+        self.ammeter_sample_count = 0
+        self.ammeter_last_sample = None
+        # last_reads width of the current run, set by the first sample
+        self._ammeter_reads_width = None
+        self.ammeter_first_sample_time = None
+        self._ammeter_sample_listeners = []
+        self._ammeter_new_samples = []
+        self._ammeter_framer = LineFramer()
+        self._ammeter_read_cpu_time = 0.0
+        self.ammeter_data_lock = Lock()
+        self.ammeter_config_lock = Lock()
+        self.ammeter_status_lock = Lock()
+        self.ammeter_config_data = {}
+        self.ammeter_status_data = {}
+        self.ammeter_start_time = {}
+        self.ammeter_stop_time = {}
+        self._ammeter_stopped = Event()
+        self.ammeter_run_state = STATE_UNKNOWN
+        self._ammeter_state_listeners = []
+        self.ammeter_config_cache = None
+        self._ammeter_cache_key = None
+        self._ammeter_pending_lock = Lock()
+        self._ammeter_pending = {record_type: deque() for record_type in PARSERS}
+        self._ammeter_handlers = {
+            'DATA': self._ammeter_handle_data,
+            'START': self._ammeter_handle_start,
+            'STOP': self._ammeter_handle_stop,
+            'CONFIG': self._ammeter_handle_config,
+            'STATUS': self._ammeter_handle_status
+        }
+        self._ammeter_init_metrics()
+
+    def _ammeter_init_metrics(self):
+        """ Create the receive pipeline metrics.  Counts already kept by the framer and the data table are read when
+            the metrics are collected, the receive thread only updates the histograms once per batch.
+        """
+        framer = self._ammeter_framer
+        metrics = self.ammeter_metrics = MetricsRegistry()
+        metrics.counter('ammeter_bytes_received_total', 'Bytes received from the ammeter', lambda: framer.bytes_received)
+        metrics.counter('ammeter_lines_received_total', 'Complete lines received from the ammeter', lambda: framer.lines_framed)
+        metrics.counter('ammeter_samples_received_total', 'DATA samples received in the current run', lambda: self.ammeter_sample_count)
+        metrics.counter('ammeter_read_cpu_seconds_total', 'Receive thread CPU time spent processing received data', lambda: self._ammeter_read_cpu_time)
+        self._ammeter_bad_lines = metrics.counter('ammeter_bad_lines_total', 'Received lines dropped as bad data')
+        metrics.gauge('ammeter_pending_bytes', 'Received bytes waiting for the end of a line', lambda: len(framer))
+        metrics.gauge('ammeter_pending_commands', 'Commands waiting for a response', lambda: sum(len(pending) for pending in self._ammeter_pending.values()))
+        self._ammeter_batch_lines = metrics.histogram('ammeter_batch_lines', 'Lines processed per read from the transport', SIZE_BUCKETS)
+        self._ammeter_parse_time = metrics.histogram('ammeter_parse_seconds_per_line', 'Time to parse and store a line, averaged over each read')
+        self._ammeter_lock_wait = metrics.histogram('ammeter_data_lock_wait_seconds', 'Time the receive thread waited for ammeter_data_lock')
+        self._ammeter_command_rtt = metrics.histogram('ammeter_command_rtt_seconds', 'Time from sending a command to receiving its response')
+
+    @property
+    def _info_str(self):
+        """ Returns a string identifying the class for logging purposes """
+        return self.__class__.__name__
+
+    def _ammeter_debug_enabled(self):
+        """ Return True if debug messages will be logged (the logger may be the logging module) """
+        is_enabled = getattr(self._logger, 'isEnabledFor', None)
+        if is_enabled is None:
+            is_enabled = logging.getLogger().isEnabledFor
+        return is_enabled(logging.DEBUG)
+
+    def _ammeter_write(self, data:bytes):
+        """ Send data to the ammeter, provided by the transport """
+        raise NotImplementedError
+
+    def _ammeter_feed(self, data:bytes):
+        """ Process bytes received from the ammeter """
+        cpu_start = thread_time()
+        wait_start = perf_counter()
+        with self.ammeter_data_lock:
+            parse_start = perf_counter()
+            self._ammeter_framer.feed(data)
+            lines = self._ammeter_framer.lines()
+        self._ammeter_lock_wait.observe(parse_start - wait_start)
+        try:
+            self._ammeter_process_lines(lines)
+        except Exception as e:
+            # keep the receive thread running, the rest of the batch is lost
+            self._ammeter_bad_lines.inc()
+            self._logger.exception('%s: Error processing received data: %s', self._info_str, e)
+        if len(lines) > 0:
+            self._ammeter_batch_lines.observe(len(lines))
+            self._ammeter_parse_time.observe((perf_counter() - parse_start) / len(lines))
+        self._ammeter_dispatch_samples()
+        self._ammeter_read_cpu_time += thread_time() - cpu_start
+
+    @property
+    def ammeter_partial_data(self):
+        """ Return any received data that has not been terminated with a newline yet """
+        with self.ammeter_data_lock:
+            return self._ammeter_framer.pending.decode('utf-8', errors='replace')
+
+    @property
+    def ammeter_read_stats(self):
+        """ Return the receive thread counters, including the thread CPU time spent per received line """
+        lines = self._ammeter_framer.lines_framed
+        return {
+            'bytes': self._ammeter_framer.bytes_received,
+            'lines': lines,
+            'pending_bytes': len(self._ammeter_framer),
+            'cpu_time': self._ammeter_read_cpu_time,
+            'cpu_per_line': self._ammeter_read_cpu_time / lines if lines > 0 else 0.0
+        }
+
+    def add_sample_listener(self, callback):
+        """ Register a callable that is passed each batch (list) of new samples from the receive thread.
+            Listeners run on the receive thread and should hand the samples off rather than process them inline.
+        """
+        self._ammeter_sample_listeners = self._ammeter_sample_listeners + [callback]
+
+    def remove_sample_listener(self, callback):
+        """ Remove a previously registered sample listener """
+        self._ammeter_sample_listeners = [x for x in self._ammeter_sample_listeners if x is not callback]
+
+    def _ammeter_dispatch_samples(self):
+        """ Pass the samples parsed since the last call to the sample listeners """
+        samples = self._ammeter_new_samples
+        if len(samples) == 0:
+            return
+        self._ammeter_new_samples = []
+        for listener in self._ammeter_sample_listeners:
+            try:
+                listener(samples)
+            except Exception as e:
+                self._logger.error('%s: Sample listener %s failed: %s', self._info_str, listener, e)
+
+    def add_state_listener(self, callback):
+        """ Register a callable that is passed (old_state, new_state) when the run state changes.  Listeners run on
+            the receive thread.
+        """
+        self._ammeter_state_listeners = self._ammeter_state_listeners + [callback]
+
+    def remove_state_listener(self, callback):
+        """ Remove a previously registered state listener """
+        self._ammeter_state_listeners = [x for x in self._ammeter_state_listeners if x is not callback]
+
+    def _ammeter_set_state(self, state:str):
+        """ Update the run state and notify the state listeners """
+        # the listeners get the samples received before the state change first, i.e. the last samples of a run
+        self._ammeter_dispatch_samples()
+        old_state = self.ammeter_run_state
+        if state == old_state:
+            return
+        self.ammeter_run_state = state
+        self._logger.info('%s: Run state %s -> %s', self._info_str, old_state, state)
+        for listener in self._ammeter_state_listeners:
+            try:
+                listener(old_state, state)
+            except Exception as e:
+                self._logger.error('%s: State listener %s failed: %s', self._info_str, listener, e)
+
+    def ammeter_wait_complete(self, timeout=None):
+        """ Wait for the current run to finish (STOP received) without sending any commands.  Returns True if the
+            run is complete, False if the timeout expired first.
+        """
+        return self._ammeter_stopped.wait(timeout)
+
+    def ammeter_command(self, command:str, response=None):
+        """ Send CMD:{command} to the ammeter and return a Future.  If response is set to a record type (i.e.
+            'STATUS') the receive thread completes the future with the parsed value of the next record of that type,
+            otherwise the future is completed once the command is written.  Commands can be pipelined, responses of
+            the same type complete the pending futures in order.
+        """
+        future = self._ammeter_expect(response) if response is not None else Future()
+        future.ammeter_sent = perf_counter()
+        self._ammeter_write(f'CMD:{command}\n'.encode())
+        if response is None:
+            future.set_result(None)
+        return future
+
+    def ammeter_pipeline(self, commands:list):
+        """ Send several commands in a single write, commands is a list of (command, response) as for
+            ammeter_command.  Returns the list of futures.
+        """
+        futures = []
+        for command, response in commands:
+            future = self._ammeter_expect(response) if response is not None else Future()
+            future.ammeter_sent = perf_counter()
+            futures.append(future)
+        self._ammeter_write(''.join(f'CMD:{command}\n' for command, _ in commands).encode())
+        for future, (_, response) in zip(futures, commands):
+            if response is None:
+                future.set_result(None)
+        return futures
+
+    def ammeter_attach_cache(self, cache, key:str):
+        """ Use a DeviceConfigCache entry for this device.  The entry is updated whenever a CONFIG record arrives """
+        self.ammeter_config_cache = cache
+        self._ammeter_cache_key = key
+
+    def ammeter_invalidate_config(self):
+        """ Drop the cached config of this device, i.e. after a command that changes it """
+        if self.ammeter_config_cache is not None:
+            self.ammeter_config_cache.invalidate(self._ammeter_cache_key)
+
+    def ammeter_session_request(self):
+        """ Send STATUS, and CONFIG unless it is cached, in one write - the requests of a session set up, so several
+            devices can be sent theirs before waiting on any.  Returns (cached config or None, status future, config
+            future or None)
+        """
+        config = None
+        if self.ammeter_config_cache is not None:
+            config = self.ammeter_config_cache.get(self._ammeter_cache_key)
+        if config is not None:
+            with self.ammeter_config_lock:
+                if not self.ammeter_config_data:
+                    self.ammeter_config_data = config
+            status_future, = self.ammeter_pipeline([('STATUS', 'STATUS')])
+            return config, status_future, None
+        status_future, config_future = self.ammeter_pipeline([('STATUS', 'STATUS'), ('CONFIG', 'CONFIG')])
+        return None, status_future, config_future
+
+    def _ammeter_expect(self, record_type:str):
+        """ Return a Future completed by the next record of the given type without sending a command """
+        future = Future()
+        with self._ammeter_pending_lock:
+            self._ammeter_pending[record_type].append(future)
+        return future
+
+    def _ammeter_cancel(self, future:Future):
+        """ Cancel a command future that timed out and drop it from the pending requests """
+        if future.cancel():
+            with self._ammeter_pending_lock:
+                for pending in self._ammeter_pending.values():
+                    if future in pending:
+                        pending.remove(future)
+
+    def _ammeter_complete(self, record_type:str, value):
+        """ Complete the oldest pending command waiting on the record type """
+        pending = self._ammeter_pending.get(record_type)
+        if not pending:
+            return
+        with self._ammeter_pending_lock:
+            while len(pending) > 0:
+                future = pending.popleft()
+                if future.set_running_or_notify_cancel():
+                    future.set_result(value)
+                    sent = getattr(future, 'ammeter_sent', None)
+                    if sent is not None:
+                        self._ammeter_command_rtt.observe(perf_counter() - sent)
+                    return
+
+    def _ammeter_process_lines(self, lines:list):
+        """ Process a batch of complete lines.  DATA lines take a fast path and each run of consecutive samples is
+            stored with a single lock acquisition, everything else goes through _ammeter_parse_read_line.
+        """
+        received = time()
+        samples = []
+        # checked once per batch so the per line debug call (and building _info_str) is skipped when not logged
+        debug = self._ammeter_debug_enabled()
+        for line in lines:
+            response = line.decode('utf-8', errors='replace').split(':')
+            if response[0] == 'DATA' and len(response) == 6:
+                if debug:
+                    self._logger.debug('%s: Received data: %s', self._info_str, response)
+                try:
+                    value = parse_data(response)
+                except ProtocolError as e:
+                    self._ammeter_bad_lines.inc()
+                    self._logger.error('%s: %s', self._info_str, e)
+                    continue
+                if self._ammeter_check_width(value):
+                    samples.append(Sample(received, *value))
+                continue
+            if len(samples) > 0:
+                # store the samples before a START/STOP changes the run
+                self._ammeter_store_samples(samples)
+                samples = []
+            if not self._ammeter_parse_read_line(response, debug):
+                self._ammeter_bad_lines.inc()
+        if len(samples) > 0:
+            self._ammeter_store_samples(samples)
+
+    def _ammeter_check_width(self, value:tuple):
+        """ Return True if the last_reads of a parsed DATA record match the width of the run, a record with a
+            different width can't be stored (or written to a binary capture) so it is dropped
+        """
+        width = self._ammeter_reads_width
+        if width is None:
+            self._ammeter_reads_width = len(value[3])
+            return True
+        if len(value[3]) == width:
+            return True
+        self._ammeter_bad_lines.inc()
+        self._logger.error('%s: DATA record has %i last_reads values, expected %i: %s', self._info_str, len(value[3]), width, value)
+        return False
+
+    def _ammeter_store_samples(self, samples:list):
+        """ Add parsed samples to the data table and queue them for the sample listeners """
+        wait_start = perf_counter()
+        with self.ammeter_data_lock:
+            self._ammeter_lock_wait.observe(perf_counter() - wait_start)
+            if self.ammeter_keep_samples:
+                self.ammeter_data.extend(samples)
+            self.ammeter_sample_count += len(samples)
+            if self.ammeter_last_sample is None:
+                self.ammeter_first_sample_time = samples[0].received
+            self.ammeter_last_sample = samples[-1]
+        self._ammeter_new_samples.extend(samples)
+        if self.ammeter_run_state == STATE_UNKNOWN:
+            # attached while a run was already in progress
+            self._ammeter_set_state(STATE_RUNNING)
+        if self._ammeter_pending['DATA']:
+            self._ammeter_complete('DATA', samples[0])
+
+    def _ammeter_parse_read_line(self, response:list, debug=True):
+        """ Take a split list of data recieved from the ammeter and match it to a record.  Returns False (after logging
+            the line) if the line is bad data.
+        """
+        if response == ['']:
+            # just remove any blank lines
+            return True
+        if debug:
+            self._logger.debug('%s: Received data: %s', self._info_str, response)
+        handler = self._ammeter_handlers.get(response[0])
+        if handler is None:
+            # the framer only returns complete lines, so anything unmatched is corrupt
+            self._logger.warning('%s: Bad data: %s', self._info_str, response)
+            return False
+        try:
+            value = PARSERS[response[0]](response)
+        except ProtocolError as e:
+            self._logger.error('%s: %s', self._info_str, e)
+            return False
+        handler(value)
+        if response[0] != 'DATA':
+            # DATA requests are completed when the sample is stored
+            self._ammeter_complete(response[0], value)
+        return True
+
+    def _ammeter_handle_data(self, value:tuple):
+        """ Store a received data point """
+        if self._ammeter_check_width(value):
+            self._ammeter_store_samples([Sample(time(), *value)])
+
+    def _ammeter_handle_start(self, reported:int):
+        """ Clear the data table and set the start time """
+        with self.ammeter_data_lock:
+            self.ammeter_data = SampleStore()
+            self.ammeter_sample_count = 0
+            self.ammeter_last_sample = None
+            self._ammeter_reads_width = None
+            self.ammeter_first_sample_time = None
+            self.ammeter_start_time = {
+                'reported': reported,
+                'local': time()
+            }
+            self.ammeter_stop_time = {}
+        self._ammeter_stopped.clear()
+        self._ammeter_set_state(STATE_RUNNING)
+
+    def _ammeter_handle_stop(self, reported:int):
+        """ Set the stop time """
+        with self.ammeter_data_lock:
+            stoptime = time()
+            self.ammeter_stop_time = {
+                'reported': reported,
+                'local': stoptime,
+                'runtime_reported': reported - self.ammeter_start_time.get('reported', reported),
+                'runtime_local': stoptime - self.ammeter_start_time.get('local', stoptime)
+            }
+        self._ammeter_set_state(STATE_READY)
+        self._ammeter_stopped.set()
+
+    def _ammeter_handle_config(self, config:dict):
+        """ Update the current config """
+        with self.ammeter_config_lock:
+            self.ammeter_config_data = config
+        if self.ammeter_config_cache is not None:
+            self.ammeter_config_cache.put(self._ammeter_cache_key, config)
+
+    def _ammeter_handle_status(self, status:dict):
+        """ Update the current status """
+        with self.ammeter_status_lock:
+            self.ammeter_status_data = status
+        ended = status['status'] != STATE_RUNNING and self.ammeter_run_state == STATE_RUNNING
+        self._ammeter_set_state(status['status'])
+        if ended:
+            # the run ended without a STOP being received
+            self._ammeter_stopped.set()
@@ -3,57 +3,80 @@ Class to open and read serial data from the Micropython ammeter
 """
 import serial
 import logging
-from time import sleep, time
-from threading import Thread, Lock
-from ast import literal_eval
+from threading import Thread, Event
+from time import perf_counter
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from .ammeter_core import AmmeterCore, COMMAND_TIMEOUT
 
+# serial read timeout used by the receive thread when the caller doesn't provide one (seconds)
+READ_TIMEOUT = 0.05
 
-class AmmeterRecvSerial(serial.Serial):
+
+class AmmeterRecvSerial(AmmeterCore, serial.Serial):
     """ Class to open and read serial data from the Micropython ammeter - overrides the py-serial class """
     def __init__(self, *args, **kwargs):
-        self._logger = kwargs.get('logger', logging)
-        kwargs.pop('logger')
-        super().__init__(*args, **kwargs)
-        self.ammeter_data = []
-        self.ammeter_partial_data = ''
-        self.ammeter_data_lock = Lock()
-        self.ammeter_config_lock = Lock()
-        self.ammeter_status_lock = Lock()
-        self.ammeter_config_data = {}
-        self.ammeter_status_data = {}
+        logger = kwargs.pop('logger', logging)
+        keep_samples = kwargs.pop('keep_samples', True)
+        # the receive thread blocks on the port, the timeout bounds how long a read waits for the first byte
+        kwargs.setdefault('timeout', READ_TIMEOUT)
+        serial.Serial.__init__(self, *args, **kwargs)
+        AmmeterCore.__init__(self, logger=logger, keep_samples=keep_samples)
+        self.ammeter_metrics.labels = {'port': self.port}
+        self._ammeter_closing = Event()
         self._ammeter_recv_thread = Thread(target=self._ammeter_read, daemon=True)
         self._ammeter_recv_thread.start()
 
     @property
     def _info_str(self):
-        """ Returns a string identifying the class for logging purposes """
-        return f"{self.__class__.__name__}: {self.port}: {self.baudrate}: {self.bytesize}{self.parity}{self.stopbits}"
+        """ Returns a string identifying the class for logging purposes, built once per port configuration """
+        info_str = getattr(self, '_ammeter_info_str', None)
+        if info_str is None:
+            info_str = self._ammeter_info_str = f"{self.__class__.__name__}: {self.port}: {self.baudrate}: {self.bytesize}{self.parity}{self.stopbits}"
+        return info_str
+
+    def _reconfigure_port(self, *args, **kwargs):
+        """ Rebuild the cached identity string when the port settings change """
+        self._ammeter_info_str = None
+        super()._reconfigure_port(*args, **kwargs)
 
     def ammeter_report(self, wait=5):
         """ Returns the data table collected if the ammeter collection is complete, waits up to the specified time """
-        cancel_time = time() + wait
-        while time() < cancel_time:
-            if self.ammeter_stop_time != {}:
-                with self.ammeter_data_lock:
-                    return {
-                        'start': self.ammeter_start_time,
-                        'stop': self.ammeter_stop_time,
-                        'data': self.ammeter_data
-                    }
+        if self._ammeter_stopped.wait(wait):
+            with self.ammeter_data_lock:
+                return {
+                    'start': self.ammeter_start_time,
+                    'stop': self.ammeter_stop_time,
+                    'data': self.ammeter_data
+                }
         return None
 
+    def ammeter_wait(self, future:Future, default=None, timeout=COMMAND_TIMEOUT):
+        """ Wait for a command future, returns the default and drops the pending request if it times out """
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self._ammeter_cancel(future)
+            return default
+
+    def ammeter_session(self, cache=None, timeout=COMMAND_TIMEOUT):
+        """ Set up a session with one pipelined exchange - STATUS and CONFIG are sent in a single write and both
+            responses share one timeout.  If a DeviceConfigCache is given the config is taken from it when the
+            entry for this port and device is present (only STATUS is sent) and is kept up to date from then on.
+            Returns {'status', 'config', 'cached', 'seconds'}, with {} for a response that didn't arrive.
+        """
+        start = perf_counter()
+        if cache is not None:
+            self.ammeter_attach_cache(cache, cache.key(self.port))
+        config, status_future, config_future = self.ammeter_session_request()
+        status = self.ammeter_wait(status_future, {}, timeout)
+        if config_future is not None:
+            config = self.ammeter_wait(config_future, {}, max(0.0, start + timeout - perf_counter()))
+        return {'status': status, 'config': config, 'cached': config_future is None, 'seconds': perf_counter() - start}
+
     @property
     def ammeter_status(self):
         """ Get the current status of the ammeter """
-        with self.ammeter_status_lock:
-            self.ammeter_status_data == {}
-        self.write('CMD:STATUS\n'.encode())
-        endtime = time() + 3
-        while time() < endtime:
-            with self.ammeter_status_lock:
-                if self.ammeter_status_data != {}:
-                    return self.ammeter_status_data
-        return {}
+        return self.ammeter_wait(self.ammeter_command('STATUS', 'STATUS'), {})
 
     @property
     def ammeter_initialized(self):
@@ -83,16 +106,7 @@ class AmmeterRecvSerial(serial.Serial):
         """ Return the current configuration of the ammeter 
             Expecting: CONFIG:{interval}:{timeout}:{pin}:{name}:{baseline}[:{pin}:{name}:{baseline}...]
         """
-        with self.ammeter_config_lock:
-            self.ammeter_config_data = {}
-        self.write('CMD:CONFIG\n'.encode())
-        endtime = time() + 3
-        while time() < endtime:
-            with self.ammeter_config_lock:
-                if self.ammeter_config_data != {}:
-                    return self.ammeter_config_data
-            sleep(.25)
-        return {}
+        return self.ammeter_wait(self.ammeter_command('CONFIG', 'CONFIG'), {})
 
     @property
     def ammeter_interval(self):
@@ -103,155 +117,64 @@ class AmmeterRecvSerial(serial.Serial):
     @ammeter_interval.setter
     def ammeter_interval(self, value:int):
         """ Update the sampling interval """
-        self.write(f'CMD:INTERVAL:{int(value)}\n'.encode())
-        sleep(.2)
+        # the CONFIG request is answered after the INTERVAL command is processed
+        self.ammeter_invalidate_config()
+        self.ammeter_command(f'INTERVAL:{int(value)}')
         if self.ammeter_interval == value:
             return True
         return False
 
     def ammeter_init(self):
         """ Initialize the ammeter """
-        self.write('CMD:INIT\n'.encode())
+        # the baselines in the config change
+        self.ammeter_invalidate_config()
+        self.ammeter_command('INIT')
 
     def ammeter_start(self, timeout=None):
-        """ Start the sampling """
-        self.write((f"CMD:START{(':' + str(timeout)) if timeout is not None else ''}" + '\n').encode())
-        stop_time = time() + 3
-        while time() < stop_time:
-            if self.ammeter_running:
-                return True
-            sleep(.25)
-        return False
+        """ Start the sampling, returns as soon as the ammeter sends START """
+        started = self.ammeter_command(f"START{(':' + str(timeout)) if timeout is not None else ''}", 'START')
+        if self.ammeter_wait(started) is not None:
+            return True
+        # no START received, the ammeter may already be running
+        return self.ammeter_running
 
     def ammeter_stop(self):
-        """ Stop the sampling if currently running """
-        self.write('CMD:STOP\n'.encode())
-        stop_time = time() + 3
-        while time() < stop_time:
-            if not self.ammeter_running:
-                return True
-            sleep(.25)
-        return False
+        """ Stop the sampling if currently running, returns as soon as the ammeter sends STOP """
+        stopped = self.ammeter_command('STOP', 'STOP')
+        if self.ammeter_wait(stopped) is not None:
+            return True
+        # no STOP received, the ammeter may not have been running
+        return not self.ammeter_running
 
     @property
     def ammeter_current(self):
-        """ Read one value and return """
+        """ Read one value and return the sample (None if the ammeter is running or doesn't respond) """
         if not self.ammeter_running:
-            self.write('CMD:ONE\n'.encode())
-            self._ammeter_read()
+            return self.ammeter_wait(self.ammeter_command('ONE', 'DATA'))
+        return None
+
+    def _ammeter_write(self, data:bytes):
+        """ Send data to the ammeter """
+        self.write(data)
 
+    def close(self):
+        """ Stop the receive thread and close the port """
+        recv_thread = getattr(self, '_ammeter_recv_thread', None)
+        if recv_thread is not None and recv_thread.is_alive():
+            self._ammeter_closing.set()
+            self.cancel_read()
+            recv_thread.join()
+        super().close()
 
     def _ammeter_read(self):
-        """ Read any data waiting in the queue, if wait_for_response, wait until a non-data response is received """
+        """ Read data from the serial port as it arrives and process each complete line """
         self._logger.info('%s: Starting backgroup ammeter read.', self._info_str)
-        while True:
-            with self.ammeter_data_lock:
-                self.ammeter_partial_data += self.read(self.in_waiting).decode('utf-8')
-            ammeter_temp_data = self.ammeter_partial_data.split('\n')
-            while len(ammeter_temp_data) != 0:
-                if self._ammeter_parse_read_line(ammeter_temp_data[0].split(':')):
-                    with self.ammeter_data_lock:
-                        ammeter_temp_data.pop(0)
-                        self.ammeter_partial_data = '\n'.join(ammeter_temp_data)
-                else:
-                    # didn't find a complete line, if there are other lines then it must be corrupt
-                    if len(ammeter_temp_data) > 1:
-                        self._logger.warning('%s: Bad data: %s', self._info_str, ammeter_temp_data[0])
-                        ammeter_temp_data.pop(0)
-                        self.ammeter_partial_data = '\n'.join(ammeter_temp_data)
-                    else:
-                        # otherwise break out of the loop to wait for more data
-                        with self.ammeter_data_lock:
-                            self.ammeter_partial_data = '\n'.join(ammeter_temp_data)
-                        break
-            sleep(.1)
-
-
-    def _ammeter_parse_read_line(self, response:list):
-        """ Take a split list of data recieved from the ammeter and match it to a record """
-        if response == ['']:
-            # just remove any blank lines
-            return True
-        self._logger.debug('%s: Received data: %s', self._info_str, response)
-        # if received a data point, log it to the array
-        if response[0] == 'DATA':
-            if len(response) == 6:
-                with self.ammeter_data_lock:
-                    self.ammeter_data.append({
-                        'received': time(),
-                        'name': response[1],
-                        'ticks': int(response[2]),
-                        'current_amps': float(response[3]),
-                        'last_reads': literal_eval(response[4]),
-                        'average': float(response[5])
-                    })
-                return True
-            else:
-                self._logger.error('%s: Invalid number of fields in DATA Transmission.  Received %i, expected 6', self._info_str, len(response))
-        # if received a start response, udpate the start or end time
-        if response[0] == 'START':
-            if len(response) == 2:
-                with self.ammeter_data_lock:
-                    # clear the data table and set the start time
-                    self.ammeter_data = []
-                    starttime = time()
-                    self.ammeter_start_time = {
-                        'reported': int(response[1]),
-                        'local': starttime
-                    }
-                    self.ammeter_stop_time = {}
-                return True
-            else:
-                self._logger.error('%s: Invalid number of fields in START Transmission.  Received %i, expected 2', self._info_str, len(response))
-        # if received a stop response, udpate the start or end time
-        if response[0] == 'STOP':
-            if len(response) == 2:
-                with self.ammeter_data_lock:
-                    # clear the data table and set the start time
-                    stoptime = time()
-                    self.ammeter_stop_time = {
-                        'reported': int(response[1]),
-                        'local': stoptime,
-                        'runtime_reported': int(response[1]) - self.ammeter_start_time['reported'],
-                        'runtime_local': stoptime - self.ammeter_start_time['local']
-                    }
-                return True
-            else:
-                self._logger.error('%s: Invalid number of fields in START Transmission.  Received %i, expected 2', self._info_str, len(response))
-        # if received a config repsonse, update the current config
-        if response[0] == 'CONFIG':
-            if len(response) >= 7:
-                with self.ammeter_config_lock:
-                    self.ammeter_config_data = {
-                        'interval': int(response[1]),
-                        'timeout': int(response[2]),
-                        'init_timeout': int(response[3]),
-                        'pins': [
-                            {
-                                'pin': int(response[4]),
-                                'name': response[5],
-                                'baseline': int(response[6])
-                            }
-                        ]
-                    }
-                    if len(response) > 7 and (len(response) - 7) % 3 == 0:
-                        for x in range(6, len(response), 3):
-                            self.ammeter_config_data['pins'].append({})
-                return True
-            else:
-                self._logger.error('%s: Invalid number of fields in CONFIG Transmission.  Received %i, expected >=6', self._info_str, len(response))
-        # if received a status response, update the current status
-        if response[0] == 'STATUS':
-            if len(response) >= 2:
-                with self.ammeter_status_lock:
-                    self.ammeter_status_data = {
-                        'status': response[1],
-                        'timeout': response[2] if response[1] == 'INITIALIZING' or response[1] == 'RUNNING' else 0,
-                        'noinit_pin': response[2] if response[1] == 'NOINIT' else None
-                    }
-                return True
-            else:
-                self._logger.error('%s: Invalid number of fields in STATUS Transmission.  Received %i, expected >=2', self._info_str, len(response))
-
-        # didn't find a match, might not be a complete line
-        return False
+        while not self._ammeter_closing.is_set():
+            # block until at least one byte arrives (or the read timeout expires), then take everything waiting
+            try:
+                data = self.read(max(1, self.in_waiting))
+            except serial.SerialException as e:
+                self._logger.error('%s: Error reading from the ammeter, stopping receive: %s', self._info_str, e)
+                return
+            if data:
+                self._ammeter_feed(data)
@@ -0,0 +1,464 @@
+"""
+Offline analysis of saved captures - per run summaries and cross run comparisons computed on a pool of worker
+processes, and replay of a capture through the receive pipeline
+
+    python3 -m ammeter_logger analyze CAPTURE_FILE [CAPTURE_FILE ...] [--field {current_amps,average}] [--workers WORKERS] [--baseline CAPTURE_FILE] [--cache CACHE_FILE] [--no-cache] [--json JSON_FILE]
+    python3 -m ammeter_logger replay CAPTURE_FILE [CAPTURE_FILE ...] [--speed SPEED] [--no-check]
+
+Capture files are binary captures or CSV files written by the logger (single or multiple device), a directory is
+scanned for *.csv and *.bin captures.
+"""
+import os
+import csv
+import json
+import logging
+import argparse
+from array import array
+from itertools import islice
+from threading import Lock
+from time import perf_counter, sleep
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .ammeter_core import AmmeterCore
+from .binary_capture import BinaryCaptureReader, MAGIC
+from .device_cache import default_cache_file
+from .export import iter_chunks
+from .stats import ChannelStats
+
+ANALYSIS_COMMANDS = ('analyze', 'replay')
+# rows read from a CSV capture at a time
+CHUNK_ROWS = 65536
+# lines fed to the receiver per read during a replay, about what the serial thread sees at high sample rates
+REPLAY_BATCH = 64
+# stored with each cached summary, summaries from an older version are recomputed
+SUMMARY_VERSION = 2
+SUMMARY_QUANTILES = (0.5, 0.9, 0.99)
+
+
+def is_binary_capture(file_name:str):
+    """ Return True if the file is a binary capture """
+    with open(file_name, 'rb') as input_file:
+        return input_file.read(len(MAGIC)) == MAGIC
+
+
+def is_capture_file(file_name:str):
+    """ Return True if the file is a binary capture or a CSV file with the capture columns (not i.e. the level
+        files written with --pyramid)
+    """
+    try:
+        if is_binary_capture(file_name):
+            return True
+        with open(file_name, 'r', encoding='utf-8', newline='') as input_file:
+            header = next(csv.reader(input_file), [])
+    except (OSError, UnicodeDecodeError, csv.Error):
+        return False
+    return all(column in header for column in ('received_epoch', 'name', 'ticks', 'latest', 'average'))
+
+
+def find_captures(paths:list):
+    """ Return the capture files for a list of files and directories.  Directories are scanned for *.csv and *.bin
+        files that are captures, files given by name are always returned.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = (os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(('.csv', '.bin')))
+            files.extend(file_name for file_name in candidates if os.path.isfile(file_name) and is_capture_file(file_name))
+        else:
+            files.append(path)
+    return files
+
+
+def _csv_chunks(file_name:str, chunk_rows:int, last_reads:bool):
+    """ Yield (names, chunk) from a CSV capture, see iter_capture_chunks """
+    with open(file_name, 'r', encoding='utf-8', newline='') as input_file:
+        reader = csv.reader(input_file)
+        header = next(reader, None)
+        if header is None:
+            return
+        try:
+            device = header.index('device') if header[0] == 'device' else None
+            received, name, ticks = header.index('received_epoch'), header.index('name'), header.index('ticks')
+            latest, average = header.index('latest'), header.index('average')
+        except ValueError:
+            raise ValueError(f'{file_name} is not an ammeter capture') from None
+        reads = [x for x, column in enumerate(header) if column.startswith('read_')] if last_reads else []
+        names, name_index = [], {}
+        while True:
+            rows = list(islice(reader, chunk_rows))
+            if len(rows) == 0:
+                return
+            columns = {column: array(typecode) for column, typecode in (('received', 'd'), ('ticks', 'q'), ('current_amps', 'd'), ('average', 'd'))}
+            indexes, reads_column = array('H'), array('d')
+            skipped = 0
+            for row in rows:
+                # a short or unparsable row (i.e. the last row of a streamed capture that was interrupted) is skipped
+                try:
+                    channel = row[name] if device is None else f'{row[device]}/{row[name]}'
+                    values = float(row[received]), int(row[ticks]), float(row[latest]), float(row[average])
+                    row_reads = [float(row[x]) for x in reads]
+                except (IndexError, ValueError):
+                    skipped += 1
+                    continue
+                index = name_index.get(channel)
+                if index is None:
+                    index = name_index[channel] = len(names)
+                    names.append(channel)
+                indexes.append(index)
+                columns['received'].append(values[0])
+                columns['ticks'].append(values[1])
+                columns['current_amps'].append(values[2])
+                columns['average'].append(values[3])
+                reads_column.extend(row_reads)
+            yield names, {'columns': columns, 'last_reads': reads_column, 'names': indexes, 'width': len(reads), 'skipped': skipped}
+
+
+def iter_capture_chunks(file_name:str, chunk_rows=CHUNK_ROWS, last_reads=True):
+    """ Yield (names, chunk) for a binary or CSV capture file, a block (binary) or chunk_rows rows (CSV) at a time so
+        the file is never loaded whole.  chunk is in the export.iter_chunks format - {'columns': {column: array},
+        'last_reads': flat array, 'names': array of indexes into names, 'width'}, CSV chunks also have the number of
+        'skipped' rows that were short or unparsable.  Set last_reads=False to skip parsing the last_reads of a CSV
+        capture (width is 0).
+    """
+    if is_binary_capture(file_name):
+        with BinaryCaptureReader(file_name) as capture:
+            for chunk in iter_chunks(capture):
+                yield capture.names, chunk
+        return
+    yield from _csv_chunks(file_name, chunk_rows, last_reads)
+
+
+def summarize_capture(file_name:str, field='current_amps', chunk_rows=CHUNK_ROWS):
+    """ Return the summary of one capture file - {'file', 'rows', 'skipped_rows', 'first_received', 'last_received', 'seconds',
+        'channels': {channel: {'count', 'mean', 'stddev', 'min', 'max', 'p50', 'p90', 'p99', 'amp_hours',
+        'duration_ms'}}}.  Runs in the worker processes.
+    """
+    start = perf_counter()
+    channels = {}
+    rows, skipped, first_received, last_received = 0, 0, None, None
+    for names, chunk in iter_capture_chunks(file_name, chunk_rows, last_reads=False):
+        skipped += chunk.get('skipped', 0)
+        columns = chunk['columns']
+        if len(columns['received']) == 0:
+            continue
+        stats = [channels.get(name) for name in names]
+        for x, name in enumerate(names):
+            if stats[x] is None:
+                stats[x] = channels[name] = ChannelStats(SUMMARY_QUANTILES, tumbling_ms=0, sliding_ms=0)
+        for index, ticks, value in zip(chunk['names'], columns['ticks'], columns[field]):
+            stats[index].add(ticks, value)
+        rows += len(columns['received'])
+        first_received = columns['received'][0] if first_received is None else first_received
+        last_received = columns['received'][-1]
+    summary = {}
+    for name, stats in channels.items():
+        snapshot = stats.snapshot()
+        summary[name] = {key: snapshot[key] for key in ('count', 'mean', 'stddev', 'min', 'max', 'amp_hours', 'duration_ms')}
+        summary[name].update({f'p{int(q * 100)}': value for q, value in snapshot['quantiles'].items()})
+    return {'file': file_name, 'rows': rows, 'skipped_rows': skipped, 'first_received': first_received,
+            'last_received': last_received, 'seconds': perf_counter() - start, 'channels': summary}
+
+
+class AnalysisCache:
+    """ JSON file of capture summaries keyed on the absolute path of the capture.  An entry is only used while the
+        file's mtime and size are unchanged (and it was computed for the same field), so re-running an analysis
+        only processes new or changed captures.  Call save() to write the file once the results are stored.
+    """
+    def __init__(self, file_name=None, logger=None):
+        self.file_name = file_name if file_name is not None else default_cache_file('analysis_cache.json')
+        self._logger = logger if logger is not None else logging.getLogger(__name__)
+        self._lock = Lock()
+        self._entries = None
+        self._changed = False
+
+    def _load(self):
+        """ Read the cache file once """
+        if self._entries is None:
+            try:
+                with open(self.file_name, 'r', encoding='utf-8') as cache_file:
+                    self._entries = json.load(cache_file)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    @staticmethod
+    def _identity(file_name:str, field:str):
+        """ Return the values an entry must match to be used """
+        info = os.stat(file_name)
+        return {'mtime_ns': info.st_mtime_ns, 'size': info.st_size, 'field': field, 'version': SUMMARY_VERSION}
+
+    def get(self, file_name:str, field='current_amps'):
+        """ Return the cached summary of a capture, None if not cached or the file changed """
+        identity = self._identity(file_name, field)
+        with self._lock:
+            entry = self._load().get(os.path.abspath(file_name))
+        if entry is None or any(entry.get(key) != value for key, value in identity.items()):
+            return None
+        return dict(entry['summary'], file=file_name)
+
+    def put(self, file_name:str, summary:dict, field='current_amps'):
+        """ Store the summary of a capture """
+        entry = dict(self._identity(file_name, field), summary=summary)
+        with self._lock:
+            self._load()[os.path.abspath(file_name)] = entry
+            self._changed = True
+
+    def invalidate(self, file_name=None):
+        """ Drop the entry for a capture, or every entry """
+        with self._lock:
+            entries = self._load()
+            if file_name is None:
+                entries.clear()
+            else:
+                entries.pop(os.path.abspath(file_name), None)
+            self._changed = True
+
+    def save(self):
+        """ Write the cache file (replaced atomically) if anything changed """
+        with self._lock:
+            if not self._changed:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+                temp_file = f'{self.file_name}.tmp'
+                with open(temp_file, 'w', encoding='utf-8') as cache_file:
+                    json.dump(self._entries, cache_file)
+                os.replace(temp_file, self.file_name)
+                self._changed = False
+            except OSError as e:
+                self._logger.warning('%s: Unable to write %s: %s', self.__class__.__name__, self.file_name, e)
+
+
+def analyze_captures(files:list, field='current_amps', workers=None, cache=None, logger=None):
+    """ Summarize the capture files, the files not in the cache are processed on a pool of worker processes (in
+        this process if there is only one to do).  Returns the summaries in the order of files, each with 'cached'
+        set, or {'file', 'error'} for a file that couldn't be read.
+    """
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    results = {}
+    todo = []
+    for file_name in files:
+        summary = cache.get(file_name, field) if cache is not None and os.path.isfile(file_name) else None
+        if summary is not None:
+            results[file_name] = dict(summary, cached=True)
+        else:
+            todo.append(file_name)
+
+    def _store(file_name:str, get_summary):
+        """ Store the result for a file, errors are reported per file """
+        try:
+            summary = get_summary()
+        except (OSError, ValueError) as e:
+            logger.error('Unable to analyze %s: %s', file_name, e)
+            results[file_name] = {'file': file_name, 'error': str(e)}
+            return
+        if cache is not None:
+            cache.put(file_name, summary, field)
+        results[file_name] = dict(summary, cached=False)
+
+    workers = workers if workers is not None else os.cpu_count() or 1
+    try:
+        if len(todo) > 1 and workers > 1:
+            with ProcessPoolExecutor(min(workers, len(todo))) as pool:
+                futures = {pool.submit(summarize_capture, file_name, field): file_name for file_name in todo}
+                for future in as_completed(futures):
+                    _store(futures[future], future.result)
+        else:
+            for file_name in todo:
+                _store(file_name, lambda: summarize_capture(file_name, field))
+    finally:
+        if cache is not None:
+            cache.save()
+    return [results[file_name] for file_name in files]
+
+
+def _change(value, baseline):
+    """ Return the fractional change of value from baseline, None if it can't be computed """
+    if value is None or baseline is None or baseline == 0:
+        return None
+    return (value - baseline) / abs(baseline)
+
+
+def compare_runs(summaries:list, baseline=0):
+    """ Return one row per run and channel - {'file', 'channel', 'count', 'mean', 'p99', 'max', 'amp_hours',
+        'duration_s'} with the change of mean, p99 and max from the same channel of the baseline run (the index
+        into summaries) as 'mean_change', 'p99_change' and 'max_change'
+    """
+    reference = summaries[baseline].get('channels', {}) if len(summaries) > 0 else {}
+    rows = []
+    for summary in summaries:
+        for channel, stats in summary.get('channels', {}).items():
+            base = reference.get(channel, {})
+            rows.append({
+                'file': summary['file'],
+                'channel': channel,
+                'count': stats['count'],
+                'mean': stats['mean'],
+                'p99': stats['p99'],
+                'max': stats['max'],
+                'amp_hours': stats['amp_hours'],
+                'duration_s': stats['duration_ms'] / 1000,
+                'mean_change': _change(stats['mean'], base.get('mean')),
+                'p99_change': _change(stats['p99'], base.get('p99')),
+                'max_change': _change(stats['max'], base.get('max'))
+            })
+    return rows
+
+
+def format_comparison(rows:list):
+    """ Return a printable table of compare_runs rows """
+    def _percent(value):
+        return f'{value * 100:+.1f}%' if value is not None else '-'
+    width = max([len(os.path.basename(row['file'])) for row in rows] + [4])
+    lines = [f"{'file':<{width}}  {'channel':<12} {'samples':>10} {'mean A':>9} {'p99 A':>9} {'max A':>9} {'Ah':>10} "
+             f"{'secs':>8} {'mean':>8} {'p99':>8} {'max':>8}"]
+    for row in rows:
+        lines.append(f"{os.path.basename(row['file']):<{width}}  {row['channel']:<12} {row['count']:>10} "
+                     f"{row['mean']:>9.4f} {row['p99']:>9.4f} {row['max']:>9.4f} {row['amp_hours']:>10.6f} "
+                     f"{row['duration_s']:>8.1f} {_percent(row['mean_change']):>8} {_percent(row['p99_change']):>8} "
+                     f"{_percent(row['max_change']):>8}")
+    return '\n'.join(lines)
+
+
+class ReplayAmmeter(AmmeterCore):
+    """ Receiver without a transport, fed the lines of a recorded capture.  Commands are dropped. """
+    def __init__(self, file_name:str, logger=None, keep_samples=False):
+        super().__init__(logger=logger, keep_samples=keep_samples)
+        self.file_name = file_name
+
+    @property
+    def _info_str(self):
+        """ Returns a string identifying the class for logging purposes """
+        return f'{self.__class__.__name__}: {self.file_name}'
+
+    def _ammeter_write(self, data:bytes):
+        """ Nothing to send to during a replay """
+        self._logger.debug('%s: Dropped command %s', self._info_str, data)
+
+    def ammeter_replay(self, lines:list):
+        """ Feed a batch of lines (str, without the newline) through the receive pipeline """
+        self._ammeter_feed(('\n'.join(lines) + '\n').encode())
+
+
+def capture_lines(names:list, chunk:dict):
+    """ Return the DATA lines the ammeter sent for a chunk of a capture """
+    columns, width = chunk['columns'], chunk['width']
+    reads = chunk['last_reads'].tolist()
+    return [f'DATA:{names[index]}:{ticks}:{current!r}:{reads[x * width:(x + 1) * width]!r}:{average!r}'
+            for x, (index, ticks, current, average) in enumerate(zip(chunk['names'], columns['ticks'], columns['current_amps'], columns['average']))]
+
+
+def _mismatches(names:list, chunk:dict, samples:list):
+    """ Return the number of replayed samples that differ from the recorded ones (or are missing) """
+    columns, width = chunk['columns'], chunk['width']
+    reads = chunk['last_reads'].tolist()
+    recorded = [(names[index], ticks, current, reads[x * width:(x + 1) * width], average)
+                for x, (index, ticks, current, average) in enumerate(zip(chunk['names'], columns['ticks'], columns['current_amps'], columns['average']))]
+    replayed = [(sample.name, sample.ticks, sample.current_amps, sample.last_reads, sample.average) for sample in samples]
+    return sum(1 for expected, actual in zip(recorded, replayed) if expected != actual) + abs(len(recorded) - len(replayed))
+
+
+def replay_capture(file_name:str, speed=0.0, check=True, listeners=None, logger=None, chunk_rows=CHUNK_ROWS):
+    """ Replay a capture through the receive pipeline (framing, parsing and the sample listeners) as START, the DATA
+        lines and STOP.  speed is the multiple of the recorded rate by device ticks, 0 for as fast as possible.  With
+        check each replayed sample is compared with the recorded one.  Returns {'rows', 'replayed', 'mismatches',
+        'bad_lines', 'seconds', 'lines_per_sec', 'capture_seconds', 'speedup'}
+    """
+    device = ReplayAmmeter(file_name, logger=logger)
+    for listener in listeners if listeners is not None else []:
+        device.add_sample_listener(listener)
+    replayed = []
+    if check:
+        device.add_sample_listener(replayed.extend)
+    rows, mismatches, first_ticks, last_ticks = 0, 0, None, None
+    start = perf_counter()
+    for names, chunk in iter_capture_chunks(file_name, chunk_rows):
+        ticks = chunk['columns']['ticks']
+        if len(ticks) == 0:
+            continue
+        if first_ticks is None:
+            first_ticks = ticks[0]
+            device.ammeter_replay([f'START:{first_ticks}'])
+        lines = capture_lines(names, chunk)
+        for x in range(0, len(lines), REPLAY_BATCH):
+            if speed > 0:
+                delay = start + (ticks[x] - first_ticks) / 1000 / speed - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            device.ammeter_replay(lines[x:x + REPLAY_BATCH])
+        if check:
+            mismatches += _mismatches(names, chunk, replayed)
+            replayed.clear()
+        rows += len(ticks)
+        last_ticks = max(ticks[-1], last_ticks if last_ticks is not None else ticks[-1])
+    if first_ticks is not None:
+        device.ammeter_replay([f'STOP:{last_ticks}'])
+    elapsed = perf_counter() - start
+    capture_seconds = (last_ticks - first_ticks) / 1000 if first_ticks is not None else 0.0
+    return {
+        'rows': rows,
+        'replayed': device.ammeter_sample_count,
+        'mismatches': mismatches if check else None,
+        'bad_lines': device.ammeter_metrics['ammeter_bad_lines_total'].value,
+        'seconds': elapsed,
+        'lines_per_sec': rows / elapsed if elapsed > 0 else 0.0,
+        'capture_seconds': capture_seconds,
+        'speedup': capture_seconds / elapsed if elapsed > 0 else 0.0
+    }
+
+
+def main(argv=None):
+    """ Run the analyze or replay command, returns the exit code """
+    parser = argparse.ArgumentParser(prog='ammeter_logger', description="Analyze or replay saved ammeter captures")
+    commands = parser.add_subparsers(dest='command', required=True)
+    analyze = commands.add_parser('analyze', help='Summarize captures in parallel and compare the runs')
+    analyze.add_argument('files', metavar='CAPTURE_FILE', nargs='+', help='Capture files (binary or CSV) or directories of captures')
+    analyze.add_argument('--field', dest='field', required=False, choices=['current_amps', 'average'], default='current_amps', help='(current_amps) Value to summarize')
+    analyze.add_argument('--workers', dest='workers', required=False, type=int, default=None, help='Number of worker processes (default the number of CPUs)')
+    analyze.add_argument('--baseline', dest='baseline', required=False, default=None, help='Capture file the other runs are compared to (default the first)')
+    analyze.add_argument('--cache', dest='cache', required=False, default=None, help='Summary cache file (default ~/.cache/ammeter_logger/analysis_cache.json)')
+    analyze.add_argument('--no-cache', dest='no_cache', required=False, action='store_true', default=False, help='Process every capture, ignoring and not updating the cache')
+    analyze.add_argument('--json', dest='json', required=False, default=None, help='Also write the summaries and comparison to a JSON file')
+    replay = commands.add_parser('replay', help='Replay captures through the receive pipeline')
+    replay.add_argument('files', metavar='CAPTURE_FILE', nargs='+', help='Capture files (binary or CSV) or directories of captures')
+    replay.add_argument('--speed', dest='speed', required=False, type=float, default=0.0, help='(0) Multiple of the recorded rate, 0 for as fast as possible')
+    replay.add_argument('--no-check', dest='no_check', required=False, action='store_true', default=False, help="Don't compare the replayed samples with the recorded ones")
+    args = vars(parser.parse_args(argv))
+
+    files = find_captures(args['files'])
+    if args['command'] == 'replay':
+        failed = False
+        for file_name in files:
+            try:
+                result = replay_capture(file_name, speed=args['speed'], check=not args['no_check'])
+            except (OSError, ValueError) as e:
+                print(f"Unable to replay {file_name}: {e}")
+                failed = True
+                continue
+            check = f", {result['mismatches']} mismatched" if result['mismatches'] is not None else ''
+            print(f"{file_name}: replayed {result['replayed']} of {result['rows']} samples in {result['seconds']:.2f} s "
+                  f"({result['lines_per_sec']:,.0f} lines/sec, {result['speedup']:,.1f}x real time), "
+                  f"{result['bad_lines']} bad lines{check}")
+            failed = failed or result['replayed'] != result['rows'] or result['bad_lines'] > 0 or bool(result['mismatches'])
+        return 1 if failed else 0
+
+    start = perf_counter()
+    if args['baseline'] is not None and args['baseline'] not in files:
+        files.insert(0, args['baseline'])
+    cache = AnalysisCache(args['cache']) if not args['no_cache'] else None
+    summaries = analyze_captures(files, field=args['field'], workers=args['workers'], cache=cache)
+    valid = [summary for summary in summaries if 'error' not in summary]
+    baseline = files.index(args['baseline']) if args['baseline'] is not None else 0
+    baseline = valid.index(summaries[baseline]) if summaries[baseline] in valid else 0
+    rows = compare_runs(valid, baseline)
+    if len(rows) > 0:
+        print(format_comparison(rows))
+    cached = sum(1 for summary in valid if summary['cached'])
+    for summary in valid:
+        if summary['skipped_rows'] > 0:
+            print(f"{summary['file']}: skipped {summary['skipped_rows']} short or unparsable rows")
+    print(f"Analyzed {len(files)} captures ({cached} from the cache, {len(summaries) - len(valid)} failed) in "
+          f"{perf_counter() - start:.2f} s.  Changes are relative to {valid[baseline]['file'] if len(valid) > 0 else '-'}")
+    if args['json'] is not None:
+        with open(args['json'], 'w', encoding='utf-8') as output_file:
+            json.dump({'summaries': summaries, 'comparison': rows}, output_file, indent=2)
+    return 1 if len(valid) < len(summaries) else 0
@@ -0,0 +1,227 @@
+"""
+asyncio receiver for the Micropython ammeter - drives any number of ports from a single event loop
+"""
+import asyncio
+import serial
+from collections import deque
+from .ammeter_core import AmmeterCore, COMMAND_TIMEOUT
+
+
+class AsyncSampleIterator:
+    """ Async iterator of the samples received by an AsyncAmmeterRecv.  If maxsize is set and the consumer falls
+        more than maxsize batches behind, the oldest batches are dropped (counted in dropped_batches).
+    """
+    def __init__(self, receiver, maxsize=0):
+        self._receiver = receiver
+        self._queue = asyncio.Queue()
+        self._maxsize = maxsize
+        self._pending = deque()
+        self.dropped_batches = 0
+        receiver.add_sample_listener(self._on_samples)
+
+    def _on_samples(self, samples:list):
+        """ Sample listener, runs on the event loop thread """
+        if self._maxsize > 0 and self._queue.qsize() >= self._maxsize:
+            self._queue.get_nowait()
+            self.dropped_batches += 1
+        self._queue.put_nowait(samples)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while len(self._pending) == 0:
+            batch = await self._queue.get()
+            if batch is None:
+                raise StopAsyncIteration
+            self._pending.extend(batch)
+        return self._pending.popleft()
+
+    def close(self):
+        """ Stop receiving samples, iteration ends once the queued samples are consumed """
+        self._receiver.remove_sample_listener(self._on_samples)
+        self._queue.put_nowait(None)
+
+
+class AsyncAmmeterRecv(AmmeterCore):
+    """ asyncio version of AmmeterRecvSerial.  The port is opened non-blocking and registered with the event loop,
+        so no thread is started per port.  Uses loop.add_reader (POSIX).
+
+        async with AsyncAmmeterRecv('/dev/ttyUSB0') as ammeter:
+            print(await ammeter.status())
+            await ammeter.start()
+            async for sample in ammeter.samples():
+                ...
+    """
+    def __init__(self, port:str, baudrate=115200, logger=None, keep_samples=True, **serial_kwargs):
+        super().__init__(logger=logger, keep_samples=keep_samples)
+        self.port = port
+        self.baudrate = baudrate
+        self.ammeter_metrics.labels = {'port': port}
+        self._ammeter_info_str = f"{self.__class__.__name__}: {port}: {baudrate}"
+        self._serial_kwargs = serial_kwargs
+        self._serial = None
+        self._loop = None
+        self._iterators = []
+        # asyncio events of the wait_complete() calls, set when the run ends
+        self._stop_waiters = set()
+
+    @property
+    def _info_str(self):
+        """ Returns a string identifying the class for logging purposes """
+        return self._ammeter_info_str
+
+    async def open(self):
+        """ Open the serial port and start receiving on the running event loop """
+        self._loop = asyncio.get_running_loop()
+        self._serial = serial.Serial(self.port, self.baudrate, timeout=0, **self._serial_kwargs)
+        self._loop.add_reader(self._serial.fileno(), self._on_readable)
+        self._logger.info('%s: Starting async ammeter read.', self._info_str)
+
+    async def close(self):
+        """ Stop receiving, end any sample iterators and close the serial port """
+        for iterator in self._iterators:
+            iterator.close()
+        self._iterators = []
+        if self._serial is not None:
+            if self._serial.is_open:
+                self._loop.remove_reader(self._serial.fileno())
+                self._serial.close()
+            self._serial = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _on_readable(self):
+        """ Event loop callback when the port has data waiting """
+        try:
+            data = self._serial.read(self._serial.in_waiting or 1)
+        except serial.SerialException as e:
+            self._logger.error('%s: Error reading from the ammeter, stopping receive: %s', self._info_str, e)
+            self._loop.remove_reader(self._serial.fileno())
+            return
+        if data:
+            self._ammeter_feed(data)
+
+    def _ammeter_write(self, data:bytes):
+        """ Send data to the ammeter """
+        self._serial.write(data)
+
+    async def _wait(self, future, default=None, timeout=COMMAND_TIMEOUT):
+        """ Await a command future, returns the default and drops the pending request if it times out """
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            self._ammeter_cancel(future)
+            return default
+
+    async def session(self, cache=None, timeout=COMMAND_TIMEOUT):
+        """ Fetch the status and config in one pipelined exchange, see AmmeterRecvSerial.ammeter_session """
+        start = self._loop.time()
+        if cache is not None:
+            self.ammeter_attach_cache(cache, cache.key(self.port))
+        config, status_future, config_future = self.ammeter_session_request()
+        status = await self._wait(status_future, {}, timeout)
+        if config_future is not None:
+            config = await self._wait(config_future, {}, max(0.0, start + timeout - self._loop.time()))
+        return {'status': status, 'config': config, 'cached': config_future is None, 'seconds': self._loop.time() - start}
+
+    async def status(self):
+        """ Get the current status of the ammeter """
+        return await self._wait(self.ammeter_command('STATUS', 'STATUS'), {})
+
+    async def config(self):
+        """ Get the current configuration of the ammeter """
+        return await self._wait(self.ammeter_command('CONFIG', 'CONFIG'), {})
+
+    async def initialized(self):
+        """ Return True/False if ammeter is initialized """
+        status = await self.status()
+        return not (status != {} and status['status'] == 'NOINIT')
+
+    async def running(self):
+        """ Return True/False if sampling is in progress """
+        status = await self.status()
+        return status != {} and status['status'] == 'RUNNING'
+
+    async def ready(self):
+        """ Return True/False if the ammeter is ready to start sampling """
+        status = await self.status()
+        return status != {} and status['status'] == 'READY'
+
+    async def init(self):
+        """ Initialize the ammeter """
+        self.ammeter_invalidate_config()
+        self.ammeter_command('INIT')
+
+    async def start(self, timeout=None):
+        """ Start the sampling, returns as soon as the ammeter sends START """
+        started = self.ammeter_command(f"START{(':' + str(timeout)) if timeout is not None else ''}", 'START')
+        if await self._wait(started) is not None:
+            return True
+        return await self.running()
+
+    async def stop(self):
+        """ Stop the sampling if currently running, returns as soon as the ammeter sends STOP """
+        if await self._wait(self.ammeter_command('STOP', 'STOP')) is not None:
+            return True
+        return not await self.running()
+
+    async def current(self):
+        """ Read one value and return the sample (None if the ammeter is running or doesn't respond) """
+        if not await self.running():
+            return await self._wait(self.ammeter_command('ONE', 'DATA'))
+        return None
+
+    def _ammeter_handle_stop(self, reported:int):
+        """ Set the stop time and wake the wait_complete() calls """
+        super()._ammeter_handle_stop(reported)
+        self._notify_stopped()
+
+    def _ammeter_handle_status(self, status:dict):
+        """ Update the current status, a run that ended without a STOP wakes the wait_complete() calls """
+        super()._ammeter_handle_status(status)
+        self._notify_stopped()
+
+    def _notify_stopped(self):
+        """ Wake the wait_complete() calls if the run is complete, runs on the event loop thread """
+        if self._ammeter_stopped.is_set():
+            for event in self._stop_waiters:
+                event.set()
+
+    async def wait_complete(self, timeout=None):
+        """ Wait for the current run to finish (STOP received) without sending any commands.  Doesn't take the STOP
+            record from a pending stop() command.
+        """
+        if self._ammeter_stopped.is_set():
+            return True
+        event = asyncio.Event()
+        self._stop_waiters.add(event)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return self._ammeter_stopped.is_set()
+        finally:
+            self._stop_waiters.discard(event)
+
+    async def report(self, wait=5):
+        """ Returns the data table collected if the ammeter collection is complete, waits up to the specified time """
+        if not await self.wait_complete(timeout=wait):
+            return None
+        with self.ammeter_data_lock:
+            return {
+                'start': self.ammeter_start_time,
+                'stop': self.ammeter_stop_time,
+                'data': self.ammeter_data
+            }
+
+    def samples(self, maxsize=0):
+        """ Return an async iterator of the samples received from now on """
+        iterator = AsyncSampleIterator(self, maxsize=maxsize)
+        self._iterators.append(iterator)
+        return iterator
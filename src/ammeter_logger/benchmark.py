@@ -0,0 +1,276 @@
+"""
+Benchmarks for the ammeter receive path
+
+    python3 -m ammeter_logger.benchmark parser [--input RECORDED_FILE] [--lines LINES] [--reads READS]
+    python3 -m ammeter_logger.benchmark {throughput,latency,memory,commands,startup,all} [--lines LINES] [--reads READS]
+
+The receive benchmarks run AmmeterRecvSerial against the pty AmmeterSimulator.  A pty has no baud rate limit, so
+the throughput reported is the host side capacity - compare it with the line rate of the serial link (baud_line_rate).
+"""
+import os
+import json
+import logging
+import tempfile
+import argparse
+import tracemalloc
+from ast import literal_eval
+from time import perf_counter, time, sleep
+from .protocol import parse_line, parse_lines
+from .sample_store import SampleStore, Sample
+from .simulator import AmmeterSimulator
+from .ammeter_recv import AmmeterRecvSerial
+from .device_cache import DeviceConfigCache
+
+# rates (lines/sec) stepped through to find the maximum sustainable rate
+SUSTAINED_RATES = (500, 1000, 2000, 5000, 10000, 20000, 50000)
+# simulated link latency for the startup benchmark (seconds), the default latency timer of FTDI USB serial adapters
+STARTUP_LATENCY = 0.016
+
+
+def generate_firmware_lines(lines=100000, channels=1, reads=10):
+    """ Return a list of lines in the firmware output format (START, DATA..., STOP) """
+    output = ['START:1000']
+    for x in range(lines):
+        channel = x % channels
+        ticks = 1000 + x * 10
+        values = [round(0.1 + ((x + y) % 17) * 0.01, 4) for y in range(reads)]
+        output.append(f'DATA:ch{channel}:{ticks}:{values[-1]}:{values}:{round(sum(values) / reads, 6)}')
+    output.append(f'STOP:{1000 + lines * 10}')
+    return output
+
+
+def load_recorded_lines(file_name:str):
+    """ Return the lines from a file of recorded firmware output """
+    with open(file_name, 'r', encoding='utf-8', errors='replace') as input_file:
+        return [line.rstrip('\r\n') for line in input_file]
+
+
+def legacy_parse_line(line:str):
+    """ The parsing done per line before the dedicated parser (split, if-chain and literal_eval), kept for comparison """
+    response = line.split(':')
+    if response[0] == 'DATA' and len(response) == 6:
+        return 'DATA', (response[1], int(response[2]), float(response[3]), literal_eval(response[4]), float(response[5]))
+    if response[0] == 'START' and len(response) == 2:
+        return 'START', int(response[1])
+    if response[0] == 'STOP' and len(response) == 2:
+        return 'STOP', int(response[1])
+    return None, None
+
+
+def _time_call(function, repeat:int):
+    """ Return the best time of repeat runs of function """
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_parser(lines:list, repeat=3):
+    """ Time the legacy parser, the dedicated parser per line and in batch mode.  Returns {name: lines/sec} """
+    results = {
+        'legacy (literal_eval)': _time_call(lambda: [legacy_parse_line(line) for line in lines], repeat),
+        'parse_line': _time_call(lambda: [parse_line(line) for line in lines], repeat),
+        'parse_lines (batch)': _time_call(lambda: parse_lines(lines), repeat)
+    }
+    return {name: len(lines) / elapsed for name, elapsed in results.items()}
+
+
+def percentile(values:list, fraction:float):
+    """ Return the value at the fraction (0-1) of the sorted values """
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def baud_line_rate(baudrate:int, line_bytes:int):
+    """ Return the maximum lines/sec a serial link can carry (8N1, 10 bits per byte) """
+    return baudrate / 10 / line_bytes
+
+
+def _wait_for_samples(device:AmmeterRecvSerial, count:int, timeout:float):
+    """ Wait until the device has stored count samples or the timeout expires """
+    end_time = time() + timeout
+    while device.ammeter_sample_count < count and time() < end_time:
+        sleep(0.01)
+
+
+def bench_throughput(lines=200000, reads=10):
+    """ Send lines as fast as the pty accepts them, returns the received lines/sec and CPU time per line """
+    with AmmeterSimulator(rate=0, reads=reads, max_lines=lines, timeout=3600) as simulator:
+        device = AmmeterRecvSerial(simulator.port, logger=logging.getLogger(__name__))
+        try:
+            start = perf_counter()
+            device.ammeter_start()
+            _wait_for_samples(device, lines, timeout=120)
+            elapsed = perf_counter() - start
+            stats = device.ammeter_read_stats
+            line_bytes = stats['bytes'] / max(1, stats['lines'])
+            return {
+                'lines': device.ammeter_sample_count,
+                'lines_per_sec': device.ammeter_sample_count / elapsed,
+                'cpu_per_line_us': stats['cpu_per_line'] * 1e6,
+                'line_bytes': line_bytes,
+                'lines_per_sec_at_921600_baud': baud_line_rate(921600, line_bytes)
+            }
+        finally:
+            device.close()
+
+
+def bench_latency(rate=1000, duration=3.0, reads=10):
+    """ Send lines at a fixed rate, returns the delivered rate and the send to store latency """
+    with AmmeterSimulator(rate=rate, reads=reads, record_send_times=True, timeout=duration) as simulator:
+        device = AmmeterRecvSerial(simulator.port, logger=logging.getLogger(__name__))
+        try:
+            device.ammeter_start()
+            device.ammeter_report(wait=duration + 10)
+            received = device.ammeter_data.column('received')
+            count = min(len(received), len(simulator.send_times))
+            latencies = [(received[x] - simulator.send_times[x]) * 1000 for x in range(count)]
+            return {
+                'rate': rate,
+                'sent': simulator.lines_sent,
+                'received': device.ammeter_sample_count,
+                'delivered_rate': device.ammeter_sample_count / duration,
+                'latency_mean_ms': sum(latencies) / len(latencies) if count > 0 else 0.0,
+                'latency_p99_ms': percentile(latencies, 0.99),
+                'latency_max_ms': max(latencies) if count > 0 else 0.0
+            }
+        finally:
+            device.close()
+
+
+def bench_sustained(duration=2.0, reads=10, max_p99_ms=100.0):
+    """ Step through SUSTAINED_RATES until the receiver falls behind.  Returns the highest rate that was delivered in
+        full (at 95% of the target rate or better) with a p99 latency under max_p99_ms, and the result of every step.
+    """
+    steps = []
+    sustained = 0
+    for rate in SUSTAINED_RATES:
+        result = bench_latency(rate=rate, duration=duration, reads=reads)
+        steps.append(result)
+        if result['received'] < result['sent'] or result['delivered_rate'] < rate * 0.95 \
+                or result['latency_p99_ms'] > max_p99_ms:
+            break
+        sustained = rate
+    return {'max_sustained_lines_per_sec': sustained, 'steps': steps}
+
+
+def bench_memory(lines=100000, reads=10):
+    """ Return the bytes of memory used per stored sample """
+    samples = [Sample(time(), 'ch0', x, 0.5, [0.1] * reads, 0.5) for x in range(1000)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = SampleStore()
+    for x in range(0, lines, len(samples)):
+        store.extend(samples)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return {'samples': len(store), 'bytes_per_sample': used / len(store)}
+
+
+def bench_commands(count=200):
+    """ Return the STATUS command round trip times """
+    with AmmeterSimulator() as simulator:
+        device = AmmeterRecvSerial(simulator.port, logger=logging.getLogger(__name__))
+        try:
+            times = []
+            for _ in range(count):
+                start = perf_counter()
+                device.ammeter_status
+                times.append((perf_counter() - start) * 1000)
+            return {
+                'commands': count,
+                'rtt_mean_ms': sum(times) / len(times),
+                'rtt_p50_ms': percentile(times, 0.5),
+                'rtt_p99_ms': percentile(times, 0.99)
+            }
+        finally:
+            device.close()
+
+
+def _startup_run(mode:str, cache=None, latency=0.0):
+    """ Return the seconds from opening the port to the first sample.  mode 'sequential' is the startup done before
+        sessions (STATUS, CONFIG and STATUS again, each waited on), 'session' uses ammeter_session with the cache.
+    """
+    with AmmeterSimulator(rate=1000, timeout=1, latency=latency) as simulator:
+        start = perf_counter()
+        device = AmmeterRecvSerial(simulator.port, logger=logging.getLogger(__name__))
+        try:
+            if mode == 'sequential':
+                device.ammeter_initialized
+                device.ammeter_config
+                device.ammeter_ready
+            else:
+                device.ammeter_session(cache)
+            device.ammeter_start()
+            while device.ammeter_sample_count == 0 and perf_counter() - start < 10:
+                sleep(0.0005)
+            return perf_counter() - start
+        finally:
+            device.close()
+
+
+def bench_startup(runs=10, latency=STARTUP_LATENCY):
+    """ Return the mean milliseconds from opening the port to the first sample for the sequential startup, a session
+        without a cached config and a session with one.  latency is the simulated link latency per exchange.
+    """
+    results = {'sequential_ms': [], 'session_ms': [], 'session_cached_ms': []}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for _ in range(runs):
+            results['sequential_ms'].append(_startup_run('sequential', latency=latency) * 1000)
+            cache = DeviceConfigCache(os.path.join(cache_dir, 'cache.json'))
+            cache.invalidate()
+            results['session_ms'].append(_startup_run('session', cache, latency) * 1000)
+            results['session_cached_ms'].append(_startup_run('session', cache, latency) * 1000)
+    return {name: sum(times) / len(times) for name, times in results.items()}
+
+
+def print_results(title:str, results:dict, unit:str):
+    """ Print a table of benchmark results """
+    print(title)
+    for name, value in results.items():
+        print(f'    {name:<32} {value:>14,.1f} {unit}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the ammeter receive path")
+    parser.add_argument('benchmark', metavar='BENCHMARK', choices=['parser', 'throughput', 'latency', 'memory', 'commands', 'startup', 'all'], help='Benchmark to run')
+    parser.add_argument('--input', dest='input', required=False, default=None, help='File of recorded firmware output to use instead of generated lines')
+    parser.add_argument('--lines', dest='lines', required=False, type=int, default=100000, help='(100000) Number of DATA lines to generate')
+    parser.add_argument('--reads', dest='reads', required=False, type=int, default=10, help='(10) Number of last_reads values per generated DATA line')
+    parser.add_argument('--json', dest='json', required=False, default=None, help='Also write the results to a JSON file (to track results over releases)')
+    args = vars(parser.parse_args())
+
+    output = {}
+    if args['benchmark'] == 'parser':
+        lines = load_recorded_lines(args['input']) if args['input'] is not None else generate_firmware_lines(args['lines'], reads=args['reads'])
+        results = bench_parser(lines)
+        print_results(f'Parser throughput ({len(lines)} lines)', results, 'lines/sec')
+        baseline = results['legacy (literal_eval)']
+        for name, value in results.items():
+            print(f'    {name:<32} {value / baseline:>14.1f} x legacy')
+        output['parser'] = results
+    if args['benchmark'] in ('throughput', 'all'):
+        output['throughput'] = bench_throughput(lines=args['lines'], reads=args['reads'])
+        print_results('Receive throughput', output['throughput'], '')
+    if args['benchmark'] in ('latency', 'all'):
+        output['latency'] = bench_sustained(reads=args['reads'])
+        for step in output['latency']['steps']:
+            print_results(f"Latency at {step['rate']} lines/sec", step, '')
+        print(f"Maximum sustained rate: {output['latency']['max_sustained_lines_per_sec']} lines/sec")
+    if args['benchmark'] in ('memory', 'all'):
+        output['memory'] = bench_memory(lines=args['lines'], reads=args['reads'])
+        print_results('Memory', output['memory'], '')
+    if args['benchmark'] in ('commands', 'all'):
+        output['commands'] = bench_commands()
+        print_results('Command round trip (STATUS)', output['commands'], '')
+    if args['benchmark'] in ('startup', 'all'):
+        output['startup'] = bench_startup()
+        print_results('Startup to first sample', output['startup'], '')
+    if args['json'] is not None:
+        with open(args['json'], 'w', encoding='utf-8') as output_file:
+            json.dump(output, output_file, indent=2)
@@ -0,0 +1,296 @@
+"""
+Compact binary capture format and memory-mapped reader
+
+File layout (little endian, every section 8 byte aligned):
+    header      HEADER_SIZE bytes: MAGIC, uint32 JSON length, JSON (version, config, start, stop, last_reads_width),
+                zero padded.  Rewritten in place when the capture is closed.
+    blocks      repeated, each starting with BLOCK_HEADER (tag, count, width, reserved):
+                b'NAME' - count bytes of a JSON list of channel names appended to the name table
+                b'DATA' - count records stored column by column: received (f8), ticks (i8), current_amps (f8),
+                          average (f8), last_reads (f8 x count x width), name index (u2)
+"""
+import os
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_right
+from .sample_store import Sample, SampleStore
+from .spool import CsvSink
+
+MAGIC = b'AMMCAP01'
+VERSION = 1
+HEADER_SIZE = 4096
+HEADER_STRUCT = struct.Struct('<8sI')
+BLOCK_HEADER = struct.Struct('<4sIII')
+DATA_TAG = b'DATA'
+NAME_TAG = b'NAME'
+
+# column order and typecodes of a DATA block
+BLOCK_COLUMNS = (('received', 'd'), ('ticks', 'q'), ('current_amps', 'd'), ('average', 'd'))
+
+
+def _padding(length:int):
+    """ Return the number of bytes needed to pad length to a multiple of 8 """
+    return -length % 8
+
+
+def _data_block_size(count:int, width:int):
+    """ Return the payload size of a DATA block """
+    return count * 8 * (len(BLOCK_COLUMNS) + width) + count * 2 + _padding(count * 2)
+
+
+class BinarySink:
+    """ Writes samples to a binary capture file.  Has the same interface as CsvSink so it can be used with the
+        SpoolWriter for streaming captures or to write a complete SampleStore.
+    """
+    def __init__(self, file_name:str):
+        self.file_name = file_name
+        self._file = open(file_name, 'wb')
+        self._names = []
+        self._name_index = {}
+        self._width = None
+        self._run_info = {'config': {}, 'start': {}, 'stop': {}}
+        self.rows_written = 0
+        # rows not written because their last_reads width differs from the file
+        self.rows_skipped = 0
+        self._write_header()
+
+    def _write_header(self):
+        """ Write the file header at the start of the file """
+        header = dict(self._run_info, version=VERSION, last_reads_width=self._width)
+        header_json = json.dumps(header).encode()
+        if HEADER_STRUCT.size + len(header_json) > HEADER_SIZE:
+            raise ValueError(f'Capture header is {len(header_json)} bytes, maximum is {HEADER_SIZE - HEADER_STRUCT.size}')
+        position = self._file.tell()
+        self._file.seek(0)
+        self._file.write(HEADER_STRUCT.pack(MAGIC, len(header_json)) + header_json)
+        self._file.write(bytes(HEADER_SIZE - HEADER_STRUCT.size - len(header_json)))
+        if position > HEADER_SIZE:
+            self._file.seek(position)
+
+    def set_run_info(self, config=None, start=None, stop=None):
+        """ Store the device config and START/STOP times in the header """
+        for key, value in (('config', config), ('start', start), ('stop', stop)):
+            if value is not None:
+                self._run_info[key] = value
+        self._write_header()
+
+    def _name_indexes(self, names):
+        """ Return the file name indexes for an iterable of channel names, writing a NAME block for new names """
+        new_names = []
+        indexes = array('H')
+        for name in names:
+            index = self._name_index.get(name)
+            if index is None:
+                index = len(self._names)
+                self._names.append(name)
+                self._name_index[name] = index
+                new_names.append(name)
+            indexes.append(index)
+        if len(new_names) > 0:
+            payload = json.dumps(new_names).encode()
+            self._file.write(BLOCK_HEADER.pack(NAME_TAG, len(payload), 0, 0) + payload + bytes(_padding(len(payload))))
+        return indexes
+
+    def _write_block(self, columns:dict, last_reads, names, count:int):
+        """ Write a DATA block from column buffers """
+        name_indexes = self._name_indexes(names)
+        self._file.write(BLOCK_HEADER.pack(DATA_TAG, count, self._width, 0))
+        for column, _ in BLOCK_COLUMNS:
+            self._file.write(columns[column])
+        self._file.write(last_reads)
+        self._file.write(name_indexes)
+        self._file.write(bytes(_padding(count * 2)))
+        self.rows_written += count
+
+    def write_samples(self, samples):
+        """ Write a batch of samples (list of Samples or a SampleStore).  Rows with a different last_reads width from
+            the first sample written are skipped and counted in rows_skipped.
+        """
+        if len(samples) == 0:
+            return
+        if self._width is None:
+            self._width = len(samples[0]['last_reads'])
+            self._write_header()
+        if isinstance(samples, SampleStore):
+            # write the store chunk by chunk straight from its column buffers
+            if samples.last_reads_width != self._width:
+                self.rows_skipped += len(samples)
+                return
+            views = {column: samples.column_views(column) for column, _ in BLOCK_COLUMNS}
+            last_reads = samples.column_views('last_reads') if self._width > 0 else None
+            for x, name_view in enumerate(samples.column_views('name')):
+                self._write_block({column: views[column][x] for column in views},
+                                  last_reads[x] if last_reads is not None else b'',
+                                  (samples.names[index] for index in name_view), len(name_view))
+            return
+        width = self._width
+        if any(len(sample['last_reads']) != width for sample in samples):
+            kept = [sample for sample in samples if len(sample['last_reads']) == width]
+            self.rows_skipped += len(samples) - len(kept)
+            samples = kept
+            if len(samples) == 0:
+                return
+        columns = {column: array(typecode, (sample[column] for sample in samples)) for column, typecode in BLOCK_COLUMNS}
+        last_reads = array('d')
+        for sample in samples:
+            last_reads.extend(sample['last_reads'])
+        self._write_block(columns, last_reads, (sample['name'] for sample in samples), len(samples))
+
+    def flush(self):
+        """ Flush buffered blocks to the OS """
+        self._file.flush()
+
+    def fsync(self):
+        """ Flush and force the written blocks to disk """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """ Rewrite the header and close the file """
+        if not self._file.closed:
+            self._write_header()
+            self.fsync()
+            self._file.close()
+
+
+class BinaryCaptureReader:
+    """ Memory-mapped reader for a binary capture file.  Columns are exposed as memoryviews of the mapped file
+        (column_views) without parsing, indexing and iteration return Sample rows like a SampleStore.
+        Release any views before calling close().
+    """
+    def __init__(self, file_name:str):
+        self.file_name = file_name
+        self._file = open(file_name, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_length = HEADER_STRUCT.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f'{file_name} is not an ammeter binary capture')
+        header = json.loads(self._mmap[HEADER_STRUCT.size:HEADER_STRUCT.size + header_length])
+        self.version = header['version']
+        self.config = header['config']
+        self.start = header['start']
+        self.stop = header['stop']
+        self.last_reads_width = header['last_reads_width']
+        self.names = []
+        self._blocks = []
+        self._block_starts = []
+        self._count = 0
+        self._scan_blocks()
+
+    def _scan_blocks(self):
+        """ Walk the block headers to build the block index.  A truncated final block (i.e. from a crash while
+            capturing) is ignored.
+        """
+        offset = HEADER_SIZE
+        size = len(self._mmap)
+        while offset + BLOCK_HEADER.size <= size:
+            tag, count, width, _ = BLOCK_HEADER.unpack_from(self._mmap, offset)
+            payload = offset + BLOCK_HEADER.size
+            if tag == NAME_TAG:
+                if payload + count > size:
+                    break
+                self.names.extend(json.loads(self._mmap[payload:payload + count]))
+                offset = payload + count + _padding(count)
+            elif tag == DATA_TAG:
+                if payload + _data_block_size(count, width) > size:
+                    break
+                self._blocks.append((payload, count, width))
+                self._block_starts.append(self._count)
+                self._count += count
+                offset = payload + _data_block_size(count, width)
+            else:
+                break
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _block_column(self, block, column:str):
+        """ Return a memoryview of a column in a DATA block """
+        payload, count, width = block
+        view = memoryview(self._mmap)
+        offset = payload
+        for name, typecode in BLOCK_COLUMNS:
+            if name == column:
+                return view[offset:offset + count * 8].cast(typecode)
+            offset += count * 8
+        if column in ('last_reads', '_last_reads_flat'):
+            if count * width == 0:
+                return None
+            flat = view[offset:offset + count * width * 8].cast('d')
+            return flat if column == '_last_reads_flat' else view[offset:offset + count * width * 8].cast('d', [count, width])
+        offset += count * width * 8
+        if column == 'name':
+            return view[offset:offset + count * 2].cast('H')
+        raise KeyError(column)
+
+    def column_views(self, column:str):
+        """ Return a list of zero-copy memoryviews (one per block) of a column.  'last_reads' views are 2-D """
+        views = [self._block_column(block, column) for block in self._blocks]
+        return [view for view in views if view is not None]
+
+    def column(self, column:str):
+        """ Return a contiguous copy of a column as an array (last_reads is flattened row by row) """
+        output = array('d' if column == 'last_reads' else dict(BLOCK_COLUMNS, name='H')[column])
+        for view in self.column_views(column):
+            output.frombytes(view.tobytes() if view.ndim > 1 else view.cast('B'))
+        return output
+
+    def _row(self, block, row:int):
+        """ Build a Sample from a row of a block """
+        values = {column: self._block_column(block, column)[row] for column, _ in BLOCK_COLUMNS}
+        last_reads = self._block_column(block, '_last_reads_flat')
+        width = block[2]
+        return Sample(
+            values['received'],
+            self.names[self._block_column(block, 'name')[row]],
+            values['ticks'],
+            values['current_amps'],
+            last_reads[row * width:(row + 1) * width].tolist() if last_reads is not None else [],
+            values['average'])
+
+    def __getitem__(self, index:int):
+        if index < 0:
+            index += self._count
+        if index < 0 or index >= self._count:
+            raise IndexError('sample index out of range')
+        block = bisect_right(self._block_starts, index) - 1
+        return self._row(self._blocks[block], index - self._block_starts[block])
+
+    def __iter__(self):
+        for block in self._blocks:
+            payload, count, width = block
+            columns = [self._block_column(block, column) for column, _ in BLOCK_COLUMNS]
+            last_reads = self._block_column(block, '_last_reads_flat')
+            names = self._block_column(block, 'name')
+            for row in range(count):
+                yield Sample(
+                    columns[0][row],
+                    self.names[names[row]],
+                    columns[1][row],
+                    columns[2][row],
+                    last_reads[row * width:(row + 1) * width].tolist() if last_reads is not None else [],
+                    columns[3][row])
+
+    def close(self):
+        """ Unmap and close the file """
+        if not self._mmap.closed:
+            self._mmap.close()
+        self._file.close()
+
+
+def convert_to_csv(binary_file:str, csv_file:str):
+    """ Convert a binary capture file to the CSV format, returns the number of rows written """
+    with BinaryCaptureReader(binary_file) as reader:
+        sink = CsvSink(csv_file)
+        sink.write_samples(reader)
+        sink.close()
+        return sink.rows_written
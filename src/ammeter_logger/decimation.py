@@ -0,0 +1,269 @@
+"""
+Multi-resolution downsampling of ammeter captures - min/max/mean bucket levels and an LTTB level for plotting
+
+    python3 -m ammeter_logger.decimation CAPTURE_FILE OUTPUT_PREFIX [--factor FACTOR] [--levels LEVELS] [--points POINTS]
+"""
+import csv
+import argparse
+from array import array
+from operator import mul
+from .binary_capture import BinaryCaptureReader, MAGIC
+
+# samples (or buckets of the level below) per bucket
+DEFAULT_FACTOR = 16
+DEFAULT_LEVELS = 4
+# points in the LTTB level
+DEFAULT_LTTB_POINTS = 2000
+
+
+class PyramidLevel:
+    """ One level of the pyramid - a bucket per samples_per_bucket samples with the ticks of the first sample, the
+        sample count, min, max and mean.  The columns are typed arrays.
+    """
+    def __init__(self, samples_per_bucket:int):
+        self.samples_per_bucket = samples_per_bucket
+        self.ticks = array('q')
+        self.count = array('I')
+        self.min = array('d')
+        self.max = array('d')
+        self.mean = array('d')
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def append(self, ticks:int, count:int, minimum:float, maximum:float, mean:float):
+        """ Add a bucket """
+        self.ticks.append(ticks)
+        self.count.append(count)
+        self.min.append(minimum)
+        self.max.append(maximum)
+        self.mean.append(mean)
+
+    def __iter__(self):
+        for x in range(len(self.ticks)):
+            yield {'ticks': self.ticks[x], 'count': self.count[x], 'min': self.min[x], 'max': self.max[x], 'mean': self.mean[x]}
+
+
+class ChannelPyramid:
+    """ Pyramid for one channel.  Level 0 buckets factor samples, each level above buckets factor buckets of the level
+        below, so every sample is aggregated once and every bucket once more - O(n) in total.  Only full buckets are
+        added while samples arrive, finish() adds the partial buckets at the end of the run.
+    """
+    def __init__(self, factor=DEFAULT_FACTOR, levels=DEFAULT_LEVELS):
+        self.factor = factor
+        self.levels = [PyramidLevel(factor ** (x + 1)) for x in range(levels)]
+        self.lttb = None
+        self._ticks = array('q')
+        self._values = array('d')
+        self._consumed = [0] * levels
+        self.finished = False
+
+    def extend(self, ticks, values):
+        """ Add a run of samples (sequences of ticks and values) """
+        self._ticks.extend(ticks)
+        self._values.extend(values)
+        self._aggregate_samples(len(self._values) - len(self._values) % self.factor)
+        self._aggregate_levels(full_only=True)
+
+    def _aggregate_samples(self, end:int):
+        """ Bucket the pending samples up to end into level 0 """
+        factor, level, ticks, values = self.factor, self.levels[0], self._ticks, self._values
+        for start in range(0, end, factor):
+            bucket = values[start:start + factor]
+            level.append(ticks[start], len(bucket), min(bucket), max(bucket), sum(bucket) / len(bucket))
+        del ticks[:end]
+        del values[:end]
+
+    def _aggregate_levels(self, full_only:bool):
+        """ Bucket the new buckets of each level into the level above """
+        factor = self.factor
+        for x in range(1, len(self.levels)):
+            below, level = self.levels[x - 1], self.levels[x]
+            start = self._consumed[x]
+            end = len(below) - (len(below) - start) % factor if full_only else len(below)
+            for bucket in range(start, end, factor):
+                counts = below.count[bucket:bucket + factor]
+                total = sum(counts)
+                level.append(below.ticks[bucket], total, min(below.min[bucket:bucket + factor]),
+                             max(below.max[bucket:bucket + factor]),
+                             sum(map(mul, below.mean[bucket:bucket + factor], counts)) / total)
+            self._consumed[x] = end
+
+    def finish(self, lttb_points=DEFAULT_LTTB_POINTS):
+        """ Add the partial buckets and build the LTTB level from level 0 if it wasn't built from the samples """
+        if self.finished:
+            return
+        self._aggregate_samples(len(self._values))
+        self._aggregate_levels(full_only=False)
+        if self.lttb is None and len(self.levels) > 0:
+            self.lttb = lttb(self.levels[0].ticks, self.levels[0].mean, lttb_points)
+        self.finished = True
+
+
+def lttb(ticks, values, points:int):
+    """ Largest-Triangle-Three-Buckets downsample of (ticks, values) to at most points, keeping the first and last
+        point.  Returns (ticks, values) arrays.  O(n).
+    """
+    count = len(values)
+    if points >= count or points < 3:
+        return array('q', ticks), array('d', values)
+    out_ticks, out_values = array('q', [ticks[0]]), array('d', [values[0]])
+    every = (count - 2) / (points - 2)
+    selected = 0
+    for bucket in range(points - 2):
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, count)
+        # the average of the next bucket is the third point of the triangle
+        next_ticks = ticks[end:next_end]
+        average_ticks = sum(next_ticks) / len(next_ticks) if len(next_ticks) > 0 else ticks[count - 1]
+        average_value = sum(values[end:next_end]) / len(next_ticks) if len(next_ticks) > 0 else values[count - 1]
+        point_ticks, point_value = ticks[selected], values[selected]
+        best_area, best = -1.0, start
+        for x in range(start, end):
+            area = abs((point_ticks - average_ticks) * (values[x] - point_value)
+                       - (point_ticks - ticks[x]) * (average_value - point_value))
+            if area > best_area:
+                best_area, best = area, x
+        out_ticks.append(ticks[best])
+        out_values.append(values[best])
+        selected = best
+    out_ticks.append(ticks[count - 1])
+    out_values.append(values[count - 1])
+    return out_ticks, out_values
+
+
+class DecimationPyramid:
+    """ Sample listener that builds a ChannelPyramid for each channel while the capture runs.  Call finish() at the
+        end of the run to add the partial buckets and the LTTB level.
+    """
+    def __init__(self, field='current_amps', factor=DEFAULT_FACTOR, levels=DEFAULT_LEVELS):
+        self.field = field
+        self.factor = factor
+        self.level_count = levels
+        self.channels = {}
+
+    def channel(self, name:str):
+        """ Return the pyramid of a channel, adding it if needed """
+        pyramid = self.channels.get(name)
+        if pyramid is None:
+            pyramid = self.channels[name] = ChannelPyramid(self.factor, self.level_count)
+        return pyramid
+
+    def __call__(self, samples:list):
+        """ Sample listener - add a batch of samples """
+        field = self.field
+        batches = {}
+        for sample in samples:
+            ticks, values = batches.setdefault(sample['name'], ([], []))
+            ticks.append(sample['ticks'])
+            values.append(sample[field])
+        for name, (ticks, values) in batches.items():
+            self.channel(name).extend(ticks, values)
+
+    def finish(self, lttb_points=DEFAULT_LTTB_POINTS):
+        """ Complete every channel """
+        for pyramid in self.channels.values():
+            pyramid.finish(lttb_points)
+
+    def level(self, level:int):
+        """ Return {channel: PyramidLevel} for one level """
+        return {name: pyramid.levels[level] for name, pyramid in self.channels.items()}
+
+    def select_level(self, max_points:int):
+        """ Return the index of the finest level with no more than max_points buckets in any channel """
+        for x in range(self.level_count):
+            if all(len(pyramid.levels[x]) <= max_points for pyramid in self.channels.values()):
+                return x
+        return self.level_count - 1
+
+
+def _split_channels(source, field:str):
+    """ Return {channel: (ticks, values)} arrays from the columns of a SampleStore or BinaryCaptureReader """
+    ticks, values, names = source.column('ticks'), source.column(field), source.column('name')
+    if len(source.names) == 1:
+        return {source.names[0]: (ticks, values)}
+    # one pass over the rows, appending each to the arrays of its channel
+    channels = {name: (array('q'), array('d')) for name in source.names}
+    split = [channels[name] for name in source.names]
+    for index, row_ticks, value in zip(names, ticks, values):
+        channel_ticks, channel_values = split[index]
+        channel_ticks.append(row_ticks)
+        channel_values.append(value)
+    return channels
+
+
+def build_pyramid(source, field='current_amps', factor=DEFAULT_FACTOR, levels=DEFAULT_LEVELS, lttb_points=DEFAULT_LTTB_POINTS):
+    """ Build a finished DecimationPyramid from a saved capture (SampleStore or BinaryCaptureReader).  The columns are
+        bucketed directly and the LTTB level is built from the samples rather than level 0.
+    """
+    pyramid = DecimationPyramid(field=field, factor=factor, levels=levels)
+    for name, (ticks, values) in _split_channels(source, field).items():
+        channel = pyramid.channel(name)
+        channel.extend(ticks, values)
+        channel.lttb = lttb(ticks, values, lttb_points)
+    pyramid.finish(lttb_points)
+    return pyramid
+
+
+def load_csv_capture(file_name:str, field='current_amps'):
+    """ Return {channel: (ticks, values)} from a CSV capture (single device format) """
+    column = 'latest' if field == 'current_amps' else field
+    channels = {}
+    with open(file_name, 'r', encoding='utf-8', newline='') as input_file:
+        for row in csv.DictReader(input_file):
+            ticks, values = channels.setdefault(row['name'], (array('q'), array('d')))
+            ticks.append(int(row['ticks']))
+            values.append(float(row[column]))
+    return channels
+
+
+def load_pyramid(file_name:str, field='current_amps', factor=DEFAULT_FACTOR, levels=DEFAULT_LEVELS, lttb_points=DEFAULT_LTTB_POINTS):
+    """ Build a pyramid from a binary or CSV capture file """
+    with open(file_name, 'rb') as input_file:
+        binary = input_file.read(len(MAGIC)) == MAGIC
+    if binary:
+        with BinaryCaptureReader(file_name) as capture:
+            return build_pyramid(capture, field, factor, levels, lttb_points)
+    pyramid = DecimationPyramid(field=field, factor=factor, levels=levels)
+    for name, (ticks, values) in load_csv_capture(file_name, field).items():
+        channel = pyramid.channel(name)
+        channel.extend(ticks, values)
+        channel.lttb = lttb(ticks, values, lttb_points)
+    pyramid.finish(lttb_points)
+    return pyramid
+
+
+def write_pyramid(pyramid:DecimationPyramid, prefix:str):
+    """ Write each level to PREFIX.L<level>.csv and the LTTB level to PREFIX.lttb.csv, returns the file names """
+    files = []
+    for x in range(pyramid.level_count):
+        file_name = f'{prefix}.L{x}.csv'
+        with open(file_name, 'w', encoding='utf-8', newline='') as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow(['name', 'ticks', 'count', 'min', 'max', 'mean'])
+            for name, level in pyramid.level(x).items():
+                writer.writerows([name, bucket['ticks'], bucket['count'], bucket['min'], bucket['max'], bucket['mean']] for bucket in level)
+        files.append(file_name)
+    file_name = f'{prefix}.lttb.csv'
+    with open(file_name, 'w', encoding='utf-8', newline='') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(['name', 'ticks', pyramid.field])
+        for name, channel in pyramid.channels.items():
+            if channel.lttb is not None:
+                writer.writerows([name, ticks, value] for ticks, value in zip(*channel.lttb))
+    files.append(file_name)
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the downsampled levels of a saved ammeter capture (binary or CSV)")
+    parser.add_argument('capture', metavar='CAPTURE_FILE', help='Capture file to downsample')
+    parser.add_argument('prefix', metavar='OUTPUT_PREFIX', help='Prefix of the level files (PREFIX.L0.csv ... PREFIX.lttb.csv)')
+    parser.add_argument('--factor', dest='factor', required=False, type=int, default=DEFAULT_FACTOR, help=f'({DEFAULT_FACTOR}) Samples per bucket between levels')
+    parser.add_argument('--levels', dest='levels', required=False, type=int, default=DEFAULT_LEVELS, help=f'({DEFAULT_LEVELS}) Number of min/max/mean levels')
+    parser.add_argument('--points', dest='points', required=False, type=int, default=DEFAULT_LTTB_POINTS, help=f'({DEFAULT_LTTB_POINTS}) Number of points in the LTTB level')
+    args = vars(parser.parse_args())
+
+    for output in write_pyramid(load_pyramid(args['capture'], factor=args['factor'], levels=args['levels'], lttb_points=args['points']), args['prefix']):
+        print(f"Wrote {output}")
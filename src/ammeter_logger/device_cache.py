@@ -0,0 +1,107 @@
+"""
+Cache of the configuration reported by each ammeter, so a session can start without waiting for CMD:CONFIG
+"""
+import os
+import json
+import logging
+from time import time
+from threading import Lock
+
+# entries older than this are ignored (seconds)
+DEFAULT_MAX_AGE = 86400
+
+
+def default_cache_file(name='config_cache.json'):
+    """ Return the path of a cache file (under XDG_CACHE_HOME or ~/.cache) """
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'ammeter_logger', name)
+
+
+def device_identity(port:str):
+    """ Return the hardware identity of a serial port (USB VID:PID and serial number from pyserial), or an empty
+        string if the port isn't listed (i.e. a pty)
+    """
+    try:
+        # on Linux only the one device is read from sysfs, listing every port takes milliseconds
+        from serial.tools.list_ports_linux import SysFS
+        info = SysFS(port)
+        return info.hwid if info.hwid not in (None, 'n/a') else ''
+    except (ImportError, OSError, ValueError):
+        pass
+    try:
+        from serial.tools import list_ports
+    except ImportError:
+        return ''
+    real_port = os.path.realpath(port)
+    for info in list_ports.comports():
+        if info.device in (port, real_port):
+            return info.hwid if info.hwid not in (None, 'n/a') else ''
+    return ''
+
+
+class DeviceConfigCache:
+    """ JSON file of {key: {'config', 'time'}} where the key is the port and the identity of the device behind it, so
+        a different board plugged into the same port misses the cache.  The receivers update the entry whenever a
+        CONFIG record arrives and invalidate it when a command changes the configuration (INIT, INTERVAL).
+    """
+    def __init__(self, file_name=None, max_age=DEFAULT_MAX_AGE, logger=None):
+        self.file_name = file_name if file_name is not None else default_cache_file()
+        self.max_age = max_age
+        self._logger = logger if logger is not None else logging.getLogger(__name__)
+        self._lock = Lock()
+        self._entries = None
+
+    def key(self, port:str):
+        """ Return the cache key for a port """
+        identity = device_identity(port)
+        return f'{port}|{identity}' if identity != '' else port
+
+    def _load(self):
+        """ Read the cache file once """
+        if self._entries is None:
+            try:
+                with open(self.file_name, 'r', encoding='utf-8') as cache_file:
+                    self._entries = json.load(cache_file)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        """ Write the cache file (replaced atomically) """
+        try:
+            os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+            temp_file = f'{self.file_name}.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as cache_file:
+                json.dump(self._entries, cache_file, indent=2)
+            os.replace(temp_file, self.file_name)
+        except OSError as e:
+            self._logger.warning('%s: Unable to write %s: %s', self.__class__.__name__, self.file_name, e)
+
+    def get(self, key:str):
+        """ Return the cached config for the key, None if not cached or expired """
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is None or time() - entry['time'] > self.max_age:
+            return None
+        return entry['config']
+
+    def put(self, key:str, config:dict):
+        """ Store the config for the key """
+        with self._lock:
+            entries = self._load()
+            entry = entries.get(key)
+            if entry is not None and entry['config'] == config and time() - entry['time'] < self.max_age / 2:
+                # unchanged and recently confirmed, don't rewrite the file
+                return
+            entries[key] = {'config': config, 'time': time()}
+            self._save()
+
+    def invalidate(self, key=None):
+        """ Drop the entry for the key, or every entry """
+        with self._lock:
+            entries = self._load()
+            if key is None:
+                entries.clear()
+            elif entries.pop(key, None) is None:
+                return
+            self._save()
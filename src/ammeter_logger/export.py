@@ -0,0 +1,234 @@
+"""
+Bulk export of captured samples - formats whole columns at a time and encodes chunks in parallel
+
+    python3 -m ammeter_logger.export CAPTURE_FILE OUTPUT_FILE [--format {csv,jsonl,npz,csv.gz}] [--workers WORKERS]
+
+Supported formats: csv (same output as CsvSink), jsonl (one JSON object per sample), npz (NumPy archive of the
+columns, written without needing numpy) and csv.gz (gzip compressed CSV).
+"""
+import os
+import sys
+import json
+import gzip
+import zipfile
+import argparse
+from math import modf
+from array import array
+from time import localtime, strftime, perf_counter
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from .spool import csv_header
+from .binary_capture import BinaryCaptureReader
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'npz', 'csv.gz')
+# numeric columns exported, with their array typecodes and the numpy dtype used in npz files
+EXPORT_COLUMNS = (('received', 'd', '<f8'), ('ticks', 'q', '<i8'), ('current_amps', 'd', '<f8'), ('average', 'd', '<f8'))
+# gzip level used for csv.gz, favouring speed as each chunk is compressed separately
+GZIP_LEVEL = 6
+
+
+def format_from_name(file_name:str):
+    """ Return the export format for a file name extension (csv if not recognized) """
+    for output_format in sorted(EXPORT_FORMATS, key=len, reverse=True):
+        if file_name.endswith('.' + output_format):
+            return output_format
+    return 'csv'
+
+
+def _copy_view(typecode:str, view):
+    """ Return a column view (memoryview, 1-D or 2-D) as an array """
+    output = array(typecode)
+    output.frombytes(view.tobytes() if view.ndim > 1 else view.cast('B'))
+    return output
+
+
+def iter_chunks(source):
+    """ Yield the samples of a SampleStore or BinaryCaptureReader as column chunks, one per store chunk or capture
+        block - {'columns': {column: array}, 'last_reads': flat array, 'names': array of name indexes, 'width'}
+    """
+    width = source.last_reads_width or 0
+    views = {column: source.column_views(column) for column, _, _ in EXPORT_COLUMNS}
+    names = source.column_views('name')
+    last_reads = source.column_views('last_reads') if width > 0 else None
+    for x in range(len(names)):
+        yield {
+            'columns': {column: _copy_view(typecode, views[column][x]) for column, typecode, _ in EXPORT_COLUMNS},
+            'last_reads': _copy_view('d', last_reads[x]) if last_reads is not None else array('d'),
+            'names': _copy_view('H', names[x]),
+            'width': width
+        }
+
+
+def format_datetimes(received):
+    """ Return the received times formatted like datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f').  The
+        date and time is formatted once per second and the microseconds appended, the rounding matches datetime.
+    """
+    seconds_cache = {}
+    output = []
+    append = output.append
+    for value in received:
+        fraction, seconds = modf(value)
+        micro = round(fraction * 1e6)
+        if micro >= 1000000:
+            seconds += 1
+            micro -= 1000000
+        elif micro < 0:
+            seconds -= 1
+            micro += 1000000
+        prefix = seconds_cache.get(seconds)
+        if prefix is None:
+            prefix = seconds_cache[seconds] = strftime('%Y-%m-%d %H:%M:%S.', localtime(seconds))
+        append(f'{prefix}{micro:06d}')
+    return output
+
+
+def _csv_name(name:str):
+    """ Return a channel name quoted as the csv module would """
+    if any(char in name for char in ',"\r\n'):
+        return '"' + name.replace('"', '""') + '"'
+    return name
+
+
+def encode_csv(chunk:dict, names:list):
+    """ Return a chunk encoded as CSV rows (str) """
+    columns, width = chunk['columns'], chunk['width']
+    count = len(chunk['names'])
+    if count == 0:
+        return ''
+    name_cells = [_csv_name(name) for name in names]
+    reads = list(map(repr, chunk['last_reads']))
+    cells = [
+        list(map(repr, columns['received'])),
+        [name_cells[x] for x in chunk['names']],
+        format_datetimes(columns['received']),
+        list(map(str, columns['ticks'])),
+        list(map(repr, columns['current_amps']))
+    ]
+    cells.extend(reads[x::width] for x in range(width))
+    cells.append([repr(ticks / 1000) for ticks in columns['ticks']])
+    cells.append(list(map(repr, columns['average'])))
+    return '\r\n'.join(map(','.join, zip(*cells))) + '\r\n'
+
+
+def encode_jsonl(chunk:dict, names:list):
+    """ Return a chunk encoded as JSON lines with the Sample fields (str) """
+    columns, width = chunk['columns'], chunk['width']
+    count = len(chunk['names'])
+    if count == 0:
+        return ''
+    name_cells = [json.dumps(name) for name in names]
+    reads = list(map(repr, chunk['last_reads']))
+    last_reads = ['[' + ', '.join(reads[x * width:(x + 1) * width]) + ']' for x in range(count)]
+    rows = zip(map(repr, columns['received']), [name_cells[x] for x in chunk['names']], map(str, columns['ticks']),
+               map(repr, columns['current_amps']), last_reads, map(repr, columns['average']))
+    return ''.join(f'{{"received": {received}, "name": {name}, "ticks": {ticks}, "current_amps": {current}, '
+                   f'"last_reads": {reads}, "average": {average}}}\n'
+                   for received, name, ticks, current, reads, average in rows)
+
+
+def encode_chunk(output_format:str, chunk:dict, names:list):
+    """ Encode a chunk to bytes in a text format, runs in the worker pool """
+    if output_format == 'jsonl':
+        return encode_jsonl(chunk, names).encode('utf-8')
+    data = encode_csv(chunk, names).encode('utf-8')
+    if output_format == 'csv.gz':
+        # each chunk is a complete gzip member, concatenated members are a valid gzip file
+        return gzip.compress(data, GZIP_LEVEL)
+    return data
+
+
+def _npy_header(dtype:str, shape:tuple):
+    """ Return a .npy (format 1.0) header for a C ordered array """
+    header = f"{{'descr': '{dtype}', 'fortran_order': False, 'shape': {shape}, }}"
+    header += ' ' * (63 - (len(header) + 10) % 64) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+
+def _little_endian(values:array):
+    """ Return the bytes of an array in little endian order """
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def write_npz(source, file_name:str):
+    """ Write the columns to a NumPy .npz archive (np.load(file_name)['current_amps'] etc.).  last_reads is a 2-D
+        array, name holds the index of each sample into the names array.  Returns the rows written.
+    """
+    count, width = len(source), source.last_reads_width or 0
+    with zipfile.ZipFile(file_name, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for column, typecode, dtype in EXPORT_COLUMNS + (('name', 'H', '<u2'),):
+            with archive.open(f'{column}.npy', 'w', force_zip64=True) as output_file:
+                output_file.write(_npy_header(dtype, (count,)))
+                for view in source.column_views(column):
+                    output_file.write(_little_endian(_copy_view(typecode, view)))
+        with archive.open('last_reads.npy', 'w', force_zip64=True) as output_file:
+            output_file.write(_npy_header('<f8', (count, width)))
+            if width > 0:
+                for view in source.column_views('last_reads'):
+                    output_file.write(_little_endian(_copy_view('d', view)))
+        names_width = max([len(name) for name in source.names] + [1])
+        with archive.open('names.npy', 'w') as output_file:
+            output_file.write(_npy_header(f'<U{names_width}', (len(source.names),)))
+            output_file.write(b''.join(name.ljust(names_width, '\0').encode('utf-32-le') for name in source.names))
+    return count
+
+
+def export_capture(source, file_name:str, output_format=None, workers=None, executor='process'):
+    """ Export a SampleStore (or its snapshot) or BinaryCaptureReader to a file.  Text formats are encoded a chunk at
+        a time on a pool of workers and written in order.  executor is 'process' (the default start method), 'spawn'
+        or 'forkserver' for worker processes started without forking the caller (needed if it has threads running),
+        or 'thread' for a thread pool (only gzip releases the GIL).  Returns {'rows', 'bytes', 'seconds', 'rows_per_sec'}.
+    """
+    output_format = output_format if output_format is not None else format_from_name(file_name)
+    if output_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format {output_format}')
+    start = perf_counter()
+    written = 0
+    if output_format == 'npz':
+        rows = write_npz(source, file_name)
+        written = os.path.getsize(file_name)
+    else:
+        rows = len(source)
+        names = list(source.names)
+        workers = workers if workers is not None else os.cpu_count() or 1
+        if executor == 'thread':
+            pool = ThreadPoolExecutor(workers)
+        else:
+            pool = ProcessPoolExecutor(workers, mp_context=get_context(executor) if executor != 'process' else None)
+        with pool, open(file_name, 'wb') as output_file:
+            if output_format != 'jsonl':
+                header = (','.join(csv_header(source.last_reads_width or 0)) + '\r\n').encode('utf-8')
+                if output_format == 'csv.gz':
+                    header = gzip.compress(header, GZIP_LEVEL)
+                output_file.write(header)
+                written += len(header)
+            # keep a bounded number of chunks in flight so memory doesn't grow with the capture
+            in_flight = []
+            max_in_flight = 2 * workers
+            for chunk in iter_chunks(source):
+                in_flight.append(pool.submit(encode_chunk, output_format, chunk, names))
+                if len(in_flight) >= max_in_flight:
+                    data = in_flight.pop(0).result()
+                    output_file.write(data)
+                    written += len(data)
+            for future in in_flight:
+                data = future.result()
+                output_file.write(data)
+                written += len(data)
+    elapsed = perf_counter() - start
+    return {'rows': rows, 'bytes': written, 'seconds': elapsed, 'rows_per_sec': rows / elapsed if elapsed > 0 else 0.0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a binary ammeter capture to CSV, JSON lines, npz or compressed CSV")
+    parser.add_argument('capture', metavar='CAPTURE_FILE', help='Binary capture file to export')
+    parser.add_argument('output', metavar='OUTPUT_FILE', help='File to export to')
+    parser.add_argument('--format', dest='format', required=False, choices=EXPORT_FORMATS, default=None, help='Export format (default from the output file extension)')
+    parser.add_argument('--workers', dest='workers', required=False, type=int, default=None, help='Number of worker processes (default the number of CPUs)')
+    args = vars(parser.parse_args())
+
+    with BinaryCaptureReader(args['capture']) as capture:
+        result = export_capture(capture, args['output'], output_format=args['format'], workers=args['workers'])
+    print(f"Exported {result['rows']} rows to {args['output']} in {result['seconds']:.2f} s ({result['rows_per_sec']:,.0f} rows/sec)")
@@ -0,0 +1,366 @@
+"""
+Live sample fan-out - serves the samples received by one process to any number of local subscribers
+
+    python3 -m ammeter_logger.fanout ADDRESS        print the samples published on ADDRESS
+
+ADDRESS is a Unix socket path, or HOST:PORT for TCP.  Each message is a frame of FRAME_HEADER (payload length)
+followed by the payload.  With the binary encoding the payload is BATCH_HEADER (magic, sample count, last_reads
+width, name table length), the JSON list of channel names used in the batch, then the columns: received (f8),
+ticks (i8), current_amps (f8), average (f8), last_reads (f8 x count x width) and name index (u2), little endian.
+With the jsonl encoding the payload is one JSON object per sample, one per line.
+"""
+import os
+import sys
+import json
+import stat
+import socket
+import struct
+import logging
+import argparse
+import selectors
+from array import array
+from collections import deque
+from queue import SimpleQueue
+from threading import Thread, Lock
+from .sample_store import Sample
+
+FRAME_HEADER = struct.Struct('<I')
+BATCH_HEADER = struct.Struct('<4sIHH')
+BATCH_MAGIC = b'AMSB'
+ENCODINGS = ('binary', 'jsonl')
+# what happens to a subscriber that falls more than max_queue batches behind
+POLICY_DROP_OLDEST = 'drop-oldest'
+POLICY_DISCONNECT = 'disconnect'
+POLICIES = (POLICY_DROP_OLDEST, POLICY_DISCONNECT)
+
+
+def parse_address(address:str):
+    """ Return (family, address) for a Unix socket path or HOST:PORT """
+    host, _, port = address.rpartition(':')
+    if host != '' and port.isdigit() and '/' not in address:
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def _little_endian(values:array):
+    """ Return the bytes of an array in little endian order """
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_batch(samples:list):
+    """ Return a batch of samples as a binary payload """
+    names, name_index = [], {}
+    indexes = array('H')
+    for sample in samples:
+        index = name_index.get(sample.name)
+        if index is None:
+            index = name_index[sample.name] = len(names)
+            names.append(sample.name)
+        indexes.append(index)
+    width = len(samples[0].last_reads) if len(samples) > 0 else 0
+    last_reads = array('d')
+    for sample in samples:
+        if len(sample.last_reads) != width:
+            raise ValueError(f'last_reads width changed from {width} to {len(sample.last_reads)} within a batch')
+        last_reads.extend(sample.last_reads)
+    name_table = json.dumps(names).encode('utf-8')
+    return b''.join([
+        BATCH_HEADER.pack(BATCH_MAGIC, len(samples), width, len(name_table)),
+        name_table,
+        _little_endian(array('d', [sample.received for sample in samples])),
+        _little_endian(array('q', [sample.ticks for sample in samples])),
+        _little_endian(array('d', [sample.current_amps for sample in samples])),
+        _little_endian(array('d', [sample.average for sample in samples])),
+        _little_endian(last_reads),
+        _little_endian(indexes)])
+
+
+def decode_batch(payload:bytes):
+    """ Return the list of Samples in a binary payload """
+    magic, count, width, names_length = BATCH_HEADER.unpack_from(payload, 0)
+    if magic != BATCH_MAGIC:
+        raise ValueError('Not a sample batch')
+    offset = BATCH_HEADER.size
+    names = json.loads(payload[offset:offset + names_length])
+    offset += names_length
+    columns = []
+    for typecode, length in (('d', count), ('q', count), ('d', count), ('d', count), ('d', count * width), ('H', count)):
+        column = array(typecode)
+        column.frombytes(payload[offset:offset + length * column.itemsize])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns.append(column)
+        offset += length * column.itemsize
+    received, ticks, current_amps, average, last_reads, indexes = columns
+    return [Sample(received[x], names[indexes[x]], ticks[x], current_amps[x], last_reads[x * width:(x + 1) * width].tolist(), average[x])
+            for x in range(count)]
+
+
+def encode_jsonl(samples:list):
+    """ Return a batch of samples as JSON lines """
+    return ''.join(json.dumps(sample._asdict()) + '\n' for sample in samples).encode('utf-8')
+
+
+class _Subscriber:
+    """ A connected client and the frames waiting to be sent to it """
+    def __init__(self, connection:socket.socket, address):
+        self.connection = connection
+        self.address = address
+        self.frames = deque()
+        self.sending = None
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.slow = False
+
+
+def _remove_stale_socket(path:str):
+    """ Remove a socket left at path by an earlier server, anything else at the path is never removed """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ValueError(f'{path} exists and is not a socket, choose another path to publish on')
+    os.remove(path)
+
+
+class SampleServer:
+    """ Publishes samples to subscribers on a Unix or TCP socket.  Register the instance as a sample listener, the
+        receive thread only puts each batch on a queue.  An encoder thread frames each batch once and queues it for
+        every subscriber, a socket thread accepts subscribers and sends with non-blocking writes.  A subscriber more
+        than max_queue batches behind has its oldest batches dropped (drop-oldest) or is disconnected (disconnect).
+    """
+    def __init__(self, address:str, encoding='binary', policy=POLICY_DROP_OLDEST, max_queue=256, logger=None):
+        if encoding not in ENCODINGS:
+            raise ValueError(f'Unknown encoding {encoding}')
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown backpressure policy {policy}')
+        self.address = address
+        self.encoding = encoding
+        self.policy = policy
+        self.max_queue = max_queue
+        self._logger = logger if logger is not None else logging.getLogger(__name__)
+        self._queue = SimpleQueue()
+        self._lock = Lock()
+        self._subscribers = {}
+        self.batches_published = 0
+        self.subscribers_disconnected = 0
+        family, self._bind_address = parse_address(address)
+        if family == socket.AF_UNIX:
+            _remove_stale_socket(self._bind_address)
+        self._listener = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(self._bind_address)
+        self._listener.listen()
+        self._listener.setblocking(False)
+        self._wake_read, self._wake_write = socket.socketpair()
+        self._wake_read.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self._selector.register(self._wake_read, selectors.EVENT_READ)
+        self._closing = False
+        self._encoder_thread = Thread(target=self._encode_loop, daemon=True)
+        self._socket_thread = Thread(target=self._socket_loop, daemon=True)
+        self._encoder_thread.start()
+        self._socket_thread.start()
+        self._logger.info('%s: Publishing samples on %s', self.__class__.__name__, address)
+
+    def __call__(self, samples:list):
+        """ Sample listener - queue a batch for the subscribers """
+        self._queue.put(samples)
+
+    def _encode_loop(self):
+        """ Frame each batch once and queue it for every subscriber """
+        while True:
+            samples = self._queue.get()
+            if samples is None:
+                return
+            if len(self._subscribers) == 0:
+                continue
+            try:
+                payload = encode_batch(samples) if self.encoding == 'binary' else encode_jsonl(samples)
+            except ValueError as e:
+                self._logger.error('%s: Unable to encode batch: %s', self.__class__.__name__, e)
+                continue
+            frame = FRAME_HEADER.pack(len(payload)) + payload
+            with self._lock:
+                for subscriber in list(self._subscribers.values()):
+                    if subscriber.slow:
+                        continue
+                    if len(subscriber.frames) >= self.max_queue:
+                        if self.policy == POLICY_DISCONNECT:
+                            self._logger.warning('%s: Disconnecting slow subscriber %s', self.__class__.__name__, subscriber.address)
+                            # closed by the socket thread, even if it is blocked part way through a frame
+                            subscriber.slow = True
+                            subscriber.frames.clear()
+                            continue
+                        subscriber.frames.popleft()
+                        subscriber.frames_dropped += 1
+                    subscriber.frames.append(frame)
+                self.batches_published += 1
+            self._wake_write.send(b'\0')
+
+    def _socket_loop(self):
+        """ Accept subscribers and send the queued frames """
+        while not self._closing:
+            for key, events in self._selector.select():
+                if key.fileobj is self._listener:
+                    self._accept()
+                elif key.fileobj is self._wake_read:
+                    try:
+                        self._wake_read.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    with self._lock:
+                        subscribers = [subscriber for subscriber in self._subscribers.values() if len(subscriber.frames) > 0]
+                    for subscriber in subscribers:
+                        self._send(subscriber)
+                    with self._lock:
+                        slow = [subscriber for subscriber in self._subscribers.values() if subscriber.slow]
+                    for subscriber in slow:
+                        self._disconnect(subscriber)
+                else:
+                    subscriber = key.data
+                    if events & selectors.EVENT_READ:
+                        # subscribers don't send anything, a read only tells us the connection closed
+                        try:
+                            data = subscriber.connection.recv(4096)
+                        except OSError:
+                            data = b''
+                        if not data:
+                            self._disconnect(subscriber)
+                            continue
+                    if events & selectors.EVENT_WRITE:
+                        self._send(subscriber)
+
+    def _accept(self):
+        """ Accept a new subscriber """
+        try:
+            connection, address = self._listener.accept()
+        except (BlockingIOError, OSError):
+            return
+        connection.setblocking(False)
+        subscriber = _Subscriber(connection, address if address else self.address)
+        with self._lock:
+            self._subscribers[connection.fileno()] = subscriber
+        self._selector.register(connection, selectors.EVENT_READ, subscriber)
+        self._logger.info('%s: Subscriber connected from %s', self.__class__.__name__, subscriber.address)
+
+    def _send(self, subscriber:_Subscriber):
+        """ Send as much of the queued frames as the socket accepts, waiting for writable if it fills """
+        if subscriber.connection.fileno() not in self._subscribers:
+            return
+        while True:
+            if subscriber.sending is None or len(subscriber.sending) == 0:
+                with self._lock:
+                    frame = subscriber.frames.popleft() if len(subscriber.frames) > 0 else None
+                if frame is None:
+                    subscriber.sending = None
+                    self._selector.modify(subscriber.connection, selectors.EVENT_READ, subscriber)
+                    return
+                subscriber.sending = memoryview(frame)
+                subscriber.frames_sent += 1
+            try:
+                sent = subscriber.connection.send(subscriber.sending)
+            except BlockingIOError:
+                self._selector.modify(subscriber.connection, selectors.EVENT_READ | selectors.EVENT_WRITE, subscriber)
+                return
+            except OSError:
+                self._disconnect(subscriber)
+                return
+            subscriber.sending = subscriber.sending[sent:]
+
+    def _disconnect(self, subscriber:_Subscriber):
+        """ Close a subscriber connection """
+        with self._lock:
+            if self._subscribers.pop(subscriber.connection.fileno(), None) is None:
+                return
+        self.subscribers_disconnected += 1
+        self._selector.unregister(subscriber.connection)
+        subscriber.connection.close()
+        self._logger.info('%s: Subscriber %s disconnected', self.__class__.__name__, subscriber.address)
+
+    def subscribers(self):
+        """ Return the state of each connected subscriber """
+        with self._lock:
+            return [{'address': subscriber.address, 'queued': len(subscriber.frames), 'sent': subscriber.frames_sent,
+                     'dropped': subscriber.frames_dropped} for subscriber in self._subscribers.values()]
+
+    def close(self):
+        """ Stop publishing and disconnect the subscribers """
+        self._queue.put(None)
+        self._encoder_thread.join()
+        self._closing = True
+        self._wake_write.send(b'\0')
+        self._socket_thread.join()
+        for subscriber in list(self._subscribers.values()):
+            self._disconnect(subscriber)
+        self._selector.close()
+        self._listener.close()
+        self._wake_read.close()
+        self._wake_write.close()
+        if isinstance(self._bind_address, str):
+            try:
+                _remove_stale_socket(self._bind_address)
+            except ValueError:
+                # replaced by something else since the server started, leave it
+                pass
+
+
+class SampleSubscriber:
+    """ Client for a SampleServer using the binary encoding.  Iterating returns the samples as they are published,
+        batches() returns each published batch (list of Samples).
+
+        with SampleSubscriber('/tmp/ammeter.sock') as subscriber:
+            for sample in subscriber:
+                ...
+    """
+    def __init__(self, address:str, timeout=None):
+        family, connect_address = parse_address(address)
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(connect_address)
+        self._file = self._socket.makefile('rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def batches(self):
+        """ Yield each published batch until the server closes the connection """
+        while True:
+            header = self._file.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            length, = FRAME_HEADER.unpack(header)
+            payload = self._file.read(length)
+            if len(payload) < length:
+                return
+            yield decode_batch(payload)
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+    def close(self):
+        """ Close the connection """
+        self._file.close()
+        self._socket.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print the samples published by an ammeter capture (--publish)")
+    parser.add_argument('address', metavar='ADDRESS', help='Unix socket path or HOST:PORT the capture publishes on')
+    args = vars(parser.parse_args())
+
+    try:
+        with SampleSubscriber(args['address']) as subscriber:
+            for sample in subscriber:
+                print(f"{sample['received']:.6f} {sample['name']} {sample['ticks']} {sample['current_amps']} {sample['average']}")
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,60 @@
+"""
+Incremental line framer for the serial receive path
+"""
+
+# compact the buffer once this many consumed bytes sit at the front of it
+COMPACT_THRESHOLD = 65536
+
+
+class LineFramer:
+    """ Append-only byte buffer that splits received data into complete lines.
+        Data is appended with feed() and complete lines are consumed from a read offset, so each line costs O(1)
+        regardless of how much data is still waiting.  Consumed bytes are dropped from the front of the buffer
+        in one step once they pass COMPACT_THRESHOLD.
+    """
+    def __init__(self, delimiter=b'\n', compact_threshold=COMPACT_THRESHOLD):
+        self._buffer = bytearray()
+        self._offset = 0
+        self._delimiter = delimiter
+        self._compact_threshold = compact_threshold
+        self.bytes_received = 0
+        self.lines_framed = 0
+
+    def __len__(self):
+        """ Return the number of bytes waiting for a delimiter """
+        return len(self._buffer) - self._offset
+
+    @property
+    def pending(self):
+        """ Return a copy of the bytes not yet framed into a line """
+        return bytes(self._buffer[self._offset:])
+
+    def feed(self, data:bytes):
+        """ Append received bytes to the buffer """
+        self._buffer += data
+        self.bytes_received += len(data)
+
+    def lines(self):
+        """ Return a list of complete lines (without the delimiter or a trailing carriage return) """
+        buffer = self._buffer
+        delimiter = self._delimiter
+        offset = self._offset
+        lines = []
+        while True:
+            end = buffer.find(delimiter, offset)
+            if end == -1:
+                break
+            line_end = end - 1 if end > offset and buffer[end - 1] == 13 else end
+            lines.append(bytes(buffer[offset:line_end]))
+            offset = end + len(delimiter)
+        self.lines_framed += len(lines)
+        if offset >= self._compact_threshold or offset == len(buffer):
+            del buffer[:offset]
+            offset = 0
+        self._offset = offset
+        return lines
+
+    def clear(self):
+        """ Drop any buffered data """
+        self._buffer.clear()
+        self._offset = 0
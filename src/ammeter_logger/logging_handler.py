@@ -4,6 +4,9 @@ from glob import glob
 from datetime import datetime, timedelta
 import pathlib
 import os
+import atexit
+from queue import SimpleQueue
+from time import monotonic
 
 SYSLOG_SEVERITIES = [
     'EMERGENCY',
@@ -32,18 +35,65 @@ log_level = {
 }
 
 
+class RateLimitFilter(logging.Filter):
+    """ Limits each message class (logger and message format string) at or below max_level to per_second messages
+        with bursts of up to burst, or with sample_every set passes only every Nth message of the class instead.
+        The number of messages dropped since the last one passed is added to the record as 'suppressed' and to
+        the message text, so the filter should be added to the logger (it runs once per record) rather than to
+        each handler.
+    """
+    def __init__(self, per_second=10.0, burst=20, max_level=logging.DEBUG, sample_every=0):
+        super().__init__()
+        self.per_second = per_second
+        self.burst = burst
+        self.max_level = max_level
+        self.sample_every = sample_every
+        self._classes = {}
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        key = (record.name, record.msg)
+        state = self._classes.get(key)
+        now = monotonic()
+        if state is None:
+            state = self._classes[key] = [float(self.burst), now, 0, 0]
+        if self.sample_every > 0:
+            state[3] += 1
+            allowed = state[3] % self.sample_every == 1 or self.sample_every == 1
+        else:
+            state[0] = min(float(self.burst), state[0] + (now - state[1]) * self.per_second)
+            state[1] = now
+            allowed = state[0] >= 1
+            if allowed:
+                state[0] -= 1
+        if not allowed:
+            state[2] += 1
+            return False
+        record.suppressed = state[2]
+        if state[2] > 0:
+            record.msg = f'{record.msg} ({state[2]} similar messages suppressed)'
+            state[2] = 0
+        return True
+
+
 def create_logger(log_file='', file_level='WARNING', console_level='WARNING', name='', file_mode='a', console=True,
-                  syslog=False, syslog_script_name='', log_file_vars=[], log_file_retention_days=0, propagate=False):
+                  syslog=False, syslog_script_name='', log_file_vars=[], log_file_retention_days=0, propagate=False,
+                  queue=False, rate_limit=0, rate_limit_burst=20, sample_every=0):
     """ Creates a logger and returns the handle.
         Log file vars should be sent as a dict -> {"var": "{date}", "set": "%Y-%m-%d-%Y-%M"}
 
         Supported log file vars:
             {date} - will be replaced with the current date using the provided strftime format
-    
+
+        The logger level is set to the lowest handler level, so logger.isEnabledFor() can be used to skip building
+        messages nobody will see.  With queue=True the handlers run on a QueueListener thread and logging calls
+        only enqueue the record (the listener is stopped at exit, or with logger.queue_listener.stop()).
+        rate_limit (messages per second) or sample_every (pass every Nth message) limit each DEBUG message class.
      """
     logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
     logger.propagate = propagate
+    handlers = []
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
     # Console
@@ -51,7 +101,7 @@ def create_logger(log_file='', file_level='WARNING', console_level='WARNING', na
         console_handler = logging.StreamHandler()
         console_handler.setLevel(log_level.get(console_level.upper(), logging.WARNING))
         console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
+        handlers.append(console_handler)
 
     # syslog
     if syslog:
@@ -59,7 +109,7 @@ def create_logger(log_file='', file_level='WARNING', console_level='WARNING', na
         syslog_handler = logging.handlers.SysLogHandler(address='/dev/log')
         syslog_handler.setLevel(log_level.get(file_level.upper(), logging.WARNING))
         syslog_handler.setFormatter(syslog_formatter)
-        logger.addHandler(syslog_handler)
+        handlers.append(syslog_handler)
 
     # file
     if log_file != '':
@@ -70,22 +120,38 @@ def create_logger(log_file='', file_level='WARNING', console_level='WARNING', na
         file_handler = logging.FileHandler(log_file, mode=file_mode, encoding='utf-8', delay=False)
         file_handler.setLevel(log_level.get(file_level.upper(), logging.WARNING))
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
-
-        # manage retention
-        if log_file_retention_days > 0:
-            # replace variables with a *
-            log_file_search_name = log_file
-            for var in log_file_vars:
-                log_file_search_name.replace(var['var'], '*')
-            old_log_files = glob(log_file_search_name)
-            for old_log_file in old_log_files:
-                # check the age and delete if needed
-                fname = pathlib.Path(old_log_file)
-                mtime = datetime.fromtimestamp(fname.stat().st_mtime)
-                if mtime < datetime.now() - timedelta(days=log_file_retention_days):
-                    logger.info('Deleting old log file %s.  Modified time %s, retention set to %i days.', old_log_file, mtime, log_file_retention_days)
-                    os.remove(old_log_file)
+        handlers.append(file_handler)
+
+    # only create records for the levels a handler will output
+    logger.setLevel(min(handler.level for handler in handlers) if len(handlers) > 0 else logging.DEBUG)
+
+    # attach the handlers directly, or through a queue so the calling thread never waits on the output
+    if queue and len(handlers) > 0:
+        log_queue = SimpleQueue()
+        logger.queue_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        logger.queue_listener.start()
+        handlers = [logging.handlers.QueueHandler(log_queue)]
+        atexit.register(logger.queue_listener.stop)
+    if rate_limit > 0 or sample_every > 0:
+        # on the logger so each record is counted (and its message changed) once, whatever the number of handlers
+        logger.addFilter(RateLimitFilter(per_second=rate_limit, burst=rate_limit_burst, sample_every=sample_every))
+    for handler in handlers:
+        logger.addHandler(handler)
+
+    # manage retention of the log files
+    if log_file != '' and log_file_retention_days > 0:
+        # replace variables with a *
+        log_file_search_name = log_file
+        for var in log_file_vars:
+            log_file_search_name.replace(var['var'], '*')
+        old_log_files = glob(log_file_search_name)
+        for old_log_file in old_log_files:
+            # check the age and delete if needed
+            fname = pathlib.Path(old_log_file)
+            mtime = datetime.fromtimestamp(fname.stat().st_mtime)
+            if mtime < datetime.now() - timedelta(days=log_file_retention_days):
+                logger.info('Deleting old log file %s.  Modified time %s, retention set to %i days.', old_log_file, mtime, log_file_retention_days)
+                os.remove(old_log_file)
 
     # return the logger
     return logger
@@ -0,0 +1,224 @@
+"""
+Receive pipeline metrics - counters, gauges and histograms with Prometheus text file and JSON lines export
+"""
+import os
+import json
+import logging
+from bisect import bisect_left
+from threading import Thread, Event
+from time import time
+
+# histogram bucket upper bounds for durations (seconds), 1us to 10s
+TIME_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1,
+                0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# histogram bucket upper bounds for sizes (i.e. lines per read)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384)
+
+
+class Counter:
+    """ Monotonic counter.  Updated from a single thread (the receive thread) so no lock is taken.  If function is
+        set the value is read from it when collected instead, for counts already kept elsewhere.
+    """
+    type = 'counter'
+
+    def __init__(self, name:str, help_text:str, function=None):
+        self.name = name
+        self.help = help_text
+        self._function = function
+        self._value = 0
+
+    def inc(self, amount=1):
+        """ Add to the counter """
+        self._value += amount
+
+    @property
+    def value(self):
+        """ Return the current value """
+        return self._function() if self._function is not None else self._value
+
+
+class Gauge(Counter):
+    """ Value that can go up and down, set directly or read from function when collected """
+    type = 'gauge'
+
+    def set(self, value):
+        """ Set the gauge """
+        self._value = value
+
+
+class Histogram:
+    """ Fixed bucket histogram.  observe() is a bisect and three additions, bucket counts are made cumulative when
+        collected.
+    """
+    type = 'histogram'
+
+    def __init__(self, name:str, help_text:str, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Add an observation """
+        self._counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @property
+    def value(self):
+        """ Return {'buckets': [(upper bound, cumulative count)...], 'sum', 'count'} """
+        cumulative, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self._counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+    def quantile(self, fraction:float):
+        """ Return the upper bound of the bucket holding the fraction (0-1) of the observations """
+        if self.count == 0:
+            return None
+        target = fraction * self.count
+        for bound, count in self.value['buckets']:
+            if count >= target:
+                return bound
+        return None
+
+
+class MetricsRegistry:
+    """ Set of metrics for one receiver, labels (i.e. {'port': '/dev/ttyUSB0'}) are added to every exported sample """
+    def __init__(self, labels=None):
+        self.labels = labels if labels is not None else {}
+        self._metrics = {}
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name:str, help_text:str, function=None):
+        """ Add and return a Counter """
+        return self._add(Counter(name, help_text, function))
+
+    def gauge(self, name:str, help_text:str, function=None):
+        """ Add and return a Gauge """
+        return self._add(Gauge(name, help_text, function))
+
+    def histogram(self, name:str, help_text:str, buckets=TIME_BUCKETS):
+        """ Add and return a Histogram """
+        return self._add(Histogram(name, help_text, buckets))
+
+    def __getitem__(self, name:str):
+        return self._metrics[name]
+
+    def __iter__(self):
+        return iter(self._metrics.values())
+
+    def collect(self):
+        """ Return {name: value} of every metric """
+        return {metric.name: metric.value for metric in self._metrics.values()}
+
+
+def _label_str(labels:dict, extra=None):
+    """ Return the Prometheus label set for the labels """
+    items = list(labels.items()) + (list(extra.items()) if extra is not None else [])
+    if len(items) == 0:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in items]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def _format_value(value):
+    """ Return a Prometheus sample value """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def prometheus_text(registries:list):
+    """ Return the metrics of the registries in the Prometheus text exposition format """
+    metrics = {}
+    for registry in registries:
+        for metric in registry:
+            metrics.setdefault(metric.name, []).append((registry.labels, metric))
+    lines = []
+    for name, entries in metrics.items():
+        lines.append(f'# HELP {name} {entries[0][1].help}')
+        lines.append(f'# TYPE {name} {entries[0][1].type}')
+        for labels, metric in entries:
+            value = metric.value
+            if metric.type == 'histogram':
+                for bound, count in value['buckets']:
+                    lines.append(f'{name}_bucket{_label_str(labels, {"le": _format_value(bound)})} {count}')
+                lines.append(f'{name}_sum{_label_str(labels)} {_format_value(value["sum"])}')
+                lines.append(f'{name}_count{_label_str(labels)} {value["count"]}')
+            else:
+                lines.append(f'{name}{_label_str(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def json_line(registries:list, previous=None):
+    """ Return a JSON line with the time and the metrics of each registry.  If previous (the dict returned by the
+        last call) is given, per second rates of the counters are included.
+    """
+    now = time()
+    record = {'time': now, 'registries': []}
+    for x, registry in enumerate(registries):
+        values = registry.collect()
+        for metric in registry:
+            if metric.type == 'histogram':
+                # JSON has no infinity, the last bucket bound is written as in the Prometheus format
+                values[metric.name]['buckets'] = [(_format_value(bound), count) for bound, count in values[metric.name]['buckets']]
+        entry = {'labels': registry.labels, 'metrics': values}
+        if previous is not None and x < len(previous['registries']):
+            elapsed = now - previous['time']
+            last = previous['registries'][x]['metrics']
+            entry['rates'] = {metric.name: (values[metric.name] - last[metric.name]) / elapsed
+                              for metric in registry if metric.type == 'counter' and metric.name in last and elapsed > 0}
+        record['registries'].append(entry)
+    return record
+
+
+class MetricsExporter:
+    """ Background thread writing the metrics every interval seconds, either as a Prometheus text file (replaced
+        atomically, for the node_exporter textfile collector) or appended as JSON lines
+    """
+    def __init__(self, registries:list, file_name:str, output_format='prometheus', interval=10.0, logger=None):
+        if output_format not in ('prometheus', 'json'):
+            raise ValueError(f'Unknown metrics format {output_format}')
+        self.registries = registries
+        self.file_name = file_name
+        self.output_format = output_format
+        self.interval = interval
+        self._logger = logger if logger is not None else logging.getLogger(__name__)
+        self._previous = None
+        self._closing = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        """ Write the metrics until closed """
+        while not self._closing.wait(self.interval):
+            self.write()
+
+    def write(self):
+        """ Write the current metrics """
+        try:
+            if self.output_format == 'prometheus':
+                temp_file = f'{self.file_name}.tmp'
+                with open(temp_file, 'w', encoding='utf-8') as output_file:
+                    output_file.write(prometheus_text(self.registries))
+                os.replace(temp_file, self.file_name)
+            else:
+                record = json_line(self.registries, self._previous)
+                with open(self.file_name, 'a', encoding='utf-8') as output_file:
+                    output_file.write(json.dumps(record) + '\n')
+                self._previous = record
+        except OSError as e:
+            self._logger.error('%s: Error writing metrics to %s: %s', self.__class__.__name__, self.file_name, e)
+
+    def close(self):
+        """ Stop the thread and write the final metrics """
+        self._closing.set()
+        self._thread.join()
+        self.write()
@@ -0,0 +1,218 @@
+"""
+Concurrent capture from several Micropython ammeters with a time aligned, merged output
+"""
+import os
+import csv
+import heapq
+import logging
+from time import time, perf_counter
+from collections import deque
+from threading import Lock
+from .ammeter_recv import AmmeterRecvSerial
+from .ammeter_core import STATE_RUNNING, COMMAND_TIMEOUT
+from .spool import csv_header, csv_row
+from .stats import StatsEngine
+
+
+def merge_key(item:tuple):
+    """ Sort key for a (device, sample) pair - received time, then the device ticks """
+    return item[1]['received'], item[1]['ticks']
+
+
+def _tag_samples(device:str, samples):
+    """ Yield (device, sample) for each sample """
+    for sample in samples:
+        yield device, sample
+
+
+def merge_samples(streams:dict):
+    """ Streaming k-way merge of per device sample streams ({device: iterable of samples, each in received order}).
+        Yields (device, sample) in time order without loading the streams.
+    """
+    return heapq.merge(*(_tag_samples(device, samples) for device, samples in streams.items()), key=merge_key)
+
+
+class MergedCsvSink:
+    """ Writes (device, sample) pairs to a CSV file with a leading device column.  Has the sink interface so it can
+        be used with a SpoolWriter for a streaming capture.
+    """
+    def __init__(self, file_name:str):
+        self.file_name = file_name
+        self._file = open(file_name, 'w', encoding='utf-8', newline='')
+        self._writer = csv.writer(self._file)
+        self._header_written = False
+        self.rows_written = 0
+
+    def set_run_info(self, config=None, start=None, stop=None):
+        """ CSV output doesn't carry the run information """
+
+    def write_samples(self, items):
+        """ Write an iterable of (device, sample) pairs """
+        for device, sample in items:
+            if not self._header_written:
+                self._writer.writerow(['device'] + csv_header(len(sample['last_reads'])))
+                self._header_written = True
+            self._writer.writerow([device] + csv_row(sample))
+            self.rows_written += 1
+
+    def flush(self):
+        """ Flush buffered rows to the OS """
+        self._file.flush()
+
+    def fsync(self):
+        """ Flush and force the written rows to disk """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """ Close the output file """
+        if not self._file.closed:
+            self.fsync()
+            self._file.close()
+
+
+class StreamingMerger:
+    """ Merges live sample batches from several devices in time order while the capture runs.  A sample is only
+        released once every device has reported a later sample (or finished), so the output stays ordered without
+        holding the whole run.  Register listener(device) with each device, merged batches are passed to output.
+        A device that stops sending holds back the others until finish() is called for it, register
+        state_listener(device) with each device to finish it when its run ends.
+    """
+    def __init__(self, devices:list, output):
+        self._output = output
+        self._lock = Lock()
+        self._queues = {device: deque() for device in devices}
+        self._finished = set()
+
+    def listener(self, device:str):
+        """ Return the sample listener for a device """
+        def _listener(samples:list):
+            with self._lock:
+                self._queues[device].extend((device, sample) for sample in samples)
+                self._release()
+        return _listener
+
+    def state_listener(self, device:str):
+        """ Return the run state listener for a device, which finishes the device when its run ends.  The core passes
+            the last samples of the run to the sample listeners before the state listeners.
+        """
+        def _state_listener(old_state:str, new_state:str):
+            if old_state == STATE_RUNNING and new_state != STATE_RUNNING:
+                self.finish(device)
+        return _state_listener
+
+    def _release(self, flush=False):
+        """ Pass every sample up to the watermark (earliest latest sample of the active devices) to the output """
+        active = [queue for device, queue in self._queues.items() if device not in self._finished]
+        # the last samples of a device can arrive after it finished
+        flush = flush or len(active) == 0
+        if not flush and any(len(queue) == 0 for queue in active):
+            return
+        watermark = None if flush else min(merge_key(queue[-1]) for queue in active)
+        merged = []
+        heads = [(merge_key(queue[0]), device) for device, queue in self._queues.items() if len(queue) > 0]
+        heapq.heapify(heads)
+        while len(heads) > 0 and (watermark is None or heads[0][0] <= watermark):
+            _, device = heapq.heappop(heads)
+            queue = self._queues[device]
+            merged.append(queue.popleft())
+            if len(queue) > 0:
+                heapq.heappush(heads, (merge_key(queue[0]), device))
+        if len(merged) > 0:
+            self._output(merged)
+
+    def finish(self, device=None):
+        """ Mark a device (or all devices) as finished and release what can be released """
+        with self._lock:
+            if device is None:
+                self._finished = set(self._queues)
+                self._release(flush=True)
+            else:
+                self._finished.add(device)
+                self._release(flush=len(self._finished) == len(self._queues))
+
+
+class MultiAmmeterCapture:
+    """ Runs a capture on several ammeters at the same time.  Each device has its own receive thread, commands are
+        sent to every device before waiting on any of them so the runs start together.
+    """
+    def __init__(self, devices:list, baudrate=115200, logger=None, keep_samples=True):
+        self._logger = logger if logger is not None else logging
+        self.devices = {device: AmmeterRecvSerial(device, baudrate=baudrate, logger=self._logger, keep_samples=keep_samples)
+                        for device in devices}
+        self.stats = {device: StatsEngine() for device in devices}
+        for device, ammeter in self.devices.items():
+            ammeter.add_sample_listener(self.stats[device])
+
+    def _all(self, command:str, response:str):
+        """ Send a command to every device, then wait for each response.  Returns {device: response or None} """
+        futures = {device: ammeter.ammeter_command(command, response) for device, ammeter in self.devices.items()}
+        return {device: self.devices[device].ammeter_wait(future) for device, future in futures.items()}
+
+    def session(self, cache=None, timeout=COMMAND_TIMEOUT):
+        """ Set up a session on every device (see AmmeterRecvSerial.ammeter_session), the requests are all sent
+            before waiting so the whole setup takes one round trip.  Returns {device: session}
+        """
+        start = perf_counter()
+        requests = {}
+        for device, ammeter in self.devices.items():
+            if cache is not None:
+                ammeter.ammeter_attach_cache(cache, cache.key(device))
+            requests[device] = ammeter.ammeter_session_request()
+        sessions = {}
+        for device, (config, status_future, config_future) in requests.items():
+            ammeter = self.devices[device]
+            status = ammeter.ammeter_wait(status_future, {}, max(0.0, start + timeout - perf_counter()))
+            if config_future is not None:
+                config = ammeter.ammeter_wait(config_future, {}, max(0.0, start + timeout - perf_counter()))
+            sessions[device] = {'status': status, 'config': config, 'cached': config_future is None,
+                                'seconds': perf_counter() - start}
+        return sessions
+
+    def status(self):
+        """ Return {device: status} """
+        return {device: status if status is not None else {} for device, status in self._all('STATUS', 'STATUS').items()}
+
+    def config(self):
+        """ Return {device: config} """
+        return {device: config if config is not None else {} for device, config in self._all('CONFIG', 'CONFIG').items()}
+
+    def start(self, timeout=None):
+        """ Start all devices together, returns {device: True/False} """
+        started = self._all(f"START{(':' + str(timeout)) if timeout is not None else ''}", 'START')
+        return {device: value is not None or self.devices[device].ammeter_running for device, value in started.items()}
+
+    def stop(self):
+        """ Stop all devices, returns {device: True/False} """
+        stopped = self._all('STOP', 'STOP')
+        return {device: value is not None or not self.devices[device].ammeter_running for device, value in stopped.items()}
+
+    def wait(self, timeout=None):
+        """ Wait for every device to send STOP, returns True if all stopped within the timeout """
+        end_time = None if timeout is None else time() + timeout
+        for ammeter in self.devices.values():
+            if not ammeter.ammeter_wait_complete(None if end_time is None else max(0, end_time - time())):
+                return False
+        return True
+
+    def add_sample_listener(self, device:str, callback):
+        """ Register a sample listener on one device """
+        self.devices[device].add_sample_listener(callback)
+
+    def merged_samples(self):
+        """ Yield (device, sample) for the stored samples of all devices in time order """
+        return merge_samples({device: ammeter.ammeter_data for device, ammeter in self.devices.items()})
+
+    def summary(self):
+        """ Return a per device summary of the run, {device: {'samples', 'start', 'stop', 'channels'}} where channels
+            is the StatsEngine snapshot of the device
+        """
+        summary = {}
+        for device, ammeter in self.devices.items():
+            summary[device] = {
+                'samples': ammeter.ammeter_sample_count,
+                'start': ammeter.ammeter_start_time,
+                'stop': ammeter.ammeter_stop_time,
+                'channels': self.stats[device].snapshot()
+            }
+        return summary
@@ -0,0 +1,140 @@
+"""
+Parser for the lines sent by the Micropython ammeter
+
+    DATA:{name}:{ticks}:{current_amps}:[{read}, {read}, ...]:{average}
+    START:{ticks}
+    STOP:{ticks}
+    CONFIG:{interval}:{timeout}:{init_timeout}:{pin}:{name}:{baseline}[:{pin}:{name}:{baseline}...]
+    STATUS:{status}[:{value}]
+"""
+from ast import literal_eval
+
+
+class ProtocolError(ValueError):
+    """ Raised when a line matches a record type but can't be parsed """
+
+
+def parse_last_reads(text:str):
+    """ Parse the last_reads list.  Numeric lists are split directly, anything else falls back to literal_eval """
+    if text[:1] == '[' and text[-1:] == ']':
+        body = text[1:-1]
+        if body.strip() == '':
+            return []
+        try:
+            return [float(x) for x in body.split(',')]
+        except ValueError:
+            pass
+    try:
+        value = literal_eval(text)
+    except (ValueError, SyntaxError) as e:
+        raise ProtocolError(f'Invalid last_reads list {text!r}') from e
+    if not isinstance(value, (list, tuple)):
+        raise ProtocolError(f'Invalid last_reads list {text!r}')
+    return list(value)
+
+
+def _check_fields(response:list, expected:int, minimum=False):
+    """ Raise a ProtocolError if the record doesn't have the expected number of fields """
+    if len(response) < expected if minimum else len(response) != expected:
+        raise ProtocolError(f"Invalid number of fields in {response[0]} Transmission.  Received {len(response)}, "
+                            f"expected {'>=' if minimum else ''}{expected}")
+
+
+def parse_data(response:list):
+    """ Parse a DATA record, returns (name, ticks, current_amps, last_reads, average) """
+    _check_fields(response, 6)
+    try:
+        return response[1], int(response[2]), float(response[3]), parse_last_reads(response[4]), float(response[5])
+    except ValueError as e:
+        if isinstance(e, ProtocolError):
+            raise
+        raise ProtocolError(f'Invalid value in DATA Transmission: {e}') from e
+
+
+def parse_ticks(response:list):
+    """ Parse a START or STOP record, returns the reported ticks """
+    _check_fields(response, 2)
+    try:
+        return int(response[1])
+    except ValueError as e:
+        raise ProtocolError(f'Invalid value in {response[0]} Transmission: {e}') from e
+
+
+def parse_config(response:list):
+    """ Parse a CONFIG record, returns the config dict """
+    _check_fields(response, 7, minimum=True)
+    try:
+        config = {
+            'interval': int(response[1]),
+            'timeout': int(response[2]),
+            'init_timeout': int(response[3]),
+            'pins': []
+        }
+        for x in range(4, len(response) - 2, 3):
+            config['pins'].append({
+                'pin': int(response[x]),
+                'name': response[x + 1],
+                'baseline': int(response[x + 2])
+            })
+    except ValueError as e:
+        raise ProtocolError(f'Invalid value in CONFIG Transmission: {e}') from e
+    return config
+
+
+def parse_status(response:list):
+    """ Parse a STATUS record, returns the status dict """
+    _check_fields(response, 2, minimum=True)
+    value = response[2] if len(response) > 2 else None
+    return {
+        'status': response[1],
+        'timeout': value if response[1] == 'INITIALIZING' or response[1] == 'RUNNING' else 0,
+        'noinit_pin': value if response[1] == 'NOINIT' else None
+    }
+
+
+# record type -> parser
+PARSERS = {
+    'DATA': parse_data,
+    'START': parse_ticks,
+    'STOP': parse_ticks,
+    'CONFIG': parse_config,
+    'STATUS': parse_status
+}
+
+
+def parse_line(line):
+    """ Parse a line (str or bytes, without the newline).  Returns (record_type, value), (None, None) for a blank
+        line, or raises a ProtocolError for an unknown or invalid record.
+    """
+    if isinstance(line, (bytes, bytearray)):
+        line = line.decode('utf-8', errors='replace')
+    if line == '':
+        return None, None
+    response = line.split(':')
+    parser = PARSERS.get(response[0])
+    if parser is None:
+        raise ProtocolError(f'Unknown record {line!r}')
+    return response[0], parser(response)
+
+
+def parse_lines(lines):
+    """ Parse a batch of lines in one call.  Returns a list of (record_type, value), invalid lines are returned as
+        ('ERROR', ProtocolError) so the caller can log them in order.  Blank lines are skipped.
+    """
+    results = []
+    append = results.append
+    for line in lines:
+        if isinstance(line, (bytes, bytearray)):
+            line = line.decode('utf-8', errors='replace')
+        if line == '':
+            continue
+        response = line.split(':')
+        record_type = response[0]
+        parser = PARSERS.get(record_type)
+        try:
+            if parser is None:
+                raise ProtocolError(f'Unknown record {line!r}')
+            append((record_type, parser(response)))
+        except ProtocolError as e:
+            append(('ERROR', e))
+    return results
@@ -0,0 +1,203 @@
+"""
+Compact columnar storage for the samples received from the Micropython ammeter
+"""
+from array import array
+from collections import namedtuple
+
+# number of rows allocated per chunk.  Chunks are allocated at full size and never resized, so views handed out to
+# consumers stay valid while the receive thread keeps appending
+CHUNK_SIZE = 16384
+
+SAMPLE_FIELDS = ('received', 'name', 'ticks', 'current_amps', 'last_reads', 'average')
+
+# typecodes of the numeric columns (buffer protocol compatible, i.e. numpy.frombuffer(view, dtype=...))
+COLUMN_TYPES = {
+    'received': 'd',
+    'ticks': 'q',
+    'current_amps': 'd',
+    'average': 'd',
+    'name': 'H'
+}
+
+
+class Sample(namedtuple('Sample', SAMPLE_FIELDS)):
+    """ A single sample.  Supports attribute, index and dict style access (sample['average']) """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        """ Return the field value or the default if the field doesn't exist """
+        return getattr(self, key, default) if isinstance(key, str) else default
+
+    def keys(self):
+        """ Return the field names """
+        return self._fields
+
+    def values(self):
+        """ Return the field values """
+        return tuple(self)
+
+    def items(self):
+        """ Return (field, value) pairs """
+        return zip(self._fields, self)
+
+
+class _Chunk:
+    """ Fixed size block of columns """
+    __slots__ = ('columns', 'last_reads', 'count')
+
+    def __init__(self, last_reads_width:int):
+        self.columns = {column: array(typecode, bytes(array(typecode).itemsize * CHUNK_SIZE))
+                        for column, typecode in COLUMN_TYPES.items()}
+        self.last_reads = array('d', bytes(8 * CHUNK_SIZE * last_reads_width))
+        self.count = 0
+
+
+class SampleStore:
+    """ Columnar store of received samples.
+        Numeric fields are kept in typed arrays, the last_reads lists in a fixed width 2-D block and channel names are
+        interned to a small integer index.  Indexing returns a Sample row so callers can keep using the dict style
+        access of the previous list of dicts (store[0]['average']).  Not thread safe, the owner is expected to hold
+        its own lock while appending.
+    """
+    def __init__(self, last_reads_width=None):
+        self._last_reads_width = last_reads_width
+        self._chunks = []
+        self._count = 0
+        self.names = []
+        self._name_index = {}
+
+    def __len__(self):
+        return self._count
+
+    def __bool__(self):
+        return self._count > 0
+
+    @property
+    def last_reads_width(self):
+        """ Return the number of values stored per last_reads row (None until the first sample) """
+        return self._last_reads_width
+
+    def _intern(self, name:str):
+        """ Return the index for a channel name, adding it if needed """
+        index = self._name_index.get(name)
+        if index is None:
+            index = len(self.names)
+            self.names.append(name)
+            self._name_index[name] = index
+        return index
+
+    def append(self, received:float, name:str, ticks:int, current_amps:float, last_reads:list, average:float):
+        """ Append a sample to the store """
+        if self._last_reads_width is None:
+            self._last_reads_width = len(last_reads)
+        width = self._last_reads_width
+        if len(last_reads) != width:
+            raise ValueError(f'last_reads has {len(last_reads)} values, store width is {width}')
+        if not self._chunks or self._chunks[-1].count == CHUNK_SIZE:
+            self._chunks.append(_Chunk(width))
+        chunk = self._chunks[-1]
+        row = chunk.count
+        columns = chunk.columns
+        columns['received'][row] = received
+        columns['name'][row] = self._intern(name)
+        columns['ticks'][row] = ticks
+        columns['current_amps'][row] = current_amps
+        columns['average'][row] = average
+        chunk.last_reads[row * width:(row + 1) * width] = array('d', last_reads)
+        chunk.count = row + 1
+        self._count += 1
+
+    def append_sample(self, sample:Sample):
+        """ Append a Sample (or any sequence in SAMPLE_FIELDS order) to the store """
+        self.append(*sample)
+
+    def extend(self, samples):
+        """ Append an iterable of samples """
+        for sample in samples:
+            self.append(*sample)
+
+    def clear(self):
+        """ Remove all samples.  Existing views keep referencing the old chunks """
+        self._chunks = []
+        self._count = 0
+        self.names = []
+        self._name_index = {}
+        self._last_reads_width = None
+
+    def _row(self, chunk:_Chunk, row:int):
+        """ Build a Sample from a row of a chunk """
+        columns = chunk.columns
+        width = self._last_reads_width
+        return Sample(
+            columns['received'][row],
+            self.names[columns['name'][row]],
+            columns['ticks'][row],
+            columns['current_amps'][row],
+            chunk.last_reads[row * width:(row + 1) * width].tolist(),
+            columns['average'][row])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[x] for x in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if index < 0 or index >= self._count:
+            raise IndexError('sample index out of range')
+        return self._row(self._chunks[index // CHUNK_SIZE], index % CHUNK_SIZE)
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            for row in range(chunk.count):
+                yield self._row(chunk, row)
+
+    def column_views(self, column:str):
+        """ Return a list of zero-copy memoryviews (one per chunk) of a column.  'last_reads' views are 2-D
+            (rows x last_reads_width).  Views stay valid while the store keeps appending.
+        """
+        views = []
+        for chunk in self._chunks:
+            if column == 'last_reads':
+                width = self._last_reads_width
+                if width == 0:
+                    continue
+                views.append(memoryview(chunk.last_reads)[:chunk.count * width].cast('B').cast('d', [chunk.count, width]))
+            else:
+                views.append(memoryview(chunk.columns[column])[:chunk.count])
+        return views
+
+    def snapshot(self):
+        """ Return a StoreSnapshot of the samples stored so far, take it while holding the owner's lock """
+        return StoreSnapshot(self)
+
+    def column(self, column:str):
+        """ Return a contiguous copy of a column as an array (last_reads is flattened row by row) """
+        output = array('d' if column == 'last_reads' else COLUMN_TYPES[column])
+        for view in self.column_views(column):
+            output.frombytes(view.tobytes() if view.ndim > 1 else view.cast('B'))
+        return output
+
+
+class StoreSnapshot:
+    """ Read only view of the samples in a SampleStore when the snapshot was taken.  Holds the column views (no data
+        is copied) so it can be read without the owner's lock while the store keeps appending or is cleared.
+    """
+    def __init__(self, store:SampleStore):
+        self.names = list(store.names)
+        self.last_reads_width = store.last_reads_width
+        self._count = len(store)
+        self._views = {column: store.column_views(column) for column in tuple(COLUMN_TYPES) + ('last_reads',)}
+
+    def __len__(self):
+        return self._count
+
+    def column_views(self, column:str):
+        """ Return the memoryviews (one per chunk) of a column, as SampleStore.column_views() """
+        return list(self._views[column])
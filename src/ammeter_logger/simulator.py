@@ -0,0 +1,213 @@
+"""
+Simulated Micropython ammeter on a pseudo terminal, for testing and benchmarking without a board
+
+    python3 -m ammeter_logger.simulator [--rate RATE] [--channels CHANNELS] [--reads READS]
+"""
+import os
+import tty
+import argparse
+from array import array
+from threading import Thread, Lock, Event
+from time import time, sleep, monotonic
+
+# number of DATA lines written to the pty in one call when emitting at an unlimited rate
+BURST_LINES = 256
+
+
+class AmmeterSimulator:
+    """ Implements the firmware side of the serial protocol (CMD:INIT/START/STOP/STATUS/CONFIG/ONE/INTERVAL) on a
+        pty.  Open the simulator and point AmmeterRecvSerial at simulator.port.  DATA lines are emitted at rate lines
+        per second (0 for as fast as the pty accepts them), cycling through channels with reads last_reads values.
+        Set record_send_times to keep the time each DATA line was written (send_times) for latency measurements, and
+        max_lines to end each run after that many DATA lines.  latency (seconds) delays the handling of each read
+        from the pty, like the latency timer of a USB serial adapter - commands arriving in one write share it.
+    """
+    def __init__(self, rate=100.0, channels=1, reads=10, timeout=60, init_timeout=2, init_time=0.5,
+                 initialized=True, record_send_times=False, max_lines=None, latency=0.0):
+        self.rate = rate
+        self.max_lines = max_lines
+        self.latency = latency
+        self.channels = channels
+        self.reads = reads
+        self.timeout = timeout
+        self.init_timeout = init_timeout
+        self.init_time = init_time
+        self.status = 'READY' if initialized else 'NOINIT'
+        self.record_send_times = record_send_times
+        self.send_times = array('d')
+        self.lines_sent = 0
+        self.commands_received = 0
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._write_lock = Lock()
+        self._stop_run = Event()
+        self._run_thread = None
+        self._command_thread = None
+        self._closed = Event()
+        self._start_ticks = monotonic()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def ticks(self):
+        """ Milliseconds since the simulator was created, like time.ticks_ms() on the board """
+        return int((monotonic() - self._start_ticks) * 1000)
+
+    @property
+    def interval(self):
+        """ Sampling interval in ms for the configured rate """
+        return int(1000 / self.rate) if self.rate > 0 else 0
+
+    def open(self):
+        """ Create the pty and start answering commands """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._closed.clear()
+        self._command_thread = Thread(target=self._command_loop, daemon=True)
+        self._command_thread.start()
+
+    def close(self):
+        """ Stop any run and close the pty """
+        self._stop_run.set()
+        self._closed.set()
+        if self._run_thread is not None:
+            self._run_thread.join()
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._master, self._slave = None, None
+
+    def _send(self, data:bytes):
+        """ Write to the pty """
+        with self._write_lock:
+            view = memoryview(data)
+            while len(view) > 0:
+                view = view[os.write(self._master, view):]
+
+    def _config_line(self):
+        """ Return the CONFIG response """
+        pins = ''.join(f':{26 + x}:ch{x}:{1000 + x}' for x in range(self.channels))
+        return f'CONFIG:{self.interval}:{self.timeout}:{self.init_timeout}{pins}\n'
+
+    def _status_line(self):
+        """ Return the STATUS response """
+        if self.status == 'RUNNING':
+            return f'STATUS:RUNNING:{self.timeout}\n'
+        if self.status == 'INITIALIZING':
+            return f'STATUS:INITIALIZING:{self.init_timeout}\n'
+        if self.status == 'NOINIT':
+            return 'STATUS:NOINIT:26\n'
+        return f'STATUS:{self.status}\n'
+
+    def _data_line(self, index:int):
+        """ Return a DATA line for the sample number """
+        values = [round(0.1 + ((index + x) % 17) * 0.01, 4) for x in range(self.reads)]
+        average = round(sum(values) / len(values), 6) if len(values) > 0 else 0.0
+        return f'DATA:ch{index % self.channels}:{self.ticks}:{values[-1] if len(values) > 0 else 0.0}:{values}:{average}\n'
+
+    def _command_loop(self):
+        """ Read and answer commands until closed """
+        buffer = b''
+        while not self._closed.is_set():
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            if self.latency > 0:
+                sleep(self.latency)
+            buffer += data
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                self._command(line.decode('utf-8', errors='replace').strip())
+
+    def _command(self, command:str):
+        """ Handle one command line """
+        self.commands_received += 1
+        fields = command.split(':')
+        if fields[0] != 'CMD' or len(fields) < 2:
+            return
+        if fields[1] == 'STATUS':
+            self._send(self._status_line().encode())
+        elif fields[1] == 'CONFIG':
+            self._send(self._config_line().encode())
+        elif fields[1] == 'INTERVAL' and len(fields) > 2:
+            self.rate = 1000 / int(fields[2]) if int(fields[2]) > 0 else 0
+        elif fields[1] == 'INIT' and self.status != 'RUNNING':
+            self.status = 'INITIALIZING'
+            Thread(target=self._initialize, daemon=True).start()
+        elif fields[1] == 'START' and self.status == 'READY':
+            run_time = int(fields[2]) if len(fields) > 2 else self.timeout
+            self.status = 'RUNNING'
+            self._stop_run.clear()
+            self._send(f'START:{self.ticks}\n'.encode())
+            self._run_thread = Thread(target=self._run, args=(run_time,), daemon=True)
+            self._run_thread.start()
+        elif fields[1] == 'STOP' and self.status == 'RUNNING':
+            self._stop_run.set()
+        elif fields[1] == 'ONE' and self.status != 'RUNNING':
+            self._send(self._data_line(self.lines_sent).encode())
+
+    def _initialize(self):
+        """ Simulate the baseline measurement """
+        sleep(self.init_time)
+        self.status = 'READY'
+
+    def _run(self, run_time:float):
+        """ Emit DATA lines at the configured rate until the run time expires or STOP is received """
+        start = monotonic()
+        end = start + run_time
+        sent = 0
+        while not self._stop_run.is_set() and monotonic() < end:
+            if self.rate > 0:
+                due = int((monotonic() - start) * self.rate) + 1 - sent
+                if due <= 0:
+                    sleep(min(1 / self.rate, max(0.0, end - monotonic())))
+                    continue
+                count = min(due, BURST_LINES)
+            else:
+                count = BURST_LINES
+            if self.max_lines is not None:
+                count = min(count, self.max_lines - sent)
+                if count <= 0:
+                    break
+            lines = ''.join(self._data_line(self.lines_sent + x) for x in range(count)).encode()
+            if self.record_send_times:
+                self.send_times.extend([time()] * count)
+            try:
+                self._send(lines)
+            except OSError:
+                return
+            self.lines_sent += count
+            sent += count
+        self.status = 'READY'
+        self._send(f'STOP:{self.ticks}\n'.encode())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a simulated Micropython ammeter on a pseudo terminal")
+    parser.add_argument('--rate', dest='rate', required=False, type=float, default=100.0, help='(100) DATA lines per second, 0 for unlimited')
+    parser.add_argument('--channels', dest='channels', required=False, type=int, default=1, help='(1) Number of channels')
+    parser.add_argument('--reads', dest='reads', required=False, type=int, default=10, help='(10) Number of last_reads values per DATA line')
+    parser.add_argument('--timeout', dest='timeout', required=False, type=int, default=60, help='(60) Default capture time in seconds')
+    parser.add_argument('--noinit', dest='noinit', required=False, action='store_true', default=False, help='(False) Start in the NOINIT state')
+    args = vars(parser.parse_args())
+
+    with AmmeterSimulator(rate=args['rate'], channels=args['channels'], reads=args['reads'], timeout=args['timeout'],
+                          initialized=not args['noinit']) as simulator:
+        print(f"Simulated ammeter running on {simulator.port}.  Press Ctrl+C to exit.")
+        try:
+            while True:
+                sleep(1)
+        except KeyboardInterrupt:
+            pass
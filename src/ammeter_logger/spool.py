@@ -0,0 +1,159 @@
+"""
+Streaming writer stage - spools samples to disk while the capture is running
+"""
+import os
+import csv
+import logging
+from datetime import datetime
+from queue import Queue, Empty
+from threading import Thread
+from time import time
+
+# seconds close() waits for the writer thread to drain the queue
+CLOSE_TIMEOUT = 30.0
+
+
+def csv_header(last_reads_width:int):
+    """ Return the CSV header row for the given number of last_reads values """
+    header = ['received_epoch', 'name', 'received_datetime', 'ticks', 'latest']
+    for x in range(last_reads_width):
+        header.append(f'read_{x+1}')
+    header.append('time_from_start')
+    header.append('average')
+    return header
+
+
+def csv_row(record):
+    """ Return the CSV row for a sample """
+    row = [
+        record['received'],
+        record['name'],
+        datetime.fromtimestamp(record['received']).strftime('%Y-%m-%d %H:%M:%S.%f'),
+        record['ticks'],
+        record['current_amps']]
+    row.extend(record['last_reads'])
+    row.append(float(record['ticks'])/1000)
+    row.append(record['average'])
+    return row
+
+
+class CsvSink:
+    """ Writes samples to a CSV file.  The header is written with the first batch of samples """
+    def __init__(self, file_name:str, mode='w'):
+        self.file_name = file_name
+        self._file = open(file_name, mode, encoding='utf-8', newline='')
+        self._writer = csv.writer(self._file)
+        self._header_written = False
+        self.rows_written = 0
+
+    def set_run_info(self, config=None, start=None, stop=None):
+        """ CSV output doesn't carry the run information """
+
+    def write_samples(self, samples:list):
+        """ Write a batch of samples """
+        if len(samples) == 0:
+            return
+        if not self._header_written:
+            self._writer.writerow(csv_header(len(samples[0]['last_reads'])))
+            self._header_written = True
+        self._writer.writerows(csv_row(sample) for sample in samples)
+        self.rows_written += len(samples)
+
+    def flush(self):
+        """ Flush buffered rows to the OS """
+        self._file.flush()
+
+    def fsync(self):
+        """ Flush and force the written rows to disk """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """ Close the output file """
+        if not self._file.closed:
+            self.fsync()
+            self._file.close()
+
+
+class SpoolWriter:
+    """ Writer stage for a streaming capture.  Register the instance as a sample listener, the receive thread only
+        enqueues each batch.  A background thread appends the batches to the sink, flushing every flush_interval
+        and fsyncing every fsync_interval seconds.  The queue is bounded by max_batches so memory use stays constant
+        however long the capture runs (the receive thread waits if the disk falls that far behind).  If the sink
+        fails the error is kept in write_error and later batches are dropped (counted in samples_dropped) so the
+        receive thread is never blocked by a writer that can't make progress.
+    """
+    def __init__(self, sink, flush_interval=1.0, fsync_interval=10.0, max_batches=1024, logger=None):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self._logger = logger if logger is not None else logging.getLogger(__name__)
+        self._queue = Queue(maxsize=max_batches)
+        self.samples_written = 0
+        self.samples_dropped = 0
+        self.write_error = None
+        self._closed = False
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __call__(self, samples:list):
+        """ Sample listener - queue a batch of samples for writing """
+        if self.write_error is not None:
+            self.samples_dropped += len(samples)
+            return
+        self._queue.put(samples)
+
+    def _run(self):
+        """ Drain the queue into the sink """
+        next_flush = time() + self.flush_interval
+        next_fsync = time() + self.fsync_interval
+        pending = []
+        running = True
+        while running:
+            try:
+                batch = self._queue.get(timeout=max(0.0, next_flush - time()))
+                if batch is None:
+                    running = False
+                else:
+                    pending.extend(batch)
+            except Empty:
+                pass
+            now = time()
+            if self.write_error is not None:
+                # the sink has failed, keep draining so the receive thread never blocks
+                self.samples_dropped += len(pending)
+            elif now >= next_flush or not running:
+                try:
+                    self.sink.write_samples(pending)
+                    self.samples_written += len(pending)
+                    if now >= next_fsync:
+                        self.sink.fsync()
+                        next_fsync = now + self.fsync_interval
+                    else:
+                        self.sink.flush()
+                except Exception as e:
+                    self.write_error = e
+                    self.samples_dropped += len(pending)
+                    self._logger.error('%s: Error writing %i samples, dropping the rest of the capture: %s', self.__class__.__name__, len(pending), e)
+            else:
+                continue
+            pending = []
+            next_flush = now + self.flush_interval
+
+    def close(self, run_info=None):
+        """ Write any queued samples, update the run information (dict of config/start/stop) and close the sink """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(CLOSE_TIMEOUT)
+        if self._thread.is_alive():
+            self._logger.error('%s: Timed out waiting for the writer, %s not closed', self.__class__.__name__, getattr(self.sink, 'file_name', self.sink))
+            return
+        try:
+            if run_info is not None:
+                self.sink.set_run_info(**run_info)
+            self.sink.close()
+        except Exception as e:
+            self.write_error = self.write_error if self.write_error is not None else e
+            self._logger.error('%s: Error closing the sink: %s', self.__class__.__name__, e)
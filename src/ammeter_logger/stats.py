@@ -0,0 +1,245 @@
+"""
+Online statistics for the samples received from the Micropython ammeter, updated as each batch is parsed
+"""
+from collections import deque
+from math import sqrt
+
+# quantiles tracked by default
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class P2Quantile:
+    """ Streaming quantile estimate using the P-square algorithm (Jain & Chlamtac) - O(1) memory and update """
+    def __init__(self, quantile:float):
+        self.quantile = quantile
+        self._initial = []
+        self._heights = None
+        self._positions = None
+        self._desired = None
+        self._increments = (0, quantile / 2, quantile, (1 + quantile) / 2, 1)
+
+    def add(self, value:float):
+        """ Add an observation """
+        heights = self._heights
+        if heights is None:
+            self._initial.append(value)
+            if len(self._initial) == 5:
+                self._initial.sort()
+                self._heights = self._initial
+                self._positions = [0, 1, 2, 3, 4]
+                q = self.quantile
+                self._desired = [0, 2 * q, 4 * q, 2 + 2 * q, 4]
+            return
+        positions = self._positions
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+        for x in range(cell + 1, 5):
+            positions[x] += 1
+        desired = self._desired
+        for x in range(5):
+            desired[x] += self._increments[x]
+        for x in (1, 2, 3):
+            delta = desired[x] - positions[x]
+            if (delta >= 1 and positions[x + 1] - positions[x] > 1) or (delta <= -1 and positions[x - 1] - positions[x] < -1):
+                step = 1 if delta > 0 else -1
+                height = heights[x] + step / (positions[x + 1] - positions[x - 1]) * (
+                    (positions[x] - positions[x - 1] + step) * (heights[x + 1] - heights[x]) / (positions[x + 1] - positions[x])
+                    + (positions[x + 1] - positions[x] - step) * (heights[x] - heights[x - 1]) / (positions[x] - positions[x - 1]))
+                if not heights[x - 1] < height < heights[x + 1]:
+                    height = heights[x] + step * (heights[x + step] - heights[x]) / (positions[x + step] - positions[x])
+                heights[x] = height
+                positions[x] += step
+
+    @property
+    def value(self):
+        """ Return the current estimate (None before any observations) """
+        if self._heights is not None:
+            return self._heights[2]
+        if len(self._initial) == 0:
+            return None
+        ordered = sorted(self._initial)
+        return ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+
+
+class SlidingWindow:
+    """ Mean, min and max over the last window_ms of device ticks.  Min/max use monotonic deques so each update is
+        amortized O(1).
+    """
+    def __init__(self, window_ms:int):
+        self.window_ms = window_ms
+        self._values = deque()
+        self._min = deque()
+        self._max = deque()
+        self._sum = 0.0
+
+    def add(self, ticks:int, value:float):
+        """ Add an observation and expire the ones older than the window """
+        self._values.append((ticks, value))
+        self._sum += value
+        while len(self._min) > 0 and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((ticks, value))
+        while len(self._max) > 0 and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((ticks, value))
+        oldest = ticks - self.window_ms
+        while self._values[0][0] <= oldest:
+            self._sum -= self._values.popleft()[1]
+        while self._min[0][0] <= oldest:
+            self._min.popleft()
+        while self._max[0][0] <= oldest:
+            self._max.popleft()
+
+    def snapshot(self):
+        """ Return the window statistics """
+        count = len(self._values)
+        return {
+            'window_ms': self.window_ms,
+            'count': count,
+            'mean': self._sum / count if count > 0 else None,
+            'min': self._min[0][1] if count > 0 else None,
+            'max': self._max[0][1] if count > 0 else None
+        }
+
+
+class ChannelStats:
+    """ Running statistics for one channel: count, mean and variance (Welford), min/max, charge integrated over the
+        device ticks (trapezoidal), streaming quantiles and tumbling/sliding windows.
+    """
+    def __init__(self, quantiles=DEFAULT_QUANTILES, tumbling_ms=60000, sliding_ms=10000, windows_kept=60):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.amp_seconds = 0.0
+        self._last_ticks = None
+        self.first_ticks = None
+        self._quantiles = [P2Quantile(q) for q in quantiles]
+        self._sliding = SlidingWindow(sliding_ms) if sliding_ms else None
+        self._tumbling_ms = tumbling_ms
+        self._window = None
+        self.windows = deque(maxlen=windows_kept)
+
+    def add(self, ticks:int, value:float):
+        """ Add an observation """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self._last_ticks is not None and ticks > self._last_ticks:
+            self.amp_seconds += (value + self.last) / 2 * (ticks - self._last_ticks) / 1000
+        if self.first_ticks is None:
+            self.first_ticks = ticks
+        self._last_ticks = ticks
+        self.last = value
+        for quantile in self._quantiles:
+            quantile.add(value)
+        if self._sliding is not None:
+            self._sliding.add(ticks, value)
+        if self._tumbling_ms:
+            self._add_tumbling(ticks, value)
+
+    def _add_tumbling(self, ticks:int, value:float):
+        """ Add an observation to the current tumbling window, closing it when the ticks pass the window end """
+        start = ticks - ticks % self._tumbling_ms
+        window = self._window
+        if window is not None and window['start_ticks'] != start:
+            window['mean'] = window.pop('_sum') / window['count']
+            self.windows.append(window)
+            window = None
+        if window is None:
+            window = self._window = {'start_ticks': start, 'count': 0, '_sum': 0.0, 'min': value, 'max': value}
+        window['count'] += 1
+        window['_sum'] += value
+        if value < window['min']:
+            window['min'] = value
+        if value > window['max']:
+            window['max'] = value
+
+    def snapshot(self):
+        """ Return an immutable view of the current statistics """
+        return {
+            'count': self.count,
+            'last': self.last,
+            'mean': self.mean if self.count > 0 else None,
+            'stddev': sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.0,
+            'min': self.min,
+            'max': self.max,
+            'amp_hours': self.amp_seconds / 3600,
+            'duration_ms': self._last_ticks - self.first_ticks if self.count > 0 else 0,
+            'quantiles': {quantile.quantile: quantile.value for quantile in self._quantiles},
+            'sliding': self._sliding.snapshot() if self._sliding is not None else None,
+            'last_window': dict(self.windows[-1]) if len(self.windows) > 0 else None
+        }
+
+
+class StatsEngine:
+    """ Sample listener that keeps ChannelStats for every channel.  The receive thread updates the statistics and
+        publishes a new snapshot after each batch, queries (snapshot, channel) just read the last published snapshot
+        so they are O(1) and never wait on the receive thread.
+    """
+    def __init__(self, field='current_amps', quantiles=DEFAULT_QUANTILES, tumbling_ms=60000, sliding_ms=10000):
+        self.field = field
+        self._quantiles = quantiles
+        self._tumbling_ms = tumbling_ms
+        self._sliding_ms = sliding_ms
+        self._channels = {}
+        self._snapshot = {}
+
+    def __call__(self, samples:list):
+        """ Sample listener - update the statistics with a batch of samples """
+        field = self.field
+        updated = set()
+        for sample in samples:
+            channel = self._channels.get(sample['name'])
+            if channel is None:
+                channel = self._channels[sample['name']] = ChannelStats(self._quantiles, self._tumbling_ms, self._sliding_ms)
+            channel.add(sample['ticks'], sample[field])
+            updated.add(sample['name'])
+        snapshot = dict(self._snapshot)
+        for name in updated:
+            snapshot[name] = self._channels[name].snapshot()
+        self._snapshot = snapshot
+
+    def reset(self):
+        """ Clear the statistics, i.e. at the start of a new run """
+        self._channels = {}
+        self._snapshot = {}
+
+    def snapshot(self):
+        """ Return {channel: statistics} as of the last processed batch """
+        return self._snapshot
+
+    def channel(self, name:str):
+        """ Return the statistics of one channel (None if no samples received) """
+        return self._snapshot.get(name)
+
+    @property
+    def count(self):
+        """ Return the number of samples processed """
+        return sum(channel['count'] for channel in self._snapshot.values())
+
+
+def format_summary(snapshot:dict):
+    """ Return a printable one line per channel summary of a StatsEngine snapshot """
+    lines = []
+    for name, stats in snapshot.items():
+        quantiles = ', '.join(f"p{int(q * 100)} {value:.4f}" for q, value in stats['quantiles'].items() if value is not None)
+        lines.append(f"{name}: {stats['count']} samples, mean {stats['mean']:.4f} A (sd {stats['stddev']:.4f}), "
+                     f"min {stats['min']:.4f} A, max {stats['max']:.4f} A, {quantiles}, {stats['amp_hours']:.6f} Ah "
+                     f"over {stats['duration_ms'] / 1000:.1f} s")
+    return '\n'.join(lines)
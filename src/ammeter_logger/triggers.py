@@ -0,0 +1,177 @@
+"""
+Continuous capture into a bounded ring buffer, saving a segment around each triggering sample
+"""
+import logging
+from collections import deque
+from operator import attrgetter
+from threading import Thread
+from .spool import CsvSink, SpoolWriter
+
+# upper bound on the samples held for the pre-trigger window, whatever the sample rate
+DEFAULT_MAX_BUFFER = 1000000
+
+
+class ThresholdTrigger:
+    """ Fires on every sample with field above and/or below the limits """
+    def __init__(self, field='current_amps', above=None, below=None):
+        if above is None and below is None:
+            raise ValueError('A threshold trigger needs an above or below limit')
+        self.field = field
+        self.above = above
+        self.below = below
+        self._value = attrgetter(field)
+
+    def __str__(self):
+        limits = [f'> {self.above}' if self.above is not None else None, f'< {self.below}' if self.below is not None else None]
+        return f"{self.field} {' or '.join(limit for limit in limits if limit is not None)}"
+
+    def fired(self, samples:list):
+        """ Return the indexes of the samples in the batch that fire the trigger """
+        values = list(map(self._value, samples))
+        if len(values) == 0:
+            return []
+        above, below = self.above, self.below
+        # whole batch inside the limits - the common case, checked without a python level loop
+        if (above is None or max(values) <= above) and (below is None or min(values) >= below):
+            return []
+        return [x for x, value in enumerate(values) if (above is not None and value > above) or (below is not None and value < below)]
+
+
+class RateTrigger:
+    """ Fires when field changes by more than max_change per second (of device ticks) between two samples of the
+        same channel
+    """
+    def __init__(self, max_change:float, field='current_amps'):
+        self.field = field
+        self.max_change = max_change
+        self._value = attrgetter(field)
+        self._last = {}
+
+    def __str__(self):
+        return f"{self.field} change > {self.max_change}/s"
+
+    def fired(self, samples:list):
+        """ Return the indexes of the samples in the batch that fire the trigger """
+        fired = []
+        last, get_value, max_change = self._last, self._value, self.max_change / 1000
+        for x, sample in enumerate(samples):
+            value, ticks = get_value(sample), sample.ticks
+            previous = last.get(sample.name)
+            if previous is not None and ticks > previous[0] and abs(value - previous[1]) > max_change * (ticks - previous[0]):
+                fired.append(x)
+            last[sample.name] = (ticks, value)
+        return fired
+
+
+class TriggeredCapture:
+    """ Sample listener for continuous monitoring.  The last pre_seconds of samples (by device ticks) are kept in a
+        ring buffer of at most max_buffer samples, so memory stays constant however long the run lasts.  When any
+        trigger fires a segment is opened with the buffered samples, followed by the samples up to post_seconds after
+        the last trigger (a trigger inside the post window extends it).  Each segment is streamed through a
+        SpoolWriter to the sink returned by sink_factory(segment_number), by default PREFIX.<segment>.csv.
+    """
+    def __init__(self, triggers:list, pre_seconds=5.0, post_seconds=5.0, prefix='segment', sink_factory=None,
+                 config=None, max_buffer=DEFAULT_MAX_BUFFER, logger=None):
+        self.triggers = triggers
+        self.pre_ticks = int(pre_seconds * 1000)
+        self.post_ticks = int(post_seconds * 1000)
+        self.prefix = prefix
+        self._sink_factory = sink_factory if sink_factory is not None else self._csv_sink
+        self.config = config if config is not None else {}
+        self._logger = logger if logger is not None else logging.getLogger(__name__)
+        self._buffer = deque(maxlen=max_buffer)
+        self._segment = None
+        self._closing = []
+        self.segments = []
+        self.triggers_fired = 0
+
+    def _csv_sink(self, segment:int):
+        """ Default sink factory - a CSV file per segment """
+        return CsvSink(f'{self.prefix}.{segment:04d}.csv')
+
+    def __call__(self, samples:list):
+        """ Sample listener - check the triggers and buffer or save the batch """
+        if len(self.triggers) == 1:
+            fired = self.triggers[0].fired(samples)
+        else:
+            fired = sorted(set().union(*(trigger.fired(samples) for trigger in self.triggers)))
+        if len(fired) == 0 and self._segment is None:
+            self._buffer.extend(samples)
+            self._trim_buffer()
+            return
+        self.triggers_fired += len(fired)
+        fired = set(fired)
+        start = 0
+        for x, sample in enumerate(samples):
+            if self._segment is not None and sample.ticks > self._segment['post_end']:
+                self._write_segment(samples[start:x])
+                self._close_segment()
+                start = x
+            if x in fired:
+                if self._segment is None:
+                    self._buffer.extend(samples[start:x])
+                    self._trim_buffer(sample.ticks)
+                    self._open_segment(sample)
+                    start = x
+                self._segment['post_end'] = sample.ticks + self.post_ticks
+        if self._segment is not None:
+            self._write_segment(samples[start:])
+        else:
+            self._buffer.extend(samples[start:])
+            self._trim_buffer()
+
+    def _trim_buffer(self, newest=None):
+        """ Drop the buffered samples older than the pre trigger window """
+        buffer = self._buffer
+        if len(buffer) == 0:
+            return
+        oldest = (buffer[-1].ticks if newest is None else newest) - self.pre_ticks
+        while len(buffer) > 0 and buffer[0].ticks < oldest:
+            buffer.popleft()
+
+    def _open_segment(self, sample):
+        """ Start a segment with the buffered samples """
+        number = len(self.segments)
+        spool = SpoolWriter(self._sink_factory(number), logger=self._logger)
+        pre_trigger = list(self._buffer)
+        self._buffer.clear()
+        self._segment = {
+            'segment': number,
+            'spool': spool,
+            'trigger_ticks': sample.ticks,
+            'trigger_sample': sample,
+            'start_ticks': pre_trigger[0].ticks if len(pre_trigger) > 0 else sample.ticks,
+            'stop_ticks': sample.ticks,
+            'post_end': sample.ticks + self.post_ticks,
+            'samples': 0
+        }
+        self._write_segment(pre_trigger)
+        self._logger.info('%s: Trigger at ticks %s (%s), saving segment %i', self.__class__.__name__, sample.ticks,
+                          ', '.join(str(trigger) for trigger in self.triggers), number)
+
+    def _write_segment(self, samples:list):
+        """ Queue samples for the open segment """
+        if len(samples) > 0:
+            self._segment['spool'](samples)
+            self._segment['samples'] += len(samples)
+            self._segment['stop_ticks'] = samples[-1].ticks
+
+    def _close_segment(self):
+        """ Finish the open segment, the spool is drained and closed off the receive thread """
+        segment, self._segment = self._segment, None
+        spool = segment.pop('spool')
+        run_info = {'config': self.config, 'start': {'reported': segment['start_ticks']},
+                    'stop': {'reported': segment['stop_ticks']}}
+        closing = Thread(target=spool.close, kwargs={'run_info': run_info}, daemon=True)
+        closing.start()
+        self._closing = [thread for thread in self._closing if thread.is_alive()] + [closing]
+        segment['trigger_sample'] = segment['trigger_sample']._asdict()
+        self.segments.append(segment)
+
+    def close(self):
+        """ Finish any open segment and wait for the segment files to be written """
+        if self._segment is not None:
+            self._close_segment()
+        for thread in self._closing:
+            thread.join()
+        self._closing = []
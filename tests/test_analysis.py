@@ -0,0 +1,96 @@
+"""
+Capture analysis, cache and replay tests
+"""
+import pytest
+from ammeter_logger.sample_store import Sample
+from ammeter_logger.spool import CsvSink
+from ammeter_logger.binary_capture import BinarySink
+from ammeter_logger.decimation import write_pyramid, DecimationPyramid
+from ammeter_logger.analysis import (find_captures, summarize_capture, analyze_captures, AnalysisCache, compare_runs,
+                                     replay_capture)
+
+ROWS = 1000
+
+
+def _samples(scale=1.0):
+    return [Sample(1700000000.0 + x * 0.01, f'ch{x % 2}', x * 10, scale * (x % 10) * 0.1, [x * 0.5, x * 0.25], scale * 0.45)
+            for x in range(ROWS)]
+
+
+def _write(sink, samples:list):
+    sink.set_run_info(config={'interval': 10}, start={'reported': 0}, stop={'reported': ROWS * 10})
+    sink.write_samples(samples)
+    sink.close()
+    return sink.file_name
+
+
+@pytest.fixture
+def captures(tmp_path):
+    return [_write(CsvSink(str(tmp_path / 'run0.csv')), _samples()),
+            _write(BinarySink(str(tmp_path / 'run1.bin')), _samples(2.0))]
+
+
+def test_summarize(captures):
+    for file_name, scale in zip(captures, (1.0, 2.0)):
+        summary = summarize_capture(file_name, chunk_rows=300)
+        assert summary['rows'] == ROWS and summary['skipped_rows'] == 0
+        assert sorted(summary['channels']) == ['ch0', 'ch1']
+        channel = summary['channels']['ch1']
+        assert channel['count'] == ROWS // 2
+        assert channel['mean'] == pytest.approx(scale * 0.5)
+        assert channel['max'] == pytest.approx(scale * 0.9)
+
+
+def test_skipped_rows(captures):
+    with open(captures[0], 'a', encoding='utf-8') as output_file:
+        output_file.write('1700000010.0,ch0,2023')
+    summary = summarize_capture(captures[0])
+    assert summary['rows'] == ROWS and summary['skipped_rows'] == 1
+
+
+def test_find_captures(captures, tmp_path):
+    pyramid = DecimationPyramid()
+    pyramid(_samples())
+    pyramid.finish(100)
+    write_pyramid(pyramid, str(tmp_path / 'run0.csv'))
+    (tmp_path / 'notes.txt').write_text('notes')
+    # the pyramid level files aren't captures
+    assert find_captures([str(tmp_path)]) == captures
+
+
+def test_cache(captures, tmp_path):
+    cache_file = str(tmp_path / 'cache' / 'analysis_cache.json')
+    first = analyze_captures(captures, workers=1, cache=AnalysisCache(cache_file))
+    assert [summary['cached'] for summary in first] == [False, False]
+    second = analyze_captures(captures, workers=1, cache=AnalysisCache(cache_file))
+    assert [summary['cached'] for summary in second] == [True, True]
+    assert second[1]['channels'] == first[1]['channels']
+    # a changed capture and an invalidated one are read again
+    _write(CsvSink(captures[0]), _samples(3.0))
+    cache = AnalysisCache(cache_file)
+    cache.invalidate(captures[1])
+    third = analyze_captures(captures, workers=1, cache=cache)
+    assert [summary['cached'] for summary in third] == [False, False]
+    assert third[0]['channels']['ch1']['mean'] == pytest.approx(1.5)
+    # the summaries are for the field they were computed for
+    assert not analyze_captures(captures[:1], field='average', workers=1, cache=AnalysisCache(cache_file))[0]['cached']
+
+
+def test_analyze_errors(captures, tmp_path):
+    missing = str(tmp_path / 'missing.csv')
+    results = analyze_captures(captures + [missing], workers=2)
+    assert 'error' in results[2]
+    rows = compare_runs(results[:2])
+    baseline = [row for row in rows if row['file'] == captures[0] and row['channel'] == 'ch1'][0]
+    changed = [row for row in rows if row['file'] == captures[1] and row['channel'] == 'ch1'][0]
+    assert baseline['mean_change'] == pytest.approx(0.0)
+    assert changed['mean_change'] == pytest.approx(1.0)
+
+
+def test_replay(captures):
+    for file_name in captures:
+        received = []
+        result = replay_capture(file_name, listeners=[received.extend], chunk_rows=300)
+        assert result['rows'] == result['replayed'] == ROWS
+        assert result['mismatches'] == 0 and result['bad_lines'] == 0
+        assert [sample.ticks for sample in received] == [x * 10 for x in range(ROWS)]
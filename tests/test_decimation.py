@@ -0,0 +1,79 @@
+"""
+Downsampling pyramid and LTTB tests
+"""
+import pytest
+from ammeter_logger.sample_store import SampleStore, Sample
+from ammeter_logger.decimation import lttb, ChannelPyramid, DecimationPyramid, build_pyramid, load_pyramid, \
+    write_pyramid
+from ammeter_logger.spool import CsvSink
+
+
+def _store(count:int, channels=1):
+    """ Return a SampleStore of a saw tooth with a spike, channels interleaved """
+    store = SampleStore()
+    for x in range(count):
+        value = 5.0 if x == count // 2 else (x % 10) / 10
+        store.append_sample(Sample(1000.0 + x / 100, f'ch{x % channels}', x * 10, value, [value], value))
+    return store
+
+
+def test_lttb():
+    ticks = list(range(1000))
+    values = [0.0] * 1000
+    values[500] = 10.0
+    out_ticks, out_values = lttb(ticks, values, 20)
+    assert len(out_ticks) == len(out_values) == 20
+    assert (out_ticks[0], out_ticks[-1]) == (0, 999)
+    # the spike is the largest triangle in its bucket
+    assert 500 in out_ticks and max(out_values) == 10.0
+    assert list(out_ticks) == sorted(out_ticks)
+    assert list(lttb(ticks[:10], values[:10], 20)[0]) == ticks[:10]
+
+
+def test_channel_pyramid():
+    pyramid = ChannelPyramid(factor=4, levels=2)
+    values = [float(x) for x in range(37)]
+    # arrives in uneven batches, only full buckets are added until finish()
+    for start in range(0, 37, 7):
+        pyramid.extend(range(start, min(start + 7, 37)), values[start:start + 7])
+    assert len(pyramid.levels[0]) == 9 and len(pyramid.levels[1]) == 2
+    pyramid.finish(lttb_points=5)
+    level0, level1 = list(pyramid.levels[0]), list(pyramid.levels[1])
+    assert len(level0) == 10 and len(level1) == 3
+    assert level0[0] == {'ticks': 0, 'count': 4, 'min': 0.0, 'max': 3.0, 'mean': 1.5}
+    assert level0[-1] == {'ticks': 36, 'count': 1, 'min': 36.0, 'max': 36.0, 'mean': 36.0}
+    assert level1[0] == {'ticks': 0, 'count': 16, 'min': 0.0, 'max': 15.0, 'mean': 7.5}
+    assert level1[-1]['count'] == 5 and level1[-1]['mean'] == pytest.approx(34.0)
+    assert sum(level1_bucket['count'] for level1_bucket in level1) == 37
+    assert len(pyramid.lttb[0]) == 5
+
+
+def test_listener_matches_build():
+    store = _store(5000, channels=2)
+    live = DecimationPyramid(factor=8, levels=3)
+    for start in range(0, len(store), 300):
+        live(store[start:start + 300])
+    live.finish()
+    built = build_pyramid(store, factor=8, levels=3)
+    assert sorted(built.channels) == ['ch0', 'ch1']
+    for level in range(3):
+        for name in ('ch0', 'ch1'):
+            assert list(live.level(level)[name]) == list(built.level(level)[name])
+    assert sum(live.level(0)['ch0'].count) == 2500
+    assert built.channels['ch0'].lttb[1][list(built.channels['ch0'].lttb[0]).index(25000)] == 5.0
+    assert [built.select_level(points) for points in (1000, 100, 10, 1)] == [0, 1, 2, 2]
+
+
+def test_load_csv(tmp_path):
+    store = _store(1000)
+    file_name = str(tmp_path / 'capture.csv')
+    sink = CsvSink(file_name)
+    sink.write_samples(store)
+    sink.close()
+    loaded = load_pyramid(file_name, factor=8, levels=2, lttb_points=50)
+    built = build_pyramid(store, factor=8, levels=2, lttb_points=50)
+    assert list(loaded.level(1)['ch0']) == list(built.level(1)['ch0'])
+    files = write_pyramid(loaded, str(tmp_path / 'out'))
+    assert [name.rsplit('.', 2)[-2] for name in files] == ['L0', 'L1', 'lttb']
+    with open(files[-1], encoding='utf-8') as lttb_file:
+        assert len(lttb_file.readlines()) == 51
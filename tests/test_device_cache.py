@@ -0,0 +1,69 @@
+"""
+Device config cache tests
+"""
+import json
+from time import time
+import pytest
+from ammeter_logger import AmmeterRecvSerial
+from ammeter_logger.device_cache import DeviceConfigCache
+from ammeter_logger.simulator import AmmeterSimulator
+
+
+@pytest.fixture
+def cache_file(tmp_path):
+    return str(tmp_path / 'cache' / 'config_cache.json')
+
+
+def test_put_get(cache_file):
+    cache = DeviceConfigCache(cache_file)
+    assert cache.get('/dev/ttyUSB0') is None
+    cache.put('/dev/ttyUSB0', {'interval': 100})
+    # persisted for the next process
+    assert DeviceConfigCache(cache_file).get('/dev/ttyUSB0') == {'interval': 100}
+    assert DeviceConfigCache(cache_file).get('/dev/ttyUSB1') is None
+
+
+def test_expired(cache_file):
+    cache = DeviceConfigCache(cache_file, max_age=60)
+    cache.put('/dev/ttyUSB0', {'interval': 100})
+    with open(cache_file, 'r', encoding='utf-8') as input_file:
+        entries = json.load(input_file)
+    entries['/dev/ttyUSB0']['time'] = time() - 120
+    with open(cache_file, 'w', encoding='utf-8') as output_file:
+        json.dump(entries, output_file)
+    assert DeviceConfigCache(cache_file, max_age=60).get('/dev/ttyUSB0') is None
+    assert DeviceConfigCache(cache_file, max_age=600).get('/dev/ttyUSB0') == {'interval': 100}
+
+
+def test_invalidate(cache_file):
+    cache = DeviceConfigCache(cache_file)
+    cache.put('/dev/ttyUSB0', {'interval': 100})
+    cache.put('/dev/ttyUSB1', {'interval': 200})
+    cache.invalidate('/dev/ttyUSB0')
+    assert DeviceConfigCache(cache_file).get('/dev/ttyUSB0') is None
+    assert DeviceConfigCache(cache_file).get('/dev/ttyUSB1') == {'interval': 200}
+    cache.invalidate()
+    assert DeviceConfigCache(cache_file).get('/dev/ttyUSB1') is None
+
+
+def test_session_cache(cache_file):
+    with AmmeterSimulator(rate=100) as simulator:
+        recv = AmmeterRecvSerial(simulator.port)
+        try:
+            session = recv.ammeter_session(cache=DeviceConfigCache(cache_file))
+            assert not session['cached'] and session['config']['interval'] == 10
+        finally:
+            recv.close()
+        cache = DeviceConfigCache(cache_file)
+        recv = AmmeterRecvSerial(simulator.port)
+        try:
+            session = recv.ammeter_session(cache=cache)
+            assert session['cached'] and session['config']['interval'] == 10
+            # changing the interval drops the entry, the CONFIG response to the check stores the new one
+            recv.ammeter_interval = 20
+            assert cache.get(cache.key(simulator.port)) == recv.ammeter_config
+            assert cache.get(cache.key(simulator.port))['interval'] == 20
+            recv.ammeter_invalidate_config()
+            assert DeviceConfigCache(cache_file).get(cache.key(simulator.port)) is None
+        finally:
+            recv.close()
@@ -0,0 +1,81 @@
+"""
+Bulk export tests
+"""
+import io
+import csv
+import json
+import gzip
+import zipfile
+from array import array
+import pytest
+from ammeter_logger.sample_store import SampleStore, CHUNK_SIZE
+from ammeter_logger.spool import CsvSink
+from ammeter_logger.export import export_capture, format_from_name
+
+ROWS = CHUNK_SIZE + 100
+
+
+@pytest.fixture
+def store():
+    store = SampleStore()
+    for x in range(ROWS):
+        store.append(1700000000.0 + x * 0.0013, 'ch0' if x % 3 else 'a,"b"', x * 10, x * 0.001, [x * 0.5, -x * 0.25], x * 0.002)
+    return store
+
+
+def test_csv_matches_sink(store, tmp_path):
+    sink = CsvSink(str(tmp_path / 'sink.csv'))
+    sink.write_samples(list(store))
+    sink.close()
+    result = export_capture(store, str(tmp_path / 'export.csv'), executor='thread', workers=2)
+    assert result['rows'] == ROWS
+    assert (tmp_path / 'export.csv').read_bytes() == (tmp_path / 'sink.csv').read_bytes()
+
+
+def test_csv_gz(store, tmp_path):
+    export_capture(store, str(tmp_path / 'export.csv'), executor='thread')
+    result = export_capture(store, str(tmp_path / 'export.csv.gz'), executor='thread')
+    assert result['bytes'] == (tmp_path / 'export.csv.gz').stat().st_size
+    with gzip.open(tmp_path / 'export.csv.gz') as input_file:
+        assert input_file.read() == (tmp_path / 'export.csv').read_bytes()
+
+
+def test_jsonl(store, tmp_path):
+    export_capture(store, str(tmp_path / 'export.jsonl'), executor='thread')
+    lines = (tmp_path / 'export.jsonl').read_text().splitlines()
+    assert len(lines) == ROWS
+    for x in (0, 1, CHUNK_SIZE, ROWS - 1):
+        assert json.loads(lines[x]) == store[x]._asdict()
+
+
+def test_npz(store, tmp_path):
+    export_capture(store, str(tmp_path / 'export.npz'))
+    with zipfile.ZipFile(tmp_path / 'export.npz') as archive:
+        assert sorted(archive.namelist()) == sorted(f'{column}.npy' for column in ('received', 'ticks', 'current_amps', 'average', 'name', 'last_reads', 'names'))
+        data = archive.read('last_reads.npy')
+        header_length = int.from_bytes(data[8:10], 'little')
+        assert b"'shape': (%i, 2)" % ROWS in data[10:10 + header_length]
+        values = array('d', data[10 + header_length:])
+        assert values[2 * CHUNK_SIZE:2 * CHUNK_SIZE + 2].tolist() == store[CHUNK_SIZE]['last_reads']
+        data = archive.read('ticks.npy')
+        header_length = int.from_bytes(data[8:10], 'little')
+        assert array('q', data[10 + header_length:]).tolist() == [x * 10 for x in range(ROWS)]
+
+
+def test_spawned_workers_from_snapshot(store, tmp_path):
+    snapshot = store.snapshot()
+    store.append(0.0, 'late', 0, 0.0, [0.0, 0.0], 0.0)
+    result = export_capture(snapshot, str(tmp_path / 'export.csv'), executor='spawn', workers=2)
+    assert result['rows'] == ROWS
+    rows = list(csv.reader(io.StringIO((tmp_path / 'export.csv').read_text(), newline='')))
+    # header and the rows in the snapshot, the sample appended after it isn't exported
+    assert len(rows) == ROWS + 1
+    assert rows[-1][1] == 'ch0'
+
+
+def test_format_from_name():
+    assert format_from_name('capture.csv.gz') == 'csv.gz'
+    assert format_from_name('capture.jsonl') == 'jsonl'
+    assert format_from_name('capture.txt') == 'csv'
+    with pytest.raises(ValueError):
+        export_capture(SampleStore(), 'unused', output_format='xml')
@@ -0,0 +1,100 @@
+"""
+Live sample fan-out tests
+"""
+import socket
+from time import sleep, monotonic
+import pytest
+from ammeter_logger.sample_store import Sample
+from ammeter_logger.fanout import SampleServer, SampleSubscriber, encode_batch, decode_batch, POLICY_DISCONNECT
+
+
+def _batch(index:int, count=1000):
+    return [Sample(1000.0 + x, f'ch{x % 2}', index * count + x, x * 0.001, [x * 0.5, x * 0.25], x * 0.002) for x in range(count)]
+
+
+def _wait_for(condition, timeout=5.0):
+    """ Wait for condition() to be true """
+    end = monotonic() + timeout
+    while not condition():
+        assert monotonic() < end, 'timed out'
+        sleep(0.01)
+
+
+def test_encode_decode():
+    batch = _batch(3, count=10)
+    assert decode_batch(encode_batch(batch)) == batch
+    with pytest.raises(ValueError):
+        encode_batch([batch[0], Sample(0.0, 'ch0', 0, 0.0, [0.0], 0.0)])
+
+
+def test_subscriber_receives_batches(tmp_path):
+    address = str(tmp_path / 'ammeter.sock')
+    server = SampleServer(address)
+    try:
+        with SampleSubscriber(address, timeout=5) as subscriber:
+            _wait_for(lambda: len(server.subscribers()) == 1)
+            batches = [_batch(x, count=10) for x in range(5)]
+            for batch in batches:
+                server(batch)
+            received = subscriber.batches()
+            assert [next(received) for _ in batches] == batches
+    finally:
+        server.close()
+    # the socket is removed when the server closes
+    assert not (tmp_path / 'ammeter.sock').exists()
+
+
+def test_drop_oldest(tmp_path):
+    address = str(tmp_path / 'ammeter.sock')
+    server = SampleServer(address, max_queue=4)
+    try:
+        # a subscriber that never reads
+        idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        idle.connect(address)
+        _wait_for(lambda: len(server.subscribers()) == 1)
+        for x in range(100):
+            server(_batch(x))
+        _wait_for(lambda: server.batches_published == 100)
+        state = server.subscribers()
+        # still connected, with the oldest batches dropped instead of queueing without limit
+        assert len(state) == 1
+        assert state[0]['queued'] <= 4 and state[0]['dropped'] > 0
+        assert state[0]['sent'] + state[0]['queued'] + state[0]['dropped'] == 100
+        idle.close()
+    finally:
+        server.close()
+
+
+def test_disconnect_slow(tmp_path):
+    address = str(tmp_path / 'ammeter.sock')
+    server = SampleServer(address, policy=POLICY_DISCONNECT, max_queue=4)
+    try:
+        idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        idle.connect(address)
+        with SampleSubscriber(address, timeout=5) as subscriber:
+            _wait_for(lambda: len(server.subscribers()) == 2)
+            batches, received = subscriber.batches(), []
+            for x in range(100):
+                server(_batch(x, count=100))
+                # the reading subscriber keeps up
+                received.append(next(batches))
+            # the idle subscriber is disconnected, the other one gets every batch
+            _wait_for(lambda: server.subscribers_disconnected == 1)
+            assert len(server.subscribers()) == 1
+            assert [batch[0]['ticks'] for batch in received] == [x * 100 for x in range(100)]
+        idle.close()
+    finally:
+        server.close()
+
+
+def test_stale_socket_only(tmp_path):
+    data_file = tmp_path / 'capture.csv'
+    data_file.write_text('data')
+    with pytest.raises(ValueError):
+        SampleServer(str(data_file))
+    assert data_file.read_text() == 'data'
+    # a socket left by an earlier server is replaced
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(tmp_path / 'ammeter.sock'))
+    stale.close()
+    SampleServer(str(tmp_path / 'ammeter.sock')).close()
@@ -0,0 +1,53 @@
+"""
+Logging setup and rate limit filter tests
+"""
+import logging
+from ammeter_logger.logging_handler import create_logger, RateLimitFilter
+
+
+def _record(msg='Received data: %s', level=logging.DEBUG, name='test'):
+    return logging.LogRecord(name, level, __file__, 1, msg, ('x',), None)
+
+
+def test_sample_every():
+    rate_filter = RateLimitFilter(sample_every=3)
+    records = [_record() for _ in range(7)]
+    assert [rate_filter.filter(record) for record in records] == [True, False, False, True, False, False, True]
+    assert records[0].getMessage() == 'Received data: x'
+    assert records[3].suppressed == 2
+    assert records[3].getMessage() == 'Received data: x (2 similar messages suppressed)'
+    # other message classes and levels above max_level are counted separately or not at all
+    assert rate_filter.filter(_record('Other: %s'))
+    assert rate_filter.filter(_record(level=logging.WARNING))
+
+
+def test_rate_burst():
+    rate_filter = RateLimitFilter(per_second=0.001, burst=5)
+    assert [rate_filter.filter(_record()) for _ in range(8)] == [True] * 5 + [False] * 3
+
+
+def test_logger_filtered_once(tmp_path, capsys):
+    log_file = tmp_path / 'test.log'
+    logger = create_logger(log_file=str(log_file), file_level='DEBUG', console_level='DEBUG', name='rate_limit_test',
+                           sample_every=2)
+    try:
+        for x in range(5):
+            logger.debug('Received data: %s', x)
+    finally:
+        for handler in list(logger.handlers):
+            handler.close()
+            logger.removeHandler(handler)
+    expected = ['Received data: 0', 'Received data: 2 (1 similar messages suppressed)', 'Received data: 4 (1 similar messages suppressed)']
+    # both handlers output the same records, each with the suppressed count added once
+    assert [line.split(' - ')[-1] for line in log_file.read_text().splitlines()] == expected
+    assert [line.split(' - ')[-1] for line in capsys.readouterr().err.splitlines()] == expected
+
+
+def test_logger_level():
+    logger = create_logger(console_level='INFO', name='level_test')
+    try:
+        assert logger.level == logging.INFO
+        assert not logger.isEnabledFor(logging.DEBUG)
+    finally:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
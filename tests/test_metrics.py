@@ -0,0 +1,67 @@
+"""
+Metrics and export format tests
+"""
+import json
+from ammeter_logger.metrics import MetricsRegistry, prometheus_text, json_line
+
+
+def _registry(port:str, bad_lines:int):
+    registry = MetricsRegistry({'port': port})
+    registry.counter('ammeter_bad_lines_total', 'Received lines dropped as bad data').inc(bad_lines)
+    registry.gauge('ammeter_pending_bytes', 'Received bytes waiting for the end of a line', lambda: 7)
+    histogram = registry.histogram('ammeter_batch_lines', 'Lines processed per read', (1, 4, 16))
+    for value in (1, 3, 3, 100):
+        histogram.observe(value)
+    return registry
+
+
+def test_histogram():
+    histogram = _registry('a', 0)['ammeter_batch_lines']
+    assert histogram.value == {'buckets': [(1, 1), (4, 3), (16, 3), (float('inf'), 4)], 'sum': 107, 'count': 4}
+    assert histogram.quantile(0.5) == 4
+    assert histogram.quantile(1.0) == float('inf')
+
+
+def test_prometheus_text():
+    text = prometheus_text([_registry('/dev/ttyUSB0', 2), _registry('/dev/ttyUSB1', 0)])
+    lines = text.splitlines()
+    assert text.endswith('\n')
+    # one HELP/TYPE per metric, a sample per registry
+    assert lines.count('# TYPE ammeter_bad_lines_total counter') == 1
+    assert 'ammeter_bad_lines_total{port="/dev/ttyUSB0"} 2' in lines
+    assert 'ammeter_bad_lines_total{port="/dev/ttyUSB1"} 0' in lines
+    assert 'ammeter_pending_bytes{port="/dev/ttyUSB0"} 7' in lines
+    assert '# TYPE ammeter_batch_lines histogram' in lines
+    assert 'ammeter_batch_lines_bucket{port="/dev/ttyUSB0",le="4"} 3' in lines
+    assert 'ammeter_batch_lines_bucket{port="/dev/ttyUSB0",le="+Inf"} 4' in lines
+    assert 'ammeter_batch_lines_sum{port="/dev/ttyUSB0"} 107.0' in lines
+    assert 'ammeter_batch_lines_count{port="/dev/ttyUSB0"} 4' in lines
+
+
+def _escape_registry(port:str):
+    registry = MetricsRegistry({'port': port})
+    registry.counter('x', 'x')
+    return registry
+
+
+def test_label_escape():
+    assert 'x{port="a\\"b"} 0' in prometheus_text([_escape_registry('a"b')]).splitlines()
+
+
+def test_json_line():
+    registry = _registry('a', 2)
+    first = json_line([registry])
+    # valid JSON with the infinite bucket bound as text
+    decoded = json.loads(json.dumps(first))
+    metrics = decoded['registries'][0]['metrics']
+    assert decoded['registries'][0]['labels'] == {'port': 'a'}
+    assert metrics['ammeter_bad_lines_total'] == 2
+    assert metrics['ammeter_batch_lines']['buckets'][-1] == ['+Inf', 4]
+    assert 'rates' not in decoded['registries'][0]
+    registry['ammeter_bad_lines_total'].inc(3)
+    first['time'] -= 2.0
+    second = json_line([registry], first)
+    rates = second['registries'][0]['rates']
+    # only counters get a rate
+    assert list(rates) == ['ammeter_bad_lines_total']
+    assert 1.4 < rates['ammeter_bad_lines_total'] <= 1.5
@@ -0,0 +1,89 @@
+"""
+Merging tests for the multi device capture
+"""
+from ammeter_logger.sample_store import Sample
+from ammeter_logger.multi_capture import merge_samples, merge_key, StreamingMerger
+from ammeter_logger import ammeter_core
+from ammeter_logger.ammeter_core import AmmeterCore
+
+
+def _samples(received:list, name='ch0'):
+    """ Return samples received at the given times """
+    return [Sample(value, name, int(value * 1000), 0.1, [0.1], 0.1) for value in received]
+
+
+def _keys(items):
+    """ Return (device, received) of merged (device, sample) pairs """
+    return [(device, sample['received']) for device, sample in items]
+
+
+def test_merge_samples():
+    merged = merge_samples({'a': _samples([1.0, 3.0, 5.0]), 'b': _samples([2.0, 3.0, 6.0])})
+    assert _keys(merged) == [('a', 1.0), ('b', 2.0), ('a', 3.0), ('b', 3.0), ('a', 5.0), ('b', 6.0)]
+
+
+def test_streaming_merger_order():
+    output = []
+    merger = StreamingMerger(['a', 'b'], output.extend)
+    listener_a, listener_b = merger.listener('a'), merger.listener('b')
+    listener_a(_samples([1.0, 2.0, 4.0]))
+    # nothing can be released until every device has reported
+    assert output == []
+    listener_b(_samples([1.5, 3.0]))
+    assert _keys(output) == [('a', 1.0), ('b', 1.5), ('a', 2.0), ('b', 3.0)]
+    listener_b(_samples([5.0]))
+    listener_a(_samples([6.0]))
+    merger.finish()
+    assert [received for _, received in _keys(output)] == [1.0, 1.5, 2.0, 3.0, 4.0, 5.0, 6.0]
+
+
+def test_streaming_merger_finish_device():
+    output = []
+    merger = StreamingMerger(['a', 'b'], output.extend)
+    merger.listener('a')(_samples([1.0, 2.0]))
+    merger.listener('b')(_samples([1.5]))
+    assert _keys(output) == [('a', 1.0), ('b', 1.5)]
+    # b stopped, a is no longer held back by it
+    merger.finish('b')
+    merger.listener('a')(_samples([3.0, 4.0]))
+    assert _keys(output)[2:] == [('a', 2.0), ('a', 3.0), ('a', 4.0)]
+    merger.finish('a')
+    # samples that arrive after every device finished are released directly
+    merger.listener('b')(_samples([5.0]))
+    assert _keys(output)[-1] == ('b', 5.0)
+    assert len(output) == 6
+
+
+class _Core(AmmeterCore):
+    """ Transport-less core, commands are dropped """
+    def _ammeter_write(self, data:bytes):
+        pass
+
+
+def test_samples_dispatched_before_stop():
+    core = _Core()
+    stopped_at_dispatch = []
+    core.add_sample_listener(lambda samples: stopped_at_dispatch.append(core._ammeter_stopped.is_set()))
+    core._ammeter_feed(b'START:0\nDATA:ch0:1:0.1:[0.1]:0.1\nDATA:ch0:2:0.1:[0.1]:0.1\nSTOP:3\n')
+    # the merger finishes a device once it is stopped, its last samples must have been passed on by then
+    assert stopped_at_dispatch == [False]
+    assert core._ammeter_stopped.is_set()
+
+
+def test_state_listener_finish(monkeypatch):
+    clock = [1.0]
+    monkeypatch.setattr(ammeter_core, 'time', lambda: clock[0])
+    first, second = _Core(), _Core()
+    output = []
+    merger = StreamingMerger(['a', 'b'], output.extend)
+    for device, core in (('a', first), ('b', second)):
+        core.add_sample_listener(merger.listener(device))
+        core.add_state_listener(merger.state_listener(device))
+    first._ammeter_feed(b'START:0\nDATA:ch0:1:0.1:[0.1]:0.1\n')
+    second._ammeter_feed(b'START:0\nDATA:ch0:1:0.1:[0.1]:0.1\n')
+    clock[0] = 3.0
+    second._ammeter_feed(b'DATA:ch0:3:0.1:[0.1]:0.1\nSTOP:4\n')
+    # the last sample of a (received before b's last sample) arrives in the same read as its STOP
+    clock[0] = 2.0
+    first._ammeter_feed(b'DATA:ch0:2:0.1:[0.1]:0.1\nSTOP:4\n')
+    assert [(device, sample['ticks']) for device, sample in output] == [('a', 1), ('b', 1), ('a', 2), ('b', 3)]
@@ -0,0 +1,57 @@
+"""
+Protocol parser tests
+"""
+import pytest
+from ammeter_logger.protocol import ProtocolError, parse_last_reads, parse_data, parse_config, parse_status, \
+    parse_line, parse_lines
+
+
+def test_last_reads():
+    assert parse_last_reads('[0.1, 0.2, 3]') == [0.1, 0.2, 3.0]
+    assert parse_last_reads('[]') == []
+    assert parse_last_reads('[ ]') == []
+    # not a plain list of numbers, parsed by the literal_eval fallback
+    assert parse_last_reads('[0.1, 0.2,]') == [0.1, 0.2]
+    assert parse_last_reads('(0.1, 0.2)') == [0.1, 0.2]
+    for text in ('[a, b]', '0.1', '', '[0.1, 0.2'):
+        with pytest.raises(ProtocolError):
+            parse_last_reads(text)
+
+
+def test_data():
+    assert parse_data('DATA:ch0:1234:0.5:[0.4, 0.6]:0.5'.split(':')) == ('ch0', 1234, 0.5, [0.4, 0.6], 0.5)
+    with pytest.raises(ProtocolError):
+        parse_data('DATA:ch0:1234:0.5:[0.4, 0.6]'.split(':'))
+    with pytest.raises(ProtocolError):
+        parse_data('DATA:ch0:notticks:0.5:[0.4, 0.6]:0.5'.split(':'))
+    with pytest.raises(ProtocolError):
+        parse_data('DATA:ch0:1234:0.5:[x]:0.5'.split(':'))
+
+
+def test_config():
+    config = parse_config('CONFIG:100:60:2:26:ch0:1000:27:ch1:1001'.split(':'))
+    assert config == {'interval': 100, 'timeout': 60, 'init_timeout': 2, 'pins': [
+        {'pin': 26, 'name': 'ch0', 'baseline': 1000}, {'pin': 27, 'name': 'ch1', 'baseline': 1001}]}
+    with pytest.raises(ProtocolError):
+        parse_config('CONFIG:100:60:2'.split(':'))
+    with pytest.raises(ProtocolError):
+        parse_config('CONFIG:100:x:2:26:ch0:1000'.split(':'))
+
+
+def test_status():
+    assert parse_status(['STATUS', 'READY']) == {'status': 'READY', 'timeout': 0, 'noinit_pin': None}
+    assert parse_status(['STATUS', 'RUNNING', '60'])['timeout'] == '60'
+    assert parse_status(['STATUS', 'NOINIT', '26'])['noinit_pin'] == '26'
+    with pytest.raises(ProtocolError):
+        parse_status(['STATUS'])
+
+
+def test_lines():
+    assert parse_line(b'START:100') == ('START', 100)
+    assert parse_line('') == (None, None)
+    with pytest.raises(ProtocolError):
+        parse_line('HELLO:1')
+    results = parse_lines([b'STOP:200', b'', b'BAD', b'DATA:ch0:1:0.1:[0.1]:0.1', b'START:x'])
+    assert [record_type for record_type, _ in results] == ['STOP', 'ERROR', 'DATA', 'ERROR']
+    assert results[0][1] == 200
+    assert isinstance(results[1][1], ProtocolError) and isinstance(results[1][1], ValueError)
@@ -0,0 +1,171 @@
+"""
+Receive path tests against the simulated ammeter (ammeter_logger.simulator) on a pseudo terminal
+"""
+import asyncio
+import csv
+import logging
+from time import monotonic, sleep
+import pytest
+from ammeter_logger import AmmeterRecvSerial, AsyncAmmeterRecv, MultiAmmeterCapture
+from ammeter_logger.simulator import AmmeterSimulator
+from ammeter_logger.spool import SpoolWriter, CsvSink
+from ammeter_logger.binary_capture import BinarySink, BinaryCaptureReader
+from ammeter_logger.multi_capture import StreamingMerger, merge_key
+
+
+@pytest.fixture
+def simulator():
+    """ Simulated ammeter running a 1 second capture at 200 lines per second """
+    with AmmeterSimulator(rate=200, channels=2, reads=5, timeout=1) as sim:
+        yield sim
+
+
+def _recv(sim, **kwargs):
+    """ Open a receiver on the simulator port """
+    return AmmeterRecvSerial(port=sim.port, baudrate=115200, **kwargs)
+
+
+def test_start_report(simulator):
+    recv = _recv(simulator)
+    try:
+        assert recv.ammeter_ready
+        assert recv.ammeter_start()
+        report = recv.ammeter_report(wait=5)
+        assert report is not None
+        assert report['start'] != {} and report['stop'] != {}
+        assert len(report['data']) == simulator.lines_sent > 0
+        assert report['data'][0]['name'] in ('ch0', 'ch1')
+        assert len(report['data'][0]['last_reads']) == 5
+    finally:
+        recv.close()
+
+
+def test_stop(simulator):
+    simulator.timeout = 30
+    recv = _recv(simulator)
+    try:
+        assert recv.ammeter_start()
+        sleep(0.2)
+        start = monotonic()
+        assert recv.ammeter_stop()
+        assert monotonic() - start < 1
+        assert recv.ammeter_report(wait=1) is not None
+        assert recv.ammeter_sample_count == simulator.lines_sent
+    finally:
+        recv.close()
+
+
+def test_malformed_lines(simulator, caplog):
+    caplog.set_level(logging.WARNING)
+    recv = _recv(simulator)
+    try:
+        assert recv.ammeter_start()
+        sleep(0.1)
+        simulator._send(b'garbage line\n')
+        simulator._send(b'DATA:ch0:100:0.1:[0.1, 0.2]:0.15\n')
+        simulator._send(b'DATA:ch0:100:notafloat:[0.1, 0.2, 0.3, 0.4, 0.5]:0.3\n')
+        report = recv.ammeter_report(wait=5)
+        assert report is not None
+        assert len(report['data']) == simulator.lines_sent
+        assert all(len(sample['last_reads']) == 5 for sample in report['data'])
+        assert recv.ammeter_metrics['ammeter_bad_lines_total'].value == 3
+    finally:
+        recv.close()
+    # each bad line is logged once
+    assert len([record for record in caplog.records if record.levelno >= logging.WARNING]) == 3
+
+
+def test_async_stop(simulator):
+    simulator.timeout = 30
+
+    async def run():
+        async with AsyncAmmeterRecv(simulator.port) as recv:
+            assert await recv.start()
+            await asyncio.sleep(0.2)
+            report = asyncio.ensure_future(recv.report(wait=5))
+            start = monotonic()
+            assert await recv.stop()
+            assert await report is not None
+            return monotonic() - start
+
+    assert asyncio.run(run()) < 1
+
+
+def test_stream_csv(simulator, tmp_path):
+    file_name = str(tmp_path / 'capture.csv')
+    recv = _recv(simulator, keep_samples=False)
+    writer = SpoolWriter(CsvSink(file_name), flush_interval=0.1)
+    recv.add_sample_listener(writer)
+    try:
+        assert recv.ammeter_start()
+        assert recv.ammeter_report(wait=5) is not None
+    finally:
+        recv.close()
+    writer.close()
+    assert writer.write_error is None
+    assert len(recv.ammeter_data) == 0
+    with open(file_name, encoding='utf-8', newline='') as input_file:
+        rows = list(csv.reader(input_file))
+    assert rows[0][:2] == ['received_epoch', 'name']
+    assert len(rows) - 1 == writer.samples_written == simulator.lines_sent
+
+
+def test_stream_binary(simulator, tmp_path):
+    file_name = str(tmp_path / 'capture.bin')
+    recv = _recv(simulator, keep_samples=False)
+    sink = BinarySink(file_name)
+    writer = SpoolWriter(sink, flush_interval=0.1)
+    recv.add_sample_listener(writer)
+    try:
+        assert recv.ammeter_start()
+        assert recv.ammeter_report(wait=5) is not None
+    finally:
+        recv.close()
+    writer.close()
+    assert writer.write_error is None
+    assert sink.rows_skipped == 0
+    with BinaryCaptureReader(file_name) as reader:
+        assert len(reader) == simulator.lines_sent
+
+
+class FailingSink(CsvSink):
+    """ CsvSink that fails on the first write """
+    def write_samples(self, samples:list):
+        raise RuntimeError('sink failure')
+
+
+def test_stream_sink_failure(simulator, tmp_path):
+    recv = _recv(simulator, keep_samples=False)
+    writer = SpoolWriter(FailingSink(str(tmp_path / 'capture.csv')), flush_interval=0.05, max_batches=2)
+    recv.add_sample_listener(writer)
+    try:
+        assert recv.ammeter_start()
+        assert recv.ammeter_report(wait=5) is not None
+        assert recv.ammeter_sample_count == simulator.lines_sent
+    finally:
+        recv.close()
+    start = monotonic()
+    writer.close()
+    assert monotonic() - start < 1
+    assert isinstance(writer.write_error, RuntimeError)
+    assert writer.samples_written == 0
+    assert writer.samples_dropped == simulator.lines_sent
+
+
+def test_multi_stream():
+    with AmmeterSimulator(rate=200, timeout=1) as first, AmmeterSimulator(rate=300, timeout=1) as second:
+        capture = MultiAmmeterCapture([first.port, second.port], keep_samples=False)
+        output = []
+        merger = StreamingMerger(list(capture.devices), output.extend)
+        for device in capture.devices:
+            capture.add_sample_listener(device, merger.listener(device))
+            capture.devices[device].add_state_listener(merger.state_listener(device))
+        try:
+            assert all(capture.start().values())
+            assert capture.wait(timeout=5)
+        finally:
+            for ammeter in capture.devices.values():
+                ammeter.close()
+        # every device was finished by its state listener, which releases everything
+        assert len(output) == first.lines_sent + second.lines_sent
+        assert output == sorted(output, key=merge_key)
@@ -0,0 +1,73 @@
+"""
+SampleStore tests
+"""
+import pytest
+from ammeter_logger.sample_store import SampleStore, Sample, CHUNK_SIZE
+
+
+def _sample(index:int, name='ch0', width=3):
+    """ Return a Sample with values derived from the index """
+    return Sample(1000.0 + index, name, index * 10, index * 0.5, [float(index + x) for x in range(width)], index * 0.25)
+
+
+def test_append_and_index():
+    store = SampleStore()
+    assert len(store) == 0 and not store
+    store.append_sample(_sample(0))
+    store.append(1001.0, 'ch1', 10, 0.5, [1.0, 2.0, 3.0], 0.25)
+    assert len(store) == 2 and store.last_reads_width == 3
+    assert store[0] == _sample(0)
+    assert store[-1] == _sample(1, name='ch1')
+    assert store[1]['name'] == 'ch1' and store[1].average == 0.25
+    assert store[1].get('missing', 'x') == 'x'
+    with pytest.raises(KeyError):
+        store[1]['missing']
+    with pytest.raises(IndexError):
+        store[2]
+    assert store.names == ['ch0', 'ch1']
+
+
+def test_width_mismatch():
+    store = SampleStore()
+    store.append_sample(_sample(0))
+    with pytest.raises(ValueError):
+        store.append_sample(_sample(1, width=2))
+    assert len(store) == 1
+
+
+def test_chunks_and_columns():
+    count = CHUNK_SIZE + 10
+    store = SampleStore()
+    store.extend(_sample(x, name=f'ch{x % 2}') for x in range(count))
+    assert len(store) == count
+    assert store[CHUNK_SIZE] == _sample(CHUNK_SIZE, name=f'ch{CHUNK_SIZE % 2}')
+    assert store[CHUNK_SIZE - 1:CHUNK_SIZE + 1] == [store[CHUNK_SIZE - 1], store[CHUNK_SIZE]]
+    assert list(store)[-1] == store[-1]
+    ticks = store.column('ticks')
+    assert len(ticks) == count and ticks[-1] == (count - 1) * 10
+    assert list(store.column('last_reads')[:6]) == [0.0, 1.0, 2.0, 1.0, 2.0, 3.0]
+    views = store.column_views('last_reads')
+    assert len(views) == 2 and views[0].shape == (CHUNK_SIZE, 3)
+    assert views[1][9, 2] == float(count - 1 + 2)
+
+
+def test_views_stay_valid():
+    store = SampleStore()
+    store.extend(_sample(x) for x in range(10))
+    view = store.column_views('current_amps')[0]
+    store.extend(_sample(x) for x in range(10, CHUNK_SIZE + 10))
+    assert len(view) == 10 and view[9] == 4.5
+    store.clear()
+    assert len(store) == 0 and store.last_reads_width is None
+    assert view[9] == 4.5
+
+
+def test_snapshot():
+    store = SampleStore()
+    store.extend(_sample(x) for x in range(10))
+    snapshot = store.snapshot()
+    store.extend(_sample(x, name='ch1') for x in range(10, 20))
+    store.clear()
+    assert len(snapshot) == 10 and snapshot.names == ['ch0'] and snapshot.last_reads_width == 3
+    assert snapshot.column_views('ticks')[0].tolist() == [x * 10 for x in range(10)]
+    assert snapshot.column_views('last_reads')[0].shape == (10, 3)
@@ -0,0 +1,71 @@
+"""
+Online statistics tests
+"""
+import random
+from statistics import mean, stdev
+import pytest
+from ammeter_logger.sample_store import Sample
+from ammeter_logger.stats import P2Quantile, SlidingWindow, ChannelStats, StatsEngine
+
+
+def test_p2_quantile():
+    generator = random.Random(1)
+    values = [generator.gauss(1.0, 0.1) for _ in range(20000)]
+    ordered = sorted(values)
+    for q in (0.5, 0.9, 0.99):
+        estimate = P2Quantile(q)
+        for value in values:
+            estimate.add(value)
+        assert estimate.value == pytest.approx(ordered[int(q * len(ordered))], abs=0.01)
+
+
+def test_p2_quantile_few_values():
+    estimate = P2Quantile(0.5)
+    assert estimate.value is None
+    for value in (3.0, 1.0, 2.0):
+        estimate.add(value)
+    assert estimate.value == 2.0
+
+
+def test_sliding_window():
+    window = SlidingWindow(100)
+    for ticks, value in ((0, 5.0), (50, 1.0), (90, 3.0)):
+        window.add(ticks, value)
+    assert window.snapshot() == {'window_ms': 100, 'count': 3, 'mean': 3.0, 'min': 1.0, 'max': 5.0}
+    # ticks 0 and 50 fall out of the window
+    window.add(150, 2.0)
+    assert window.snapshot() == {'window_ms': 100, 'count': 2, 'mean': 2.5, 'min': 2.0, 'max': 3.0}
+    assert SlidingWindow(100).snapshot()['mean'] is None
+
+
+def test_channel_stats():
+    values = [0.1, 0.3, 0.2, 0.5, 0.4, 0.1]
+    stats = ChannelStats(tumbling_ms=2000, sliding_ms=None)
+    for x, value in enumerate(values):
+        stats.add(x * 1000, value)
+    snapshot = stats.snapshot()
+    assert snapshot['count'] == 6 and snapshot['last'] == 0.1
+    assert snapshot['mean'] == pytest.approx(mean(values))
+    assert snapshot['stddev'] == pytest.approx(stdev(values))
+    assert (snapshot['min'], snapshot['max']) == (0.1, 0.5)
+    assert snapshot['duration_ms'] == 5000
+    # trapezoidal charge over the 1 s ticks
+    assert snapshot['amp_hours'] == pytest.approx(sum((a + b) / 2 for a, b in zip(values, values[1:])) / 3600)
+    assert snapshot['sliding'] is None
+    assert [window['start_ticks'] for window in stats.windows] == [0, 2000]
+    assert snapshot['last_window'] == {'start_ticks': 2000, 'count': 2, 'min': 0.2, 'max': 0.5, 'mean': pytest.approx(0.35)}
+
+
+def test_engine():
+    engine = StatsEngine()
+    first = engine.snapshot()
+    engine([Sample(0.0, 'ch0', 0, 0.1, [], 0.1), Sample(0.0, 'ch1', 0, 0.2, [], 0.2)])
+    engine([Sample(0.0, 'ch0', 10, 0.3, [], 0.3)])
+    # published snapshots are replaced, not updated in place
+    assert first == {}
+    assert engine.count == 3
+    assert engine.channel('ch0')['mean'] == pytest.approx(0.2)
+    assert engine.channel('ch1')['count'] == 1
+    assert engine.channel('ch2') is None
+    engine.reset()
+    assert engine.count == 0
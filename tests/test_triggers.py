@@ -0,0 +1,91 @@
+"""
+Triggered capture tests
+"""
+import pytest
+from ammeter_logger.sample_store import Sample
+from ammeter_logger.triggers import ThresholdTrigger, RateTrigger, TriggeredCapture
+
+
+class ListSink:
+    """ Sink that keeps the written samples in memory """
+    def __init__(self):
+        self.samples = []
+        self.run_info = None
+        self.closed = False
+
+    def set_run_info(self, config=None, start=None, stop=None):
+        self.run_info = {'config': config, 'start': start, 'stop': stop}
+
+    def write_samples(self, samples:list):
+        self.samples.extend(samples)
+
+    def flush(self):
+        pass
+
+    def fsync(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def _samples(values:list, start_ticks=0, step=100):
+    """ Return samples of the values, step ms apart """
+    return [Sample(0.0, 'ch0', start_ticks + x * step, value, [value], value) for x, value in enumerate(values)]
+
+
+def test_threshold():
+    samples = _samples([0.1, 0.5, 0.2, -0.1])
+    assert ThresholdTrigger(above=0.4).fired(samples) == [1]
+    assert ThresholdTrigger(above=0.4, below=0.0).fired(samples) == [1, 3]
+    assert ThresholdTrigger(above=1.0).fired(samples) == []
+    assert ThresholdTrigger('average', below=0.15).fired(samples) == [0, 3]
+    with pytest.raises(ValueError):
+        ThresholdTrigger()
+
+
+def test_rate():
+    trigger = RateTrigger(1.0)
+    # 0.05 A in 100 ms is 0.5 A/s, 0.3 A in 100 ms is 3 A/s
+    assert trigger.fired(_samples([0.1, 0.15, 0.45])) == [2]
+    # the last sample of the previous batch is kept per channel
+    assert trigger.fired(_samples([0.1], start_ticks=300)) == [0]
+
+
+def test_segments():
+    sinks = []
+
+    def sink_factory(segment:int):
+        sinks.append(ListSink())
+        return sinks[-1]
+
+    capture = TriggeredCapture([ThresholdTrigger(above=1.0)], pre_seconds=0.3, post_seconds=0.5,
+                               sink_factory=sink_factory, config={'interval': 100})
+    values = [0.0] * 10 + [2.0] + [0.0] * 3 + [2.0] + [0.0] * 20 + [3.0] + [0.0] * 10
+    samples = _samples(values)
+    # batches that split the pre and post windows
+    for start in range(0, len(samples), 4):
+        capture(samples[start:start + 4])
+    capture.close()
+    assert capture.triggers_fired == 3
+    assert [segment['trigger_ticks'] for segment in capture.segments] == [1000, 3500]
+    # 300 ms before the first trigger to 500 ms after the second, which extended the segment
+    first = capture.segments[0]
+    assert (first['start_ticks'], first['stop_ticks'], first['samples']) == (700, 1900, 13)
+    assert [sample.ticks for sample in sinks[0].samples] == list(range(700, 2000, 100))
+    assert [sample.ticks for sample in sinks[1].samples] == list(range(3200, 4100, 100))
+    assert sinks[0].closed and sinks[1].closed
+    assert sinks[0].run_info == {'config': {'interval': 100}, 'start': {'reported': 700}, 'stop': {'reported': 1900}}
+    assert first['trigger_sample']['current_amps'] == 2.0
+
+
+def test_buffer_bounded():
+    capture = TriggeredCapture([ThresholdTrigger(above=1.0)], pre_seconds=10.0, max_buffer=50, sink_factory=lambda segment: ListSink())
+    capture(_samples([0.0] * 500))
+    # limited by the number of samples
+    assert len(capture._buffer) == 50
+    assert capture._buffer[0].ticks == 450 * 100
+    capture = TriggeredCapture([ThresholdTrigger(above=1.0)], pre_seconds=1.0, max_buffer=500, sink_factory=lambda segment: ListSink())
+    capture(_samples([0.0] * 100))
+    # limited by the pre trigger window
+    assert [sample.ticks for sample in capture._buffer] == list(range(8900, 10000, 100))